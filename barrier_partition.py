@@ -0,0 +1,103 @@
+"""Per-group solve of the centralized barrier certificate.
+
+The certificate of the detection script (teleop_twist_keyboard.py) projects
+the nominal inputs of all robots onto the pair constraints in one QP.  Robots
+whose pairs cannot become active this tick do not interact, so
+barrier_components splits them into connected groups and the partitioned
+solver created by create_partitioned_solver solves one smaller QP per group,
+optionally on a thread pool.
+
+The groups carry the same optimum as the joint QP, but every QP is solved to
+its backend's tolerance: the exact solvers ('quadprog', 'active_set') agree
+with the joint solve to about 1e-9, OSQP and CVXOPT (with the loose options
+the detection script sets) only to their tolerances.  test_barrier_partition.py
+states the tolerance of each backend.
+"""
+
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from qp_backends import solve
+
+
+def barrier_components(rows, A, b, dxi):
+    """Splits the centralized barrier certificate into independent QPs.
+
+    The QP projects dxi onto {u : A u <= b}.  When b >= 0, u = 0 is feasible,
+    so any projection stays within |dxi| of dxi and |u_i| <= |dxi_i| + |dxi|.
+    A pair row that this bound cannot make active is left out, which does
+    not change the optimum; the robots linked by the remaining rows form the
+    connected components.
+
+    rows: Mx2 numpy int array, the robot pair of each row of A
+    A, b: the certificate constraints (pair rows, 2N columns)
+    dxi: 2xN numpy array of nominal inputs
+
+    -> (labels, kept) numpy arrays, the component of every robot and the mask
+       of rows that may be active; None if some b < 0 (solve it whole)
+    """
+    if np.any(b < 0):
+        return None
+    N = dxi.shape[1]
+    speed = np.linalg.norm(dxi, axis=0) + np.linalg.norm(dxi)
+    # Row k reads -2e'u_i + 2e'u_j <= b_k, so A_k u <= 2|e| (|u_i| + |u_j|)
+    index = np.arange(len(rows))
+    gradient = np.hypot(A[index, 2 * rows[:, 0]], A[index, 2 * rows[:, 0] + 1])
+    kept = gradient * (speed[rows[:, 0]] + speed[rows[:, 1]]) >= b
+    graph = coo_matrix((np.ones(np.count_nonzero(kept)), (rows[kept, 0], rows[kept, 1])), shape=(N, N))
+    _, labels = connected_components(graph, directed=False)
+    return labels, kept
+
+
+def create_partitioned_solver(backend='cvxopt', workers=1):
+    """Creates the per-group solver of the barrier certificate.
+
+    backend: QP solver of every group, any name in qp_backends.BACKENDS
+    workers: threads solving the groups, 1 solves them in turn
+
+    -> function solve_partitioned(H, f, A, b, rows, dxi, stats=None) -> the
+       stacked inputs (2N numpy array) or None if a group's QP failed.
+       rows and dxi are those of barrier_components; stats, a dict, receives
+       the number of QPs solved ('qps') and of rows kept ('rows', out of
+       'rows_total')
+    """
+    pool = ThreadPoolExecutor(workers) if workers > 1 else None
+
+    def solve_component(problem):
+        return solve(backend, *problem[1:])
+
+    def solve_partitioned(H, f, A, b, rows, dxi, stats=None):
+        if stats is None:
+            stats = {}
+        N = dxi.shape[1]
+        stats['rows_total'] = len(rows)
+        split = barrier_components(rows, A, b, dxi)
+        if split is None:
+            stats.update(qps=1, rows=len(rows))
+            return solve(backend, H, f, A, b)
+        labels, kept = split
+        # A robot without any row keeps its nominal input
+        result = np.reshape(dxi, 2 * N, order='F').copy()
+        problems = []
+        for component in range(labels.max() + 1):
+            robots = np.flatnonzero(labels == component)
+            members = kept & (labels[rows[:, 0]] == component)
+            if robots.size < 2 or not np.any(members):
+                continue
+            columns = np.ravel(np.column_stack((2 * robots, 2 * robots + 1)))
+            problems.append((columns, H[np.ix_(columns, columns)], f[columns], A[np.ix_(members, columns)], b[members]))
+        stats.update(qps=len(problems), rows=np.count_nonzero(kept))
+
+        solutions = map(solve_component, problems) if pool is None else pool.map(solve_component, problems)
+        for (columns, _, _, _, _), solution in zip(problems, solutions):
+            if solution is None:
+                return None
+            result[columns] = solution
+        return result
+
+    return solve_partitioned
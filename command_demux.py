@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""On-robot end of the multiplexed command output (command_output.py).
+
+Subscribes to the Float32MultiArray of all robots' commands published by a
+centralized controller (~input, default /fleet_cmd) and republishes this
+robot's entry, index ~robot, as a Twist on ~output (default /cmd_vel).  If
+no command arrives for ~timeout seconds the robot is stopped once.
+
+    rosrun teleop_twist_keyboard command_demux.py _robot:=3
+"""
+
+from __future__ import print_function
+
+import rospy
+from geometry_msgs.msg import Twist
+from std_msgs.msg import Float32MultiArray
+
+
+def main():
+    rospy.init_node('command_demux')
+    robot = rospy.get_param('~robot')
+    timeout = rospy.get_param('~timeout', 1.0)
+    publisher = rospy.Publisher(rospy.get_param('~output', '/cmd_vel'), Twist, queue_size=1)
+    twist = Twist()
+    state = {'stamp': None}
+
+    def callback(data):
+        twist.linear.x = data.data[2 * robot]
+        twist.angular.z = data.data[2 * robot + 1]
+        publisher.publish(twist)
+        state['stamp'] = rospy.get_time()
+
+    def watchdog(event):
+        if state['stamp'] is not None and rospy.get_time() - state['stamp'] > timeout:
+            twist.linear.x = twist.angular.z = 0.
+            publisher.publish(twist)
+            state['stamp'] = None
+            rospy.logwarn('no fleet command for %.1f s, robot stopped', timeout)
+
+    rospy.Subscriber(rospy.get_param('~input', '/fleet_cmd'), Float32MultiArray, callback, queue_size=1,
+                     tcp_nodelay=True)
+    rospy.Timer(rospy.Duration(timeout / 2.), watchdog)
+    rospy.spin()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except rospy.ROSInterruptException:
+        pass
@@ -0,0 +1,48 @@
+"""Command output stage of the controller nodes.
+
+A controller that computes the commands of several robots can publish them
+all as one Float32MultiArray, laid out as [v0, w0, v1, w1, ...] in the
+units of /cmd_vel, which command_demux.py on every robot turns back into
+that robot's Twist.  create_command_filter decides whether a tick's
+commands are worth publishing at all: they are held back while no command
+has moved more than epsilon from the last published one, but republished
+at least every keepalive seconds so the robots' command timeouts never fire.
+With epsilon <= 0 the filter is off and every tick is published.
+"""
+
+from __future__ import print_function
+
+import numpy as np
+
+
+def create_command_filter(size, epsilon=0., keepalive=0.5):
+    """Creates the change filter of the command output.
+
+    size: number of command values (2 per robot)
+    epsilon: smallest change of any value that is published; <= 0 publishes
+             every tick, repeats included
+    keepalive: longest time (s) between two publishes
+
+    -> (function, function) changed(values, now) -> True when values should
+       be published (they then become the reference), and stats() -> dict of
+       'published' and 'suppressed' ticks
+    """
+    last = np.full(size, np.nan)
+    state = {'stamp': -np.inf}
+    counters = {'published': 0, 'suppressed': 0}
+
+    def changed(values, now):
+        values = np.ravel(values)
+        # nan compares false, so the first tick always publishes
+        if epsilon > 0 and now - state['stamp'] < keepalive and np.all(np.abs(values - last) <= epsilon):
+            counters['suppressed'] += 1
+            return False
+        last[:] = values
+        state['stamp'] = now
+        counters['published'] += 1
+        return True
+
+    def stats():
+        return dict(counters)
+
+    return changed, stats
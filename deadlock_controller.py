@@ -0,0 +1,1103 @@
+"""ROS-free core of the deadlock-resolution controller (teleop_twist_keyboardres.py).
+
+Everything needed to turn a 3xN pose snapshot into the per-robot commands lives
+here, so the live node and the offline replay tool (replay_pose_stream.py) run
+exactly the same tick logic.
+"""
+
+from __future__ import print_function
+
+import math
+import numpy as np
+
+from qp_backends import (solve, solve_osqp, create_osqp_workspace, solve_relaxed, select_backend,
+                         create_active_set_cache, create_fast_path, satisfies)
+from ratelog import create_rate_limited_logger
+from telemetry import STATUS_SOLVED, STATUS_NOMINAL, STATUS_FAILED, STATUS_RELAXED, STATUS_HELD, STATUS_FILTERED
+
+# Nothing in the tick may block on terminal or ssh pipe I/O, so diagnostics go
+# through a rate-limited background logger.  Set qp_verbose to get OSQP's own
+# (blocking) output back when debugging a single solve.
+log, log_stats, stop_log = create_rate_limited_logger({'risk': 1.0, 'barrier': 0.2, 'qp_failed': 0.5, 'rows': 1.0, 'qp': 1.0, 'fast_path': 1.0,
+                                                     'deadlock': 0})
+qp_verbose = False
+# Equilibrate the deadlock QP before OSQP sees it, with the tolerances held on
+# the unscaled residuals (see qp_backends.equilibrated_osqp_problem).  On the
+# recorded runs this takes the OSQP iterations from p99 2350 to 1025 and keeps
+# the commands within 5e-5 of the exact solution, where OSQP's own scaling is
+# off by up to 0.25.  Off by default so replays match the recordings; compare
+# with replay_pose_stream.py --scaling.
+qp_scaling = False
+# A QP without a feasibility certificate gets this many OSQP iterations before
+# it is declared infeasible and the slack-relaxed QP is solved instead.  What
+# OSQP returns from that attempt is only used if it violates no row by more
+# than qp_accept_tol (relative to the largest |b|).
+qp_infeasible_max_iter = 1000
+qp_accept_tol = 1e-3
+qp_slack_weight = 1e2
+# Solver for the deadlock QP, any name in qp_backends.BACKENDS.  Only 'osqp'
+# uses the settings above; select_qp_backend benchmarks the backends instead.
+qp_backend = 'osqp'
+# With another backend, first try each robot's active set of the previous
+# tick (one small KKT solve) before solving the QP in full.
+qp_reuse_active_set = True
+solve_cached, qp_cache_stats = create_active_set_cache()
+# Return the CLF-optimal input without a solver when no barrier row is active
+qp_fast_path = True
+fast_path, fast_path_stats = create_fast_path(candidates=((), (0,)))
+# Optional memo of solutions (qp_backends.create_solution_memo), consulted
+# before the solver; None disables it.
+qp_memo = None
+# Solver of the 2-variable projection of the fast ticks (safety_filter_step)
+filter_backend = 'active_set'
+# The CLF-CBF QP of clf_cbf has its CLF row last
+clf_fast_path, clf_fast_path_stats = create_fast_path(candidates=((), (-1,)))
+# Keep only the k nearest robots as obstacles of each robot (None: all of them),
+# which fixes the QP shape of de_CLF_CBF, clf_cbf and the safety filter at k
+qp_neighbors = None
+
+
+def at_pose(states, poses, position_error=0.05, rotation_error=0.2):
+    """Checks whether robots are "close enough" to poses
+
+    states: 3xN numpy array (of unicycle states)
+    poses: 3xN numpy array (of desired states)
+
+    -> 1xN numpy index array (of agents that are close enough)
+    """
+    #Check user input types
+    assert isinstance(states, np.ndarray), "In the at_pose function, the robot current state argument (states) must be a numpy ndarray. Recieved type %r." % type(states).__name__
+    assert isinstance(poses, np.ndarray), "In the at_pose function, the checked pose argument (poses) must be a numpy ndarray. Recieved type %r." % type(poses).__name__
+    assert isinstance(position_error, (float,int)), "In the at_pose function, the allowable position error argument (position_error) must be an integer or float. Recieved type %r." % type(position_error).__name__
+    assert isinstance(rotation_error, (float,int)), "In the at_pose function, the allowable angular error argument (rotation_error) must be an integer or float. Recieved type %r." % type(rotation_error).__name__
+
+    #Check user input ranges/sizes
+    assert states.shape[0] == 3, "In the at_pose function, the dimension of the state of each robot must be 3 ([x;y;theta]). Recieved %r." % states.shape[0]
+    assert poses.shape[0] == 3, "In the at_pose function, the dimension of the checked pose of each robot must be 3 ([x;y;theta]). Recieved %r." % poses.shape[0]
+    assert states.shape == poses.shape, "In the at_pose function, the robot current state and checked pose inputs must be the same size (3xN, where N is the number of robots being checked). Recieved a state array of size %r x %r and checked pose array of size %r x %r." % (states.shape[0], states.shape[1], poses.shape[0], poses.shape[1])
+
+    # Calculate rotation errors with angle wrapping
+    res = states[2, :] - poses[2, :]
+    res = np.abs(np.arctan2(np.sin(res), np.cos(res)))
+
+    # Calculate position errors
+    pes = np.linalg.norm(states[:2, :] - poses[:2, :], 2, 0)
+
+    # Determine which agents are done
+    done = np.nonzero((res <= rotation_error) & (pes <= position_error))
+
+    return done
+
+def create_si_to_uni_dynamics(linear_velocity_gain=1, angular_velocity_limit=np.pi):
+    """ Returns a function mapping from single-integrator to unicycle dynamics with angular velocity magnitude restrictions.
+
+        linear_velocity_gain: Gain for unicycle linear velocity
+        angular_velocity_limit: Limit for angular velocity (i.e., |w| < angular_velocity_limit)
+
+        -> function
+    """
+
+    #Check user input types
+    assert isinstance(linear_velocity_gain, (int, float)), "In the function create_si_to_uni_dynamics, the linear velocity gain (linear_velocity_gain) must be an integer or float. Recieved type %r." % type(linear_velocity_gain).__name__
+    assert isinstance(angular_velocity_limit, (int, float)), "In the function create_si_to_uni_dynamics, the angular velocity limit (angular_velocity_limit) must be an integer or float. Recieved type %r." % type(angular_velocity_limit).__name__
+
+    #Check user input ranges/sizes
+    assert linear_velocity_gain > 0, "In the function create_si_to_uni_dynamics, the linear velocity gain (linear_velocity_gain) must be positive. Recieved %r." % linear_velocity_gain
+    assert angular_velocity_limit >= 0, "In the function create_si_to_uni_dynamics, the angular velocity limit (angular_velocity_limit) must not be negative. Recieved %r." % angular_velocity_limit
+    
+
+    def si_to_uni_dyn(dxi, poses):
+        """A mapping from single-integrator to unicycle dynamics.
+
+        dxi: 2xN numpy array with single-integrator control inputs
+        poses: 2xN numpy array with single-integrator poses
+
+        -> 2xN numpy array of unicycle control inputs
+        """
+
+        #Check user input types
+        assert isinstance(dxi, np.ndarray), "In the si_to_uni_dyn function created by the create_si_to_uni_dynamics function, the single integrator velocity inputs (dxi) must be a numpy array. Recieved type %r." % type(dxi).__name__
+        assert isinstance(poses, np.ndarray), "In the si_to_uni_dyn function created by the create_si_to_uni_dynamics function, the current robot poses (poses) must be a numpy array. Recieved type %r." % type(poses).__name__
+
+        #Check user input ranges/sizes
+        assert dxi.shape[0] == 2, "In the si_to_uni_dyn function created by the create_si_to_uni_dynamics function, the dimension of the single integrator velocity inputs (dxi) must be 2 ([x_dot;y_dot]). Recieved dimension %r." % dxi.shape[0]
+        assert poses.shape[0] == 3, "In the si_to_uni_dyn function created by the create_si_to_uni_dynamics function, the dimension of the current pose of each robot must be 3 ([x;y;theta]). Recieved dimension %r." % poses.shape[0]
+        assert dxi.shape[1] == poses.shape[1], "In the si_to_uni_dyn function created by the create_si_to_uni_dynamics function, the number of single integrator velocity inputs must be equal to the number of current robot poses. Recieved a single integrator velocity input array of size %r x %r and current pose array of size %r x %r." % (dxi.shape[0], dxi.shape[1], poses.shape[0], poses.shape[1])
+
+        M,N = np.shape(dxi)
+
+        a = np.cos(poses[2, :])
+        b = np.sin(poses[2, :])
+
+        dxu = np.zeros((2, N))
+        dxu[0, :] = linear_velocity_gain*(a*dxi[0, :] + b*dxi[1, :])
+        dxu[1, :] = angular_velocity_limit*np.arctan2(-b*dxi[0, :] + a*dxi[1, :], dxu[0, :])/(np.pi/2)
+
+        return dxu
+
+    return si_to_uni_dyn
+
+def create_si_to_uni_mapping(projection_distance=0.05, angular_velocity_limit=np.pi):
+	"""Creates two functions for mapping from single integrator dynamics to
+    unicycle dynamics and unicycle states to single integrator states.
+
+    This mapping is done by placing a virtual control "point" in front of
+    the unicycle.
+
+    projection_distance: How far ahead to place the point
+    angular_velocity_limit: The maximum angular velocity that can be provided
+
+    -> (function, function)
+    """
+
+	# Check user input types
+	assert isinstance(projection_distance, (int,
+											float)), "In the function create_si_to_uni_mapping, the projection distance of the new control point (projection_distance) must be an integer or float. Recieved type %r." % type(
+		projection_distance).__name__
+	assert isinstance(angular_velocity_limit, (int,
+											   float)), "In the function create_si_to_uni_mapping, the maximum angular velocity command (angular_velocity_limit) must be an integer or float. Recieved type %r." % type(
+		angular_velocity_limit).__name__
+
+	# Check user input ranges/sizes
+	assert projection_distance > 0, "In the function create_si_to_uni_mapping, the projection distance of the new control point (projection_distance) must be positive. Recieved %r." % projection_distance
+	assert projection_distance >= 0, "In the function create_si_to_uni_mapping, the maximum angular velocity command (angular_velocity_limit) must be greater than or equal to zero. Recieved %r." % angular_velocity_limit
+
+	def si_to_uni_dyn(dxi, poses):
+		"""Takes single-integrator velocities and transforms them to unicycle
+        control inputs.
+
+        dxi: 2xN numpy array of single-integrator control inputs
+        poses: 3xN numpy array of unicycle poses
+
+        -> 2xN numpy array of unicycle control inputs
+        """
+
+		# Check user input types
+		assert isinstance(dxi,
+						  np.ndarray), "In the si_to_uni_dyn function created by the create_si_to_uni_mapping function, the single integrator velocity inputs (dxi) must be a numpy array. Recieved type %r." % type(
+			dxi).__name__
+		assert isinstance(poses,
+						  np.ndarray), "In the si_to_uni_dyn function created by the create_si_to_uni_mapping function, the current robot poses (poses) must be a numpy array. Recieved type %r." % type(
+			poses).__name__
+
+		# Check user input ranges/sizes
+		assert dxi.shape[
+				   0] == 2, "In the si_to_uni_dyn function created by the create_si_to_uni_mapping function, the dimension of the single integrator velocity inputs (dxi) must be 2 ([x_dot;y_dot]). Recieved dimension %r." % \
+							dxi.shape[0]
+		assert poses.shape[
+				   0] == 3, "In the si_to_uni_dyn function created by the create_si_to_uni_mapping function, the dimension of the current pose of each robot must be 3 ([x;y;theta]). Recieved dimension %r." % \
+							poses.shape[0]
+		assert dxi.shape[1] == poses.shape[
+			1], "In the si_to_uni_dyn function created by the create_si_to_uni_mapping function, the number of single integrator velocity inputs must be equal to the number of current robot poses. Recieved a single integrator velocity input array of size %r x %r and current pose array of size %r x %r." % (
+		dxi.shape[0], dxi.shape[1], poses.shape[0], poses.shape[1])
+
+		M, N = np.shape(dxi)
+
+		cs = np.cos(poses[2, :])
+		ss = np.sin(poses[2, :])
+
+		dxu = np.zeros((2, N))
+		dxu[0, :] = (cs * dxi[0, :] + ss * dxi[1, :])
+		dxu[1, :] = (1 / projection_distance) * (-ss * dxi[0, :] + cs * dxi[1, :])
+
+		# Impose angular velocity cap.
+		dxu[1, dxu[1, :] > angular_velocity_limit] = angular_velocity_limit
+		dxu[1, dxu[1, :] < -angular_velocity_limit] = -angular_velocity_limit
+
+		return dxu
+
+	def uni_to_si_states(poses):
+		"""Takes unicycle states and returns single-integrator states
+
+        poses: 3xN numpy array of unicycle states
+
+        -> 2xN numpy array of single-integrator states
+        """
+
+		_, N = np.shape(poses)
+
+		si_states = np.zeros((2, N))
+		si_states[0, :] = poses[0, :] + projection_distance * np.cos(poses[2, :])
+		si_states[1, :] = poses[1, :] + projection_distance * np.sin(poses[2, :])
+
+		return si_states
+
+	return si_to_uni_dyn, uni_to_si_states
+
+
+def create_si_position_controller(x_velocity_gain=1, y_velocity_gain=1, velocity_magnitude_limit=0.15):
+    """Creates a position controller for single integrators.  Drives a single integrator to a point
+    using a propoertional controller.
+
+    x_velocity_gain - the gain impacting the x (horizontal) velocity of the single integrator
+    y_velocity_gain - the gain impacting the y (vertical) velocity of the single integrator
+    velocity_magnitude_limit - the maximum magnitude of the produce velocity vector (should be less than the max linear speed of the platform)
+
+    -> function
+    """
+
+    #Check user input types
+    assert isinstance(x_velocity_gain, (int, float)), "In the function create_si_position_controller, the x linear velocity gain (x_velocity_gain) must be an integer or float. Recieved type %r." % type(x_velocity_gain).__name__
+    assert isinstance(y_velocity_gain, (int, float)), "In the function create_si_position_controller, the y linear velocity gain (y_velocity_gain) must be an integer or float. Recieved type %r." % type(y_velocity_gain).__name__
+    assert isinstance(velocity_magnitude_limit, (int, float)), "In the function create_si_position_controller, the velocity magnitude limit (y_velocity_gain) must be an integer or float. Recieved type %r." % type(y_velocity_gain).__name__
+    
+    #Check user input ranges/sizes
+    assert x_velocity_gain > 0, "In the function create_si_position_controller, the x linear velocity gain (x_velocity_gain) must be positive. Recieved %r." % x_velocity_gain
+    assert y_velocity_gain > 0, "In the function create_si_position_controller, the y linear velocity gain (y_velocity_gain) must be positive. Recieved %r." % y_velocity_gain
+    assert velocity_magnitude_limit >= 0, "In the function create_si_position_controller, the velocity magnitude limit (velocity_magnitude_limit) must not be negative. Recieved %r." % velocity_magnitude_limit
+    
+    gain = np.diag([x_velocity_gain, y_velocity_gain])
+
+    def si_position_controller(xi, positions):
+
+        """
+        xi: 2xN numpy array (of single-integrator states of the robots)
+        points: 2xN numpy array (of desired points each robot should achieve)
+
+        -> 2xN numpy array (of single-integrator control inputs)
+
+        """
+
+        #Check user input types
+        assert isinstance(xi, np.ndarray), "In the si_position_controller function created by the create_si_position_controller function, the single-integrator robot states (xi) must be a numpy array. Recieved type %r." % type(xi).__name__
+        assert isinstance(positions, np.ndarray), "In the si_position_controller function created by the create_si_position_controller function, the robot goal points (positions) must be a numpy array. Recieved type %r." % type(positions).__name__
+
+        #Check user input ranges/sizes
+        assert xi.shape[0] == 2, "In the si_position_controller function created by the create_si_position_controller function, the dimension of the single-integrator robot states (xi) must be 2 ([x;y]). Recieved dimension %r." % xi.shape[0]
+        assert positions.shape[0] == 2, "In the si_position_controller function created by the create_si_position_controller function, the dimension of the robot goal points (positions) must be 2 ([x_goal;y_goal]). Recieved dimension %r." % positions.shape[0]
+        assert xi.shape[1] == positions.shape[1], "In the si_position_controller function created by the create_si_position_controller function, the number of single-integrator robot states (xi) must be equal to the number of robot goal points (positions). Recieved a single integrator current position input array of size %r x %r and desired position array of size %r x %r." % (xi.shape[0], xi.shape[1], positions.shape[0], positions.shape[1])
+
+        _,N = np.shape(xi)
+        dxi = np.zeros((2, N))
+
+        # Calculate control input
+        dxi[0][:] = x_velocity_gain*(positions[0][:]-xi[0][:])
+        dxi[1][:] = y_velocity_gain*(positions[1][:]-xi[1][:])
+
+        # Threshold magnitude
+        norms = np.linalg.norm(dxi, axis=0)
+        idxs = np.where(norms > velocity_magnitude_limit)
+        if norms[idxs].size != 0:
+            dxi[:, idxs] *= velocity_magnitude_limit/norms[idxs]
+
+        return dxi
+
+    return si_position_controller
+
+
+_, uni_to_si_states = create_si_to_uni_mapping()
+
+si_to_uni_dyn = create_si_to_uni_dynamics()
+single_integrator_position_controller = create_si_position_controller()
+barrier_gain_CBF = 1
+safety_radius = 4.0
+magnitude_limit = 2
+epi = 0.1
+lambda1 = 1
+lambda2 = 1
+MM_clf = np.array([[lambda1, 0], [0, lambda2]])
+N = 4
+# CBF2 rows with all coefficients below this are dropped from the QP
+cbf2_prune_tol = 1e-12
+
+def de_CLF_CBF(x, xo, xgoal, omega, uui, uuo, riskmatrixi, riskmatrixo, prune_tol=None, stats=None, cache_key=None):
+    """CLF + CBF1 + CBF2 deadlock-resolution QP for one robot.
+
+    With qp_fast_path set, the optimum with only the CLF row active (or none)
+    is checked against all rows first and returned if it satisfies them.
+    Next, with a qp_memo set, a solution cached for the same quantized
+    (x, xo, xgoal, omega, risk) is reused if it satisfies every barrier row
+    of the current QP.
+    Otherwise the QP (see de_CLF_CBF_qp) is solved with the qp_backend solver.  Unless
+    that is OSQP, the active set of the last QP solved under cache_key (the
+    robot index) is tried first when qp_reuse_active_set is set.
+
+    CBF2 rows whose coefficients all fall below prune_tol (default
+    cbf2_prune_tol) and that are trivially satisfied are left out of the QP.
+    Far from a neighbour sigma_x = exp(-h_x**2) underflows, so those rows are
+    skipped before any of their terms are computed.
+
+    OSQP solves go through the solver kept in the DeadlockQP of the obstacle
+    count, set up once and refreshed with the values of each tick.
+    The QP is equilibrated before the solve when qp_scaling is set.  When
+    x = 0 does not certify feasibility (some barrier row has b < 0), OSQP only
+    gets qp_infeasible_max_iter iterations; if it does not solve the problem
+    in time, or its solution violates a row by more than qp_accept_tol, the
+    CBF2 rows are relaxed with penalized slacks and that QP is solved
+    instead, so an infeasible tick still yields a command quickly.
+    The other backends detect infeasibility exactly and go straight to the
+    relaxed QP.
+
+    Pass a dict as stats to get the number of rows kept ('rows') out of
+    'rows_total', whether the relaxed QP was used ('relaxed') and the solver
+    report of qp_backends.solve ('status', 'iter', 'pri_res', ..., and
+    'cached' when the previous active set was reused, 'fast_path').
+
+    -> numpy array [u_x, u_y, delta, omega] or None if no solution was found
+    """
+    if stats is None:
+        stats = {}
+    workspace = qp_workspaces.get(xo.shape[1])
+    if workspace is None:
+        workspace = qp_workspaces[xo.shape[1]] = DeadlockQP(xo.shape[1])
+    H, f, A, b, lb, ub, initvals = workspace.build(x, xo, xgoal, omega, uui, uuo, riskmatrixi, riskmatrixo,
+                                                   prune_tol, stats)
+    num_obstacles = xo.shape[1]
+    stats['relaxed'] = False
+
+    if qp_fast_path:
+        result = fast_path(H, f, A, b, lb, ub, stats)
+        if result is not None:
+            return result
+
+    if qp_memo is None:
+        return de_CLF_CBF_solve(H, f, A, b, lb, ub, initvals, num_obstacles, stats, cache_key, workspace)
+    memo_key = qp_memo[0]((x, xo, xgoal, omega), np.hstack([np.ravel(riskmatrixi), riskmatrixo]))
+    # The CLF row only costs optimality, the barrier rows are re-checked
+    result = qp_memo[1](memo_key, lambda u: satisfies(u, A[1:], b[1:], lb, ub))
+    if result is not None:
+        stats.update(status='solved', iter=0, pri_res=0., dua_res=0.)
+        return result
+    result = de_CLF_CBF_solve(H, f, A, b, lb, ub, initvals, num_obstacles, stats, cache_key, workspace)
+    if result is not None and not stats['relaxed']:
+        qp_memo[2](memo_key, result)
+    return result
+
+
+def de_CLF_CBF_solve(H, f, A, b, lb, ub, initvals, num_obstacles, stats, cache_key=None, workspace=None):
+    """Solves a QP built by de_CLF_CBF_qp with qp_backend (see de_CLF_CBF).
+
+    workspace: DeadlockQP of num_obstacles whose OSQP solver is reused, or None
+               to set up a new one
+
+    -> numpy array [u_x, u_y, delta, omega] or None if no solution was found
+    """
+    num_rows = A.shape[0]
+    solve_osqp_qp = solve_osqp if workspace is None else workspace.osqp
+    if qp_backend != 'osqp':
+        if qp_reuse_active_set and cache_key is not None:
+            result = solve_cached(cache_key, qp_backend, H, f, A, b, lb=lb, ub=ub, initvals=initvals, stats=stats)
+        else:
+            result = solve(qp_backend, H, f, A, b, lb=lb, ub=ub, initvals=initvals, stats=stats)
+        settings = {}
+    # x = 0 (with delta taking up the CLF row) satisfies every row with b >= 0
+    elif np.all(b[1:] >= 0):
+        return solve_osqp_qp(H, f, A, b, scale=qp_scaling, stats=stats, max_iter=6000, eps_prim_inf=1e-9,
+                             lb=lb, ub=ub, initvals=initvals, verbose=qp_verbose)
+    else:
+        # Without the certificate let OSQP give up early on infeasible problems
+        settings = dict(scale=qp_scaling, max_iter=qp_infeasible_max_iter, verbose=qp_verbose)
+        result = solve_osqp_qp(H, f, A, b, stats=stats, eps_prim_inf=1e-5, lb=lb, ub=ub, initvals=initvals, **settings)
+        # The short run may stop on OSQP's tolerances far from feasible
+        if result is not None and not satisfies(result, A, b, lb, ub, qp_accept_tol):
+            stats['status'] = 'solved outside the rows'
+            result = None
+    if result is None and num_rows > num_obstacles + 1:
+        log('qp_failed', 'deadlock QP %s after %d iterations, relaxing %d CBF2 rows',
+            stats['status'], stats['iter'], num_rows - num_obstacles - 1)
+        stats['relaxed'] = True
+        result = solve_relaxed(H, f, A, b, np.arange(num_obstacles + 1, num_rows), qp_slack_weight,
+                               lb=lb, ub=ub, initvals=initvals, stats=stats, backend=qp_backend, **settings)
+    return result
+
+
+def de_CLF_CBF_qp(x, xo, xgoal, omega, uui, uuo, riskmatrixi, riskmatrixo, prune_tol=None, stats=None):
+    """Builds the QP solved by de_CLF_CBF (same arguments).
+
+    stats: optional dict, receives 'rows' and 'rows_total'
+
+    -> (H, f, A, b, lb, ub, initvals) numpy arrays, A and b holding the CLF row,
+       the CBF1 rows and the kept CBF2 rows in that order; unlike
+       DeadlockQP.build they are copies and stay valid
+    """
+    problem = DeadlockQP(xo.shape[1]).build(x, xo, xgoal, omega, uui, uuo, riskmatrixi, riskmatrixo, prune_tol, stats)
+    return tuple(np.array(a) for a in problem)
+
+
+class DeadlockQP(object):
+    """Preallocated storage of the de_CLF_CBF QP for a fixed number of
+    obstacles.  build() writes the coefficients of one tick into buffers
+    owned by the instance and returns views of them made once, so a
+    steady-state tick creates no new arrays.  osqp is an OSQP solver set up
+    once for the pattern of the full QP (qp_backends.create_osqp_workspace).
+
+    The 2x2 products of the CLF/CBF2 terms are written out on scalars; they
+    give the same QP as the matrix expressions up to rounding.
+    """
+    __slots__ = ('num_obstacles', 'H', 'f', 'A', 'b', 'lb', 'ub', 'initvals', 'osqp', 'problems')
+
+    def __init__(self, num_obstacles):
+        self.num_obstacles = num_obstacles
+        self.H = np.diag([1., 1., 1., 10.])
+        self.f = np.zeros(4)
+        self.A = np.zeros((2 * num_obstacles + 1, 4))
+        self.b = np.zeros(2 * num_obstacles + 1)
+        self.lb = np.array([-math.inf, -math.inf, -math.inf, -math.pi / 2])
+        self.ub = np.array([math.inf, math.inf, math.inf, math.pi / 2])
+        self.initvals = np.array([0., 0., 0., math.pi / 2])
+        self.osqp = create_osqp_workspace(4, 2 * num_obstacles + 1)
+        # The returned problem for each number of kept rows
+        self.problems = [(self.H, self.f, self.A[:k], self.b[:k], self.lb, self.ub, self.initvals)
+                         for k in range(2 * num_obstacles + 2)]
+
+    def build(self, x, xo, xgoal, omega, uui, uuo, riskmatrixi, riskmatrixo, prune_tol=None, stats=None):
+        """Fills the QP of one tick (arguments of de_CLF_CBF).
+
+        -> (H, f, A, b, lb, ub, initvals), A and b being views of the first
+           rows of the buffers; they are overwritten by the next build
+        """
+        num_obstacles = self.num_obstacles
+        assert xo.shape[1] == num_obstacles
+        A = self.A
+        b = self.b
+        A.fill(0.)
+        b.fill(0.)
+        if prune_tol is None:
+            prune_tol = cbf2_prune_tol
+        r2 = safety_radius * safety_radius
+        x0 = x[0, 0]
+        x1 = x[1, 0]
+        c = math.cos(omega)
+        s = math.sin(omega)
+        m00 = MM_clf[0, 0]
+        m01 = MM_clf[0, 1]
+        m10 = MM_clf[1, 0]
+        m11 = MM_clf[1, 1]
+
+        ## CLF
+        ## V(x) = |Q@x - xgoal|**2 with Q = [[c, -s], [s, c]]
+        q0 = c * x0 - s * x1 - xgoal[0, 0]
+        q1 = s * x0 + c * x1 - xgoal[1, 0]
+        mq0 = m00 * q0 + m01 * q1
+        mq1 = m10 * q0 + m11 * q1
+        dv0 = 2 * (c * mq0 + s * mq1)
+        dv1 = 2 * (c * mq1 - s * mq0)
+        # OX = [-x1, x0]
+        dqv = -x1 * dv0 + x0 * dv1
+
+        riski = 0.
+        for i in range(1, num_obstacles + 1):
+            ## CBF1
+            e0 = x0 - xo[0, i - 1]
+            e1 = x1 - xo[1, i - 1]
+            h_x = (e0 * e0 + e1 * e1) - r2
+            if h_x <= 0:
+                log('barrier', 'obstacle %d h_x = %s\nx = %s\nxo = %s', i, h_x, x, xo)
+            A[i, 0] = -e0
+            A[i, 1] = -e1
+            ratio = 1 - (riskmatrixi / (riskmatrixi + riskmatrixo[i - 1]))
+            b[i] = ratio * barrier_gain_CBF * h_x
+            riski += 2 * e0 * (uui[0, 0] - uuo[0, i - 1]) + 2 * e1 * (uui[1, 0] - uuo[1, i - 1]) + barrier_gain_CBF * h_x
+
+        riski = -riski + 6000
+        riskvalue = riski / num_obstacles
+        risk_weight = sigmoid2(riskvalue)
+        num_rows = num_obstacles + 1
+
+        # HV = 2 Q'Q, Hh = 2 I
+        hv00 = 2 * (c * c + s * s)
+        hv01 = 2 * (s * c - c * s)
+        hv11 = hv00
+        norm_v = math.sqrt(dv0 * dv0 + dv1 * dv1)
+        for i in range(1, num_obstacles + 1):
+            e0 = x0 - xo[0, i - 1]
+            e1 = x1 - xo[1, i - 1]
+            h_x = (e0 * e0 + e1 * e1) - r2
+
+            ## CBF2
+            sigma_x = math.exp(-(h_x ** 2))
+            if sigma_x <= prune_tol:
+                # The whole row is scaled by sigma_x: 0 <= 0
+                continue
+            dh0 = 2 * e0
+            dh1 = 2 * e1
+            norm_h = math.sqrt(dh0 * dh0 + dh1 * dh1)
+            # PdeltaH = |dH| I - dH dH', PdeltaV = |dV| I - dV dV'
+            ph00 = norm_h - dh0 * dh0
+            ph01 = -dh0 * dh1
+            ph11 = norm_h - dh1 * dh1
+            pv00 = norm_v - dv0 * dv0
+            pv01 = -dv0 * dv1
+            pv11 = norm_v - dv1 * dv1
+            phv0 = ph00 * dv0 + ph01 * dv1
+            phv1 = ph01 * dv0 + ph11 * dv1
+
+            dd0 = hv00 * phv0 + hv01 * phv1 + 2 * (pv00 * dh0 + pv01 * dh1)
+            dd1 = -hv01 * phv0 + hv11 * phv1 + 2 * (pv01 * dh0 + pv11 * dh1)
+            DD = 0.5 * (dv0 * phv0 + dv1 * phv1)
+            # (HV @ OX - [-dv1, dv0])' PdeltaH dV
+            dqd = (-hv00 * x1 + hv01 * x0 + dv1) * phv0 + (hv01 * x1 + hv11 * x0 - dv0) * phv1
+
+            scale = 2 * h_x * sigma_x * (DD - epi)
+            A[num_rows, 0] = -risk_weight * (sigma_x * dd0 - scale * dh0)
+            A[num_rows, 1] = -risk_weight * (sigma_x * dd1 - scale * dh1)
+            A[num_rows, 3] = -risk_weight * sigma_x * dqd
+            b[num_rows] = sigma_x * (DD - epi)
+            # A saturated sigmoid2(riskvalue) leaves 0 <= HD, nothing to enforce
+            if (abs(A[num_rows, 0]) <= prune_tol and abs(A[num_rows, 1]) <= prune_tol
+                    and abs(A[num_rows, 3]) <= prune_tol and b[num_rows] >= -prune_tol):
+                A[num_rows, 0] = A[num_rows, 1] = A[num_rows, 3] = 0.
+                continue
+            num_rows += 1
+
+        if stats is not None:
+            stats['rows'] = num_rows
+            stats['rows_total'] = 2 * num_obstacles + 1
+
+        log('risk', 'riskvalue = %s', riskvalue)
+        # deltaV_2 = 2 MM_clf (x - xgoal)
+        g0 = x0 - xgoal[0, 0]
+        g1 = x1 - xgoal[1, 0]
+        A[0, 0] = risk_weight * dv0 + (1 - risk_weight) * 2 * (m00 * g0 + m01 * g1)
+        A[0, 1] = risk_weight * dv1 + (1 - risk_weight) * 2 * (m10 * g0 + m11 * g1)
+        A[0, 2] = -1  # for delta
+        A[0, 3] = dqv  # for omega
+        b[0] = -(q0 * mq0 + q1 * mq1)
+        return self.problems[num_rows]
+
+
+# One DeadlockQP per obstacle count, shared by the robots of the node
+qp_workspaces = {}
+
+
+def sigmoid2(d):
+    # z = 1. / (1. + np.exp(-(d - 0.)))
+    # z = 1. / (1. + np.exp(-10. * (d - 701.)))
+    z = 1. / (1. + np.exp(-10. * (d -1960.)))
+    # z = 1. / (1. + np.exp(-10. * (d - 800.)))
+    # z = 1. / (1. + np.exp(-10. * (d - 800.)))
+    # z = 1.
+    return z
+
+def riskMatixCal(x, uu, neighbors=None):
+    """Risk of every robot as riskiCal computes it, all robots at once.
+
+    x: 2N numpy array of stacked SI states
+    uu: 2Nx1 numpy array of stacked SI velocities
+    neighbors: optional Nxk numpy int array from nearest_neighbors, the risk
+               of robot i then sums over neighbors[i] only
+
+    -> N numpy array
+    """
+    N = len(x) // 2
+    if neighbors is None:
+        neighbors = nearest_neighbors(np.reshape(x, (2, N), order='F'))
+    p = np.reshape(x, (2, N), order='F')
+    v = np.reshape(uu, (2, N), order='F')
+    e = p[:, :, None] - p[:, neighbors]
+    du = v[:, :, None] - v[:, neighbors]
+    terms = np.sum(2 * e * du, axis=0) + barrier_gain_CBF * (np.sum(e ** 2, axis=0) - safety_radius ** 2)
+    return (6000 - terms.sum(axis=1)) / neighbors.shape[1]
+
+
+
+def riskiCal(xi, xo, uui, uuo):
+    riski = 0
+    num_obstacles = xo.shape[1]
+    for i in range(1, num_obstacles + 1):
+        error = xi[:, 0] - xo[:, i - 1]
+        h_x = (error[0] * error[0] + error[1] * error[1]) - np.power(safety_radius, 2)
+        deltaH = 2 * np.array([[error[0]], [error[1]]])
+        uuerror = np.array([[(uui[:, 0] - uuo[:, i - 1])[0]], [(uui[:, 0] - uuo[:, i - 1])[1]]])
+        riski += deltaH.T @ uuerror + barrier_gain_CBF * h_x
+    riski = -riski + 6000
+    riski = riski / num_obstacles
+    return riski
+
+
+
+
+def nearest_neighbors(x_si, k=None):
+    """Obstacles of every robot: all other robots or, with k set, the k nearest
+    ones found with a partial sort of the pairwise distances.
+
+    x_si: 2xN numpy array of SI states
+    k: number of neighbours kept, None (or k >= N - 1) for all of them
+
+    -> Nx(N-1) or Nxk numpy int array, row i the neighbours of robot i in index order
+    """
+    N = x_si.shape[1]
+    if k is None or k >= N - 1:
+        return np.array([np.flatnonzero(np.arange(N) != i) for i in range(N)], dtype=int).reshape((N, N - 1))
+    error = x_si[:, :, None] - x_si[:, None, :]
+    distance = np.sum(error ** 2, axis=0)
+    np.fill_diagonal(distance, np.inf)
+    return np.sort(np.argpartition(distance, k - 1, axis=1)[:, :k], axis=1)
+
+
+initial_conditions = np.array([[0., 0., -1., 1.], [1., -1., 0., 0.], [-math.pi / 2, math.pi / 2, 0., math.pi]])
+goal_points = np.array([[0., 0., 1., -1.], [-1., 1., 0., 0.], [math.pi / 2, -math.pi / 2, math.pi, 0.]])
+
+
+def clf_cbf(x, xo, xgoal, stats=None):
+    """Cheap CLF + CBF1 QP for one robot, the QP of the detection controller
+    (de_create_single_integrator_CLF_CBF in teleop_twist_keyboard.py) with the
+    barrier of de_CLF_CBF at equal risk:
+
+    min |u|**2 + delta**2  s.t.  -(x - xo_j)' u <= 0.5 * barrier_gain_CBF * h_j,
+                                 2 (x - xgoal)' u - delta <= -|x - xgoal|**2
+
+    x, xo, xgoal: 2x1, 2x(N-1) and 2x1 numpy arrays (QP units)
+    stats: optional dict, receives 'active' (barrier rows active at the
+           solution) and the solver report of qp_backends.solve
+
+    -> numpy array [u_x, u_y, delta] or None if no solution was found
+    """
+    if stats is None:
+        stats = {}
+    num_obstacles = xo.shape[1]
+    error = x - xo
+    A = np.zeros((num_obstacles + 1, 3))
+    b = np.zeros(num_obstacles + 1)
+    A[:num_obstacles, 0:2] = -error.T
+    b[:num_obstacles] = 0.5 * barrier_gain_CBF * (np.sum(error ** 2, axis=0) - safety_radius ** 2)
+    A[num_obstacles, 0:2] = 2 * (x - xgoal)[:, 0]
+    A[num_obstacles, 2] = -1
+    b[num_obstacles] = -np.sum((x - xgoal) ** 2)
+    H = np.eye(3)
+    f = np.zeros(3)
+
+    result = clf_fast_path(H, f, A, b, stats=stats)
+    if result is None:
+        result = solve(qp_backend, H, f, A, b, stats=stats)
+    if result is None:
+        stats['active'] = 0
+    else:
+        slack = A[:num_obstacles] @ result - b[:num_obstacles]
+        stats['active'] = int(np.count_nonzero(slack >= -1e-6 * max(1., np.abs(b).max())))
+    return result
+
+
+def create_deadlock_detector(window=20, speed_threshold=0.5, progress_threshold=0.05, goal_distance=0.3, min_hold=20):
+    """Creates an online deadlock detector for control_step.
+
+    Per robot the last window ticks of commanded SI speed (QP units), distance
+    to the goal (metres) and number of active barrier rows are kept in ring
+    buffers with running sums, so an update is O(1).  A deadlock is suspected
+    once, over a full window, the robot is farther than goal_distance from
+    its goal, its mean speed is below speed_threshold, it got less than
+    progress_threshold closer to the goal and a barrier was active.  The
+    resolution QP then stays on for at least min_hold ticks and until the
+    robot has made progress_threshold of progress over a window.
+
+    -> (function, function, function) update(i, speed, distance, active)
+       after each tick, resolving(i) -> True while the de_CLF_CBF resolution
+       QP should be used, and stats() -> dict of 'detections', 'releases',
+       'resolution_ticks' and 'cheap_ticks'
+    """
+    robots = {}
+    counters = {'detections': 0, 'releases': 0, 'resolution_ticks': 0, 'cheap_ticks': 0}
+
+    def update(i, speed, distance, active):
+        robot = robots.get(i)
+        if robot is None:
+            robot = robots[i] = {'speed': np.zeros(window), 'distance': np.zeros(window), 'active': np.zeros(window),
+                                 'speed_sum': 0., 'active_sum': 0., 'ticks': 0, 'resolving': False, 'held': 0}
+        k = robot['ticks'] % window
+        # The slot being overwritten is the oldest sample
+        oldest_distance = robot['distance'][k] if robot['ticks'] >= window else None
+        robot['speed_sum'] += speed - robot['speed'][k]
+        robot['active_sum'] += active - robot['active'][k]
+        robot['speed'][k] = speed
+        robot['distance'][k] = distance
+        robot['active'][k] = active
+        robot['ticks'] += 1
+        if robot['resolving']:
+            counters['resolution_ticks'] += 1
+            robot['held'] += 1
+        else:
+            counters['cheap_ticks'] += 1
+        if oldest_distance is None:
+            return robot['resolving']
+
+        progress = oldest_distance - distance
+        mean_speed = robot['speed_sum'] / window
+        if not robot['resolving']:
+            if (distance > goal_distance and mean_speed < speed_threshold and progress < progress_threshold
+                    and robot['active_sum'] > 0):
+                robot['resolving'] = True
+                robot['held'] = 0
+                counters['detections'] += 1
+                log('deadlock', 'robot %d: deadlock suspected (mean speed %.3f, progress %.3f m over %d ticks), '
+                    'switching to the resolution QP', i, mean_speed, progress, window)
+        elif robot['held'] >= min_hold and (progress >= progress_threshold or distance <= goal_distance):
+            robot['resolving'] = False
+            counters['releases'] += 1
+            log('deadlock', 'robot %d: progressing again (%.3f m over %d ticks), back to the CLF-CBF QP',
+                i, progress, window)
+        return robot['resolving']
+
+    def resolving(i):
+        robot = robots.get(i)
+        return robot is not None and robot['resolving']
+
+    def stats():
+        """-> dict with the detections, releases, resolution_ticks and cheap_ticks counts"""
+        return dict(counters)
+
+    return update, resolving, stats
+
+
+def create_event_trigger(state_threshold=0.05, margin_decay=0.1, max_hold=10):
+    """Creates the trigger of control_step's event-triggered mode.
+
+    A robot's QP is solved again only when an event fires: its own position or
+    a neighbour's has moved more than state_threshold since the last solve,
+    the barrier margin h = |x - xo|**2 - safety_radius**2 of some neighbour
+    may, in the worst case for those displacements, have decayed by more than
+    margin_decay (fraction of h at the last solve), or the solution has been
+    held for max_hold ticks.  Otherwise the last solution is reused.
+    Positions are those the QP sees (10x the SI states).
+
+    -> (function, function, function, function) check(i, xi, xo) -> held
+       solution or None (solve now), update(i, xi, xo, dxx) after a solve,
+       reset(i) and stats() -> dict of 'triggers' and 'skipped' ticks
+    """
+    last = {}
+    counters = {'triggers': 0, 'skipped': 0}
+
+    def check(i, xi, xo):
+        held = last.get(i)
+        if held is not None and held['xo'].shape == xo.shape and held['ticks'] < max_hold:
+            own = np.linalg.norm(xi[:, 0] - held['xi'][:, 0])
+            others = np.linalg.norm(xo - held['xo'], axis=0)
+            if own <= state_threshold and np.all(others <= state_threshold):
+                # The distance to a neighbour shrinks by at most own + other
+                distance = np.maximum(held['distance'] - own - others, 0.)
+                h = distance ** 2 - safety_radius ** 2
+                if np.all(held['h'] > 0) and np.all(h >= (1 - margin_decay) * held['h']):
+                    held['ticks'] += 1
+                    counters['skipped'] += 1
+                    return held['dxx']
+        counters['triggers'] += 1
+        return None
+
+    def update(i, xi, xo, dxx):
+        distance = np.linalg.norm(xi - xo, axis=0)
+        last[i] = {'xi': xi.copy(), 'xo': xo.copy(), 'distance': distance,
+                   'h': distance ** 2 - safety_radius ** 2, 'dxx': dxx, 'ticks': 0}
+
+    def reset(i):
+        last.pop(i, None)
+
+    def stats():
+        """-> dict with the triggers and skipped tick counts"""
+        return dict(counters)
+
+    return check, update, reset, stats
+
+
+def control_step(x, uu, Omega, goal_points=goal_points, dxu=None, info=None, trigger=None, detector=None):
+    """Runs one controller tick for the whole fleet.  This is the body of
+    control_callback without any ROS in it.
+
+    x: 3xN numpy array of unicycle poses
+    uu: 2Nx1 numpy array of stacked single-integrator velocities (risk terms)
+    Omega: N numpy array of deadlock-resolution rotations (updated in place)
+    goal_points: 3xN numpy array of goal poses
+    dxu: optional 2xN numpy array to write the commands into
+    info: optional dict, receives per-robot 'status' (telemetry STATUS_*), 'risk'
+          'rows' (QP rows kept after CBF2 pruning, 0 when no QP was solved)
+          'iter' (solver iterations, 0 when no QP was solved) and 'reference'
+          (2xN SI velocities before the unicycle mapping, QP units)
+    trigger: optional event trigger from create_event_trigger; robots whose
+             trigger does not fire reuse their last QP solution (STATUS_HELD).
+             A robot's held solution is dropped whenever it leaves the
+             de_CLF_CBF QP (at its goal, or on the clf_cbf QP of the
+             detector), so it is never replayed after a switch
+    detector: optional deadlock detector from create_deadlock_detector; robots
+              not in a suspected deadlock solve the cheap clf_cbf QP instead of
+              de_CLF_CBF (Omega is kept) and info receives 'resolving'
+
+    With qp_neighbors set, each robot only sees its qp_neighbors nearest
+    robots (see nearest_neighbors); the risk of de_CLF_CBF then also sums
+    over those robots only.
+
+    -> 2xN numpy array of unicycle control inputs
+    """
+    _, N = np.shape(x)
+    if dxu is None:
+        dxu = np.zeros((2, N))
+
+    # x does not change during the tick, so the SI states and the risk
+    # matrix are shared by every robot.
+    x_si = uni_to_si_states(x)
+    xx_si = np.reshape(x_si, 2 * N, order='F')
+    neighbors = nearest_neighbors(x_si, qp_neighbors)
+    riskmatrix = riskMatixCal(xx_si, uu, neighbors)
+    uu_si = np.reshape(uu, (2, N), order='F')
+    status = np.full(N, STATUS_SOLVED, dtype=np.uint8)
+    rows = np.zeros(N, dtype=int)
+    iters = np.zeros(N, dtype=int)
+    reference = np.zeros((2, N))
+    resolving = np.zeros(N, dtype=bool)
+    qp_stats = {}
+
+    for i in range(N):
+        riskmatrixi = riskmatrix[i]
+        riskmatrixo = riskmatrix[neighbors[i]]
+
+        # robot i
+        xx = np.reshape(x[:, i], (3, 1))
+        xi = np.reshape(x_si[:, i], (2, 1))
+        xo = x_si[:, neighbors[i]]  # for obstacles
+        xgoal = goal_points[0:2, i].reshape((2, -1))
+        uui = uu[2 * i:2 * i + 2, 0]
+        uui = uui.reshape((2, -1))
+        uuo = uu_si[:, neighbors[i]]
+        if np.size(at_pose(np.vstack((xi, x[2, i])), np.vstack((xgoal, goal_points[2, i])), position_error=0.3, rotation_error=100)) != 1:
+            resolving[i] = detector is None or detector[1](i)
+            dxx = None if trigger is None or not resolving[i] else trigger[0](i, xi*10, xo*10)
+            active = 1
+            if not resolving[i]:
+                if trigger is not None:
+                    trigger[2](i)
+                dxx = clf_cbf(xi*10, xo*10, xgoal*10, stats=qp_stats)
+                if dxx is not None:
+                    dxx = np.array([dxx[0], dxx[1], dxx[2], Omega[i]])
+                iters[i] = qp_stats.get('iter', 0)
+                active = qp_stats['active']
+            elif dxx is not None:
+                status[i] = STATUS_HELD
+            else:
+                dxx = de_CLF_CBF(xi*10, xo*10, xgoal*10, Omega[i], uui, uuo, riskmatrixi, riskmatrixo, stats=qp_stats, cache_key=i)
+                rows[i] = qp_stats['rows']
+                if qp_stats['relaxed']:
+                    status[i] = STATUS_RELAXED
+                iters[i] = qp_stats['iter']
+                log('qp', 'robot %d: %s after %d iterations, primal residual %.2e, dual residual %.2e',
+                    i, qp_stats['status'], qp_stats['iter'], qp_stats['pri_res'], qp_stats['dua_res'])
+                if trigger is not None:
+                    if dxx is None:
+                        trigger[2](i)
+                    else:
+                        trigger[1](i, xi*10, xo*10, dxx)
+        else:
+            dxx = single_integrator_position_controller(xi, xgoal)
+            dxx = np.array([dxx[0, 0], dxx[1, 0], 0., math.pi / 2])
+            status[i] = STATUS_NOMINAL
+            active = 0
+            if trigger is not None:
+                trigger[2](i)
+
+        if dxx is None:
+            dxx = [0, 0, 0, math.pi / 2]
+            status[i] = STATUS_FAILED
+            log('qp_failed', 'de_CLF_CBF returned no solution for robot %d', i)
+
+        Omega[i] = dxx[3]
+        reference[:, i] = dxx[0:2]
+        dx = np.array([[dxx[0]], [dxx[1]]])
+        du = si_to_uni_dyn(dx, xx)
+
+        dxu[0, i] = du[0, 0]
+        dxu[1, i] = du[1, 0]
+
+        if detector is not None:
+            detector[0](i, math.hypot(dxx[0], dxx[1]), np.linalg.norm(xi - xgoal), active)
+
+    log('rows', 'QP rows kept per robot: %s', rows)
+    log('fast_path', 'QP fast path: %s', fast_path_stats())
+    if info is not None:
+        info['status'] = status
+        info['risk'] = riskmatrix
+        info['rows'] = rows
+        info['iter'] = iters
+        info['reference'] = reference
+        if detector is not None:
+            info['resolving'] = resolving
+    return dxu
+
+
+def safety_filter_step(x, reference, riskmatrix, goal_points=goal_points, dxu=None, info=None):
+    """Runs one fast tick: the CBF1 rows of de_CLF_CBF only, as a projection of
+    the slow loop's reference onto the safe set.
+
+    Solves min |u - u_ref|**2  s.t.  -(x_i - x_j)' u <= ratio_ij * barrier_gain_CBF * h_ij
+    per robot (2 variables, N-1 rows or qp_neighbors rows), skipping the
+    solver when u_ref is already safe.  Robots near their goal run the
+    position controller.
+
+    x: 3xN numpy array of unicycle poses
+    reference: 2xN numpy array of SI velocities of the last slow tick (control_step's info['reference'])
+    riskmatrix: N numpy array of risks of the last slow tick (control_step's info['risk'])
+    info: optional dict, receives 'status', 'risk', 'rows' and 'iter' as control_step
+
+    -> 2xN numpy array of unicycle control inputs
+    """
+    _, N = np.shape(x)
+    if dxu is None:
+        dxu = np.zeros((2, N))
+    x_si = uni_to_si_states(x)
+    status = np.full(N, STATUS_FILTERED, dtype=np.uint8)
+    neighbors = nearest_neighbors(x_si, qp_neighbors)
+    H = np.eye(2)
+
+    for i in range(N):
+        xi = np.reshape(x_si[:, i], (2, 1))
+        xgoal = goal_points[0:2, i].reshape((2, -1))
+        if np.size(at_pose(np.vstack((xi, x[2, i])), np.vstack((xgoal, goal_points[2, i])), position_error=0.3, rotation_error=100)) == 1:
+            u = single_integrator_position_controller(xi, xgoal)[:, 0]
+            status[i] = STATUS_NOMINAL
+        else:
+            mask = neighbors[i]
+            error = 10 * (x_si[:, [i]] - x_si[:, mask])
+            h = np.sum(error ** 2, axis=0) - safety_radius ** 2
+            ratio = 1 - riskmatrix[i] / (riskmatrix[i] + riskmatrix[mask])
+            A = -error.T
+            b = ratio * barrier_gain_CBF * h
+            u = reference[:, i]
+            if np.any(A @ u > b):
+                u = solve(filter_backend, H, -u, A, b)
+                if u is None:
+                    u = np.zeros(2)
+                    status[i] = STATUS_FAILED
+                    log('qp_failed', 'safety filter found no safe input for robot %d', i)
+
+        du = si_to_uni_dyn(np.reshape(u, (2, 1)), np.reshape(x[:, i], (3, 1)))
+        dxu[0, i] = du[0, 0]
+        dxu[1, i] = du[1, 0]
+
+    if info is not None:
+        info['status'] = status
+        info['risk'] = riskmatrix
+        info['rows'] = np.zeros(N, dtype=int)
+        info['iter'] = np.zeros(N, dtype=int)
+    return dxu
+
+
+def create_multirate_step(slow_every=5):
+    """Creates a two-rate controller tick.
+
+    Every slow_every-th call runs the full control_step (CLF, CBF1, CBF2,
+    risk, Omega update); the calls in between only run safety_filter_step
+    around the last slow tick's reference, so collision avoidance keeps the
+    tick rate while the deadlock planner runs slow_every times slower.
+
+    -> function step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+       with the arguments of control_step
+    """
+    state = {'ticks': 0, 'reference': None, 'risk': None}
+    slow_info = {}
+
+    def step(x, uu, Omega, goal_points=goal_points, dxu=None, info=None, trigger=None, detector=None):
+        if state['ticks'] % slow_every == 0 or state['reference'] is None:
+            dxu = control_step(x, uu, Omega, goal_points, dxu, slow_info, trigger, detector)
+            state['reference'] = slow_info['reference'].copy()
+            state['risk'] = slow_info['risk'].copy()
+            if info is not None:
+                info.update(slow_info)
+        else:
+            dxu = safety_filter_step(x, state['reference'], state['risk'], goal_points, dxu, info)
+        state['ticks'] += 1
+        return dxu
+
+    return step
+
+
+def select_qp_backend(samples=20, backends=None, seed=0):
+    """Benchmarks the QP backends on deadlock QPs of random fleet poses
+    between initial_conditions and goal_points and makes the fastest one that
+    solves them accurately the qp_backend.  Every QP is also tried with a
+    CBF2 row whose coefficients underflowed to zero next to a b a rounding
+    error below zero, as saturated risk weights produce them; a backend
+    calling those infeasible would send ticks to the relaxed QP.
+
+    samples: number of fleet snapshots (N QPs each)
+    backends: names to try, default all registered
+
+    -> (name, report) as returned by qp_backends.select_backend
+    """
+    global qp_backend
+    rng = np.random.RandomState(seed)
+    uui = np.zeros((2, 1))
+    uuo = np.zeros((2, N - 1))
+    problems = []
+    for _ in range(samples):
+        t = rng.uniform()
+        x = (1 - t) * initial_conditions + t * goal_points + rng.normal(scale=0.1, size=initial_conditions.shape)
+        x_si = uni_to_si_states(x)
+        riskmatrix = riskMatixCal(np.reshape(x_si, 2 * N, order='F'), np.zeros((2 * N, 1)))
+        for i in range(N):
+            mask = np.arange(N) != i
+            H, f, A, b, lb, ub, _ = de_CLF_CBF_qp(x_si[:, [i]] * 10, x_si[:, mask] * 10, goal_points[0:2, [i]] * 10,
+                                                  math.pi / 2, uui, uuo, riskmatrix[i], riskmatrix[mask])
+            problems.append((H, f, A, b, lb, ub))
+            problems.append((H, f, np.vstack((A, np.zeros(4))), np.append(b, -1e-9 * np.abs(b).max()), lb, ub))
+    qp_backend, report = select_backend(problems, backends, default=qp_backend)
+    return qp_backend, report
+
+
+def twist_command(dxu, p):
+    """Scales robot p's unicycle command the way it is published on /cmd_vel.
+
+    -> (linear.x, angular.z)
+    """
+    return dxu[0, p] / 50., dxu[1, p] / 25.
+
+
+def fleet_commands(dxu, out=None):
+    """Scales every robot's command like twist_command.
+
+    out: optional float32 2N numpy array to write into
+
+    -> 2N numpy array [linear.x 0, angular.z 0, linear.x 1, ...]
+    """
+    if out is None:
+        out = np.zeros(2 * dxu.shape[1], dtype=np.float32)
+    out[0::2] = dxu[0] / 50.
+    out[1::2] = dxu[1] / 25.
+    return out
+
+
+def create_tick_recorder(path, N):
+    """Creates a recorder that appends one CSV row per controller tick.
+
+    Each row holds the tick stamp, the 3xN pose snapshot (column-major), the
+    Omega and uu the tick started from and the published (linear.x, angular.z),
+    which is everything replay_pose_stream.py needs to rerun the tick.
+
+    -> (function, function) record(stamp, x, Omega, uu, command) and close()
+    """
+    out = open(path, 'w')
+    header = ['stamp']
+    header += ['%s%d' % (c, i) for i in range(N) for c in ('x', 'y', 'theta')]
+    header += ['omega%d' % i for i in range(N)]
+    header += ['uu%d' % i for i in range(2 * N)]
+    header += ['v', 'w']
+    out.write(','.join(header) + '\n')
+
+    def record(stamp, x, Omega, uu, command):
+        row = [stamp]
+        row.extend(np.reshape(x, 3 * N, order='F'))
+        row.extend(Omega)
+        row.extend(np.reshape(uu, 2 * N))
+        row.extend(command)
+        out.write(','.join(repr(float(v)) for v in row) + '\n')
+
+    def close():
+        out.close()
+
+    return record, close
+
+
+def read_tick_records(path):
+    """Reads a file written by create_tick_recorder.
+
+    -> list of (stamp, x, Omega, uu, command) tuples
+    """
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+        N = sum(1 for name in header if name.startswith('omega'))
+        records = []
+        for line in f:
+            if not line.strip():
+                continue
+            row = np.array([float(v) for v in line.split(',')])
+            stamp = row[0]
+            x = np.reshape(row[1:1 + 3 * N], (3, N), order='F')
+            Omega = row[1 + 3 * N:1 + 4 * N].copy()
+            uu = np.reshape(row[1 + 4 * N:1 + 6 * N], (2 * N, 1))
+            command = row[1 + 6 * N:3 + 6 * N].copy()
+            records.append((stamp, x, Omega, uu, command))
+    return records
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Joint deadlock-resolution QP for the whole fleet (centralized operation).
+
+control_step solves one de_CLF_CBF QP per robot, each treating the other
+robots as static obstacles.  create_joint_step solves a single sparse QP
+instead, over z = [u_x, u_y, delta, omega] of every robot:
+
+  * one CLF row per robot, as in de_CLF_CBF
+  * one CBF1 row per ordered pair (i, j), robot i's row of de_CLF_CBF with its
+    risk share of the barrier.  A single row per pair with the shares summed
+    lets the QP trade the margin between the two robots; in closed-loop
+    simulation of the 4-robot swap that left the fleet in a symmetric
+    deadlock, so the risk split is kept.
+  * one CBF2 row per ordered pair (i, j): robot i's row of de_CLF_CBF plus
+    the terms of its gradient that depend on x_i - x_j, acting on u_j with
+    the opposite sign.  This is where the robots are coupled.
+  * the omega bounds; robots at their goal have u fixed to the position
+    controller's command and no CLF/CBF2 rows, so they are moving obstacles
+
+The sparsity pattern only depends on N.  It is built once, and an OSQP
+solver set up on it is updated in place every tick (values and bounds only)
+and warm-started from the previous tick.  Pruned CBF2 rows keep their
+entries with zero values and infinite bounds.
+
+    python3 joint_deadlock.py [--sizes 4 8 16 32 64] [--ticks 20]
+
+benchmarks the joint QP against the per-robot loop of control_step.
+"""
+
+from __future__ import print_function
+
+import argparse
+import math
+import time
+
+import numpy as np
+import osqp
+from scipy import sparse
+
+import deadlock_controller
+from deadlock_controller import (goal_points, control_step, uni_to_si_states, si_to_uni_dyn, single_integrator_position_controller,
+                                 at_pose, sigmoid2, riskMatixCal, nearest_neighbors, log)
+from telemetry import STATUS_SOLVED, STATUS_NOMINAL
+
+
+def create_joint_pattern(N):
+    """Row and column indices of the joint QP constraint matrix.
+
+    -> (ordered, rows, cols) the ordered pairs (i != j) as a Px2 numpy int
+       array and the COO indices of A in the order the values are written by
+       create_joint_step
+    """
+    ordered = np.array([(i, j) for i in range(N) for j in range(N) if i != j], dtype=int).reshape((-1, 2))
+    pairs = len(ordered)
+    robots = np.arange(N)
+    rows = [np.repeat(robots, 4),
+            N + np.repeat(np.arange(pairs), 2),
+            N + pairs + np.repeat(np.arange(pairs), 5),
+            N + 2 * pairs + np.arange(4 * N)]
+    oi, oj = ordered[:, 0], ordered[:, 1]
+    cols = [np.ravel(4 * robots[:, None] + np.arange(4)),
+            np.ravel(np.column_stack((4 * oi, 4 * oi + 1))),
+            np.ravel(np.column_stack((4 * oi, 4 * oi + 1, 4 * oi + 3, 4 * oj, 4 * oj + 1))),
+            np.arange(4 * N)]
+    return ordered, np.concatenate(rows), np.concatenate(cols)
+
+
+def create_joint_step(prune_tol=None, max_iter=4000, **settings):
+    """Creates a controller tick that solves the joint deadlock QP (see the
+    module docstring).  When OSQP does not solve it, the tick falls back to
+    the per-robot control_step.
+
+    prune_tol: CBF2 pruning tolerance, default deadlock_controller.cbf2_prune_tol
+    max_iter, settings: OSQP settings
+
+    -> function step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+       with the arguments of control_step; trigger and detector are only used
+       by the fallback
+    """
+    state = {'N': None}
+    settings.setdefault('verbose', False)
+
+    def setup(N):
+        ordered, rows, cols = create_joint_pattern(N)
+        # CSC with the data order of the COO values: data = values[order]
+        A = sparse.csc_matrix((np.arange(1., len(rows) + 1), (rows, cols)), shape=(rows.max() + 1, 4 * N))
+        order = A.data.astype(int) - 1
+        state.update(N=N, ordered=ordered, order=order, A=A, solver=None,
+                     P=sparse.csc_matrix(np.kron(np.eye(N), np.diag([1., 1., 1., 10.]))),
+                     l=np.full(A.shape[0], -np.inf), u=np.full(A.shape[0], np.inf))
+
+    def step(x, uu, Omega, goal_points=goal_points, dxu=None, info=None, trigger=None, detector=None):
+        _, N = np.shape(x)
+        if dxu is None:
+            dxu = np.zeros((2, N))
+        if state['N'] != N:
+            setup(N)
+        tol = deadlock_controller.cbf2_prune_tol if prune_tol is None else prune_tol
+        r2 = deadlock_controller.safety_radius ** 2
+        gain = deadlock_controller.barrier_gain_CBF
+        epi = deadlock_controller.epi
+        MM = deadlock_controller.MM_clf
+
+        x_si = uni_to_si_states(x)
+        neighbors = nearest_neighbors(x_si)
+        riskmatrix = riskMatixCal(np.reshape(x_si, 2 * N, order='F'), uu, neighbors)
+        p = 10 * x_si
+        g = 10 * goal_points[0:2]
+        done = np.zeros(N, dtype=bool)
+        done[at_pose(np.vstack((x_si, x[2])), goal_points, position_error=0.3, rotation_error=100)] = True
+        risk_weight = sigmoid2(riskMatixCal(np.reshape(p, 2 * N, order='F'), uu, neighbors))
+
+        ## CLF, V_i = |Q_i x_i - xgoal_i|**2
+        c = np.cos(Omega)
+        s = np.sin(Omega)
+        q = np.vstack((c * p[0] - s * p[1], s * p[0] + c * p[1])) - g
+        mq = MM @ q
+        dv = 2 * np.vstack((c * mq[0] + s * mq[1], c * mq[1] - s * mq[0]))
+        dqv = -p[1] * dv[0] + p[0] * dv[1]
+        dv2 = 2 * MM @ (p - g)
+        clf = np.column_stack((risk_weight * dv[0] + (1 - risk_weight) * dv2[0],
+                               risk_weight * dv[1] + (1 - risk_weight) * dv2[1], -np.ones(N), dqv))
+        clf_b = -np.sum(q * mq, axis=0)
+
+        ## CBF1 and CBF2 per ordered pair, see DeadlockQP.build for the per-robot terms
+        oi, oj = state['ordered'][:, 0], state['ordered'][:, 1]
+        e = p[:, oi] - p[:, oj]
+        h = np.sum(e ** 2, axis=0) - r2
+        cbf1 = np.column_stack((-e[0], -e[1]))
+        cbf1_b = (1 - riskmatrix[oi] / (riskmatrix[oi] + riskmatrix[oj])) * gain * h
+        with np.errstate(under='ignore'):
+            sigma = np.exp(-(h ** 2))
+        dh = 2 * e
+        dvi = dv[:, oi]
+        norm_h = np.hypot(dh[0], dh[1])
+        norm_v = np.hypot(dvi[0], dvi[1])
+        ph00, ph01, ph11 = norm_h - dh[0] ** 2, -dh[0] * dh[1], norm_h - dh[1] ** 2
+        pv00, pv01, pv11 = norm_v - dvi[0] ** 2, -dvi[0] * dvi[1], norm_v - dvi[1] ** 2
+        phv0 = ph00 * dvi[0] + ph01 * dvi[1]
+        phv1 = ph01 * dvi[0] + ph11 * dvi[1]
+        hv00 = 2 * (c * c + s * s)[oi]
+        hv01 = 2 * (s * c - c * s)[oi]
+        # Gradient terms through V (robot i only) and through x_i - x_j
+        v0 = hv00 * phv0 + hv01 * phv1
+        v1 = -hv01 * phv0 + hv00 * phv1
+        DD = 0.5 * (dvi[0] * phv0 + dvi[1] * phv1)
+        scale = 2 * h * sigma * (DD - epi)
+        e0 = sigma * 2 * (pv00 * dh[0] + pv01 * dh[1]) - scale * dh[0]
+        e1 = sigma * 2 * (pv01 * dh[0] + pv11 * dh[1]) - scale * dh[1]
+        dqd = (-hv00 * p[1, oi] + hv01 * p[0, oi] + dvi[1]) * phv0 + (hv01 * p[1, oi] + hv00 * p[0, oi] - dvi[0]) * phv1
+        w = risk_weight[oi]
+        cbf2 = np.column_stack((-w * (sigma * v0 + e0), -w * (sigma * v1 + e1), -w * sigma * dqd, w * e0, w * e1))
+        cbf2_b = sigma * (DD - epi)
+        kept = (sigma > tol) & ~done[oi] & ((np.abs(cbf2).max(axis=1) > tol) | (cbf2_b < -tol))
+        cbf2[~kept] = 0.
+
+        # Bounds, robots at the goal move with the position controller
+        lb = np.tile([-np.inf, -np.inf, -np.inf, -math.pi / 2], N)
+        ub = np.tile([np.inf, np.inf, np.inf, math.pi / 2], N)
+        nominal = single_integrator_position_controller(x_si[:, done], goal_points[0:2, done]) if np.any(done) else None
+        for k, i in enumerate(np.flatnonzero(done)):
+            lb[4 * i:4 * i + 2] = ub[4 * i:4 * i + 2] = nominal[:, k]
+            lb[4 * i + 3] = ub[4 * i + 3] = math.pi / 2
+        clf[done] = 0.
+
+        values = np.concatenate((np.ravel(clf), np.ravel(cbf1), np.ravel(cbf2), np.ones(4 * N)))
+        l = state['l']
+        u = state['u']
+        pairs = len(oi)
+        u[:N] = np.where(done, np.inf, clf_b)
+        u[N:N + pairs] = cbf1_b
+        u[N + pairs:-4 * N] = np.where(kept, cbf2_b, np.inf)
+        l[-4 * N:] = lb
+        u[-4 * N:] = ub
+
+        A = state['A']
+        A.data[:] = values[state['order']]
+        if state['solver'] is None:
+            state['solver'] = osqp.OSQP()
+            state['solver'].setup(P=state['P'], q=np.zeros(4 * N), A=A, l=l, u=u, max_iter=max_iter, **settings)
+        else:
+            state['solver'].update(Ax=A.data, l=l, u=u)
+        res = state['solver'].solve()
+
+        if res.info.status != 'solved':
+            log('qp_failed', 'joint deadlock QP %s after %d iterations, solving per robot', res.info.status, res.info.iter)
+            return control_step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+
+        z = np.reshape(res.x, (N, 4))
+        Omega[:] = z[:, 3]
+        reference = z[:, 0:2].T.copy()
+        dxu[:] = si_to_uni_dyn(reference, x)
+        log('qp', 'joint QP: %s after %d iterations', res.info.status, res.info.iter)
+
+        if info is not None:
+            info['status'] = np.where(done, STATUS_NOMINAL, STATUS_SOLVED).astype(np.uint8)
+            info['risk'] = riskmatrix
+            info['rows'] = np.where(done, 0, N + np.bincount(oi[kept], minlength=N))
+            info['iter'] = np.full(N, res.info.iter, dtype=int)
+            info['reference'] = reference
+        return dxu
+
+    return step
+
+
+def benchmark(sizes=(4, 8, 16, 32, 64), ticks=20, seed=0):
+    """Times the joint QP against the per-robot loop of control_step on
+    position swaps across a circle (the deadlock-prone case).  The fleet runs
+    closed loop on the joint step, both controllers see the same poses.
+
+    -> list of (N, per-robot ms, joint ms, joint iterations) per size
+    """
+    rng = np.random.RandomState(seed)
+    results = []
+    for N in sizes:
+        radius = max(1., 0.6 * N / math.pi)
+        angle = 2 * math.pi * (np.arange(N) + rng.uniform(-0.1, 0.1, N)) / N
+        x = np.vstack((radius * np.cos(angle), radius * np.sin(angle), angle + math.pi))
+        goals = np.vstack((-x[0], -x[1], x[2]))
+        uu = np.zeros((2 * N, 1))
+        omega_loop = math.pi / 2 * np.ones(N)
+        omega_joint = math.pi / 2 * np.ones(N)
+        joint = create_joint_step()
+        loop_times, joint_times, iters = [], [], []
+        info = {}
+        for _ in range(ticks):
+            t0 = time.perf_counter()
+            control_step(x, uu, omega_loop, goals)
+            loop_times.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            dxu = joint(x, uu, omega_joint, goals, info=info)
+            joint_times.append(time.perf_counter() - t0)
+            iters.append(info['iter'].max())
+            x = x.copy()
+            x[0] += 0.05 * dxu[0] / 5 * np.cos(x[2])
+            x[1] += 0.05 * dxu[0] / 5 * np.sin(x[2])
+            x[2] += 0.05 * dxu[1] / 5
+        results.append((N, 1e3 * np.mean(loop_times), 1e3 * np.mean(joint_times), np.mean(iters)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64], help='fleet sizes')
+    parser.add_argument('--ticks', type=int, default=20, help='ticks per fleet size')
+    args = parser.parse_args()
+    print('%5s %14s %12s %12s' % ('N', 'per robot', 'joint', 'iterations'))
+    for N, loop_ms, joint_ms, iters in benchmark(args.sizes, args.ticks):
+        print('%5d %11.2f ms %9.2f ms %12.0f' % (N, loop_ms, joint_ms, iters))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""Synthetic mocap load generator for stress-testing the controller nodes.
+
+Publishes PoseStamped on /vrpn_client_node/<body>/pose for a configurable
+number of bodies moving along scripted trajectories, stepping through every
+combination of --bodies and --rates for --hold seconds each.  The first
+bodies are the robots of --names, so the controller under test sees them
+move; the others only add mocap traffic (to the relay, the master and the
+network): the controllers subscribe to their four robots' topics only, so
+more bodies do not load their callbacks.  Run it against a controller whose
+robot bases are not driving.
+
+While a level runs, the per-tick telemetry of the controllers (started with
+_telemetry:=udp://<this PC>:<port>, see telemetry.py) is collected, and each
+level reports the pose rate actually published, the controllers' tick rate,
+p99 tick interval, solve time and pose age, and the fraction of overrun ticks (a tick
+interval over --overrun periods, or a solve longer than one period).  The
+throughput ceiling is the last level before the overrun fraction exceeds
+--max-overrun.
+
+    python3 mocap_load.py --bodies 4 16 64 --rates 100 200 --telemetry-port 5005
+"""
+
+from __future__ import print_function
+
+import argparse
+import math
+import socket
+import threading
+import time
+
+import numpy as np
+
+from telemetry import parse_datagram
+from udp_poses import standin_poses
+
+NAMES = ['Hus117', 'Hus137', 'Hus138', 'Hus188']
+
+
+def figure8_poses(t, N, radius=1.0, period=20.):
+    """-> Nx3 (x, y, theta) of N bodies spread along a figure eight"""
+    s = 2 * math.pi * (np.arange(N) / float(N) + t / period)
+    x, y = radius * np.sin(s), radius * np.sin(s) * np.cos(s)
+    dx, dy = np.cos(s), np.cos(2 * s)
+    return np.column_stack((x, y, np.arctan2(dy, dx)))
+
+
+def static_poses(t, N, spacing=0.5):
+    """-> Nx3 (x, y, theta) of N bodies standing on a grid"""
+    side = int(math.ceil(math.sqrt(N)))
+    index = np.arange(N)
+    return np.column_stack((spacing * (index % side), spacing * (index // side), np.zeros(N)))
+
+
+TRAJECTORIES = {'circle': standin_poses, 'figure8': figure8_poses, 'static': static_poses}
+
+
+def tick_summary(records, period, overrun=1.5):
+    """Timing of one controller over a window of its telemetry records.
+
+    records: record tuples of telemetry.RECORD from one robot, in arrival order
+    period: nominal tick period (s)
+    overrun: tick intervals longer than this many periods count as overruns
+
+    -> dict of 'ticks', 'rate' (Hz), 'interval_p99', 'solve_p99' and
+       'pose_age_p99' (s) and 'overrun' (fraction of ticks)
+    """
+    stamps = np.array([record[0] for record in records])
+    solve = np.array([record[4] for record in records])
+    pose_age = np.array([record[8] for record in records])
+    if len(stamps) < 2:
+        return {'ticks': len(stamps), 'rate': 0., 'interval_p99': math.nan, 'solve_p99': math.nan,
+                'pose_age_p99': math.nan, 'overrun': 1.}
+    interval = np.diff(stamps)
+    late = np.concatenate(([False], interval > overrun * period)) | (solve > period)
+    return {'ticks': len(stamps), 'rate': (len(stamps) - 1) / (stamps[-1] - stamps[0]),
+            'interval_p99': np.percentile(interval, 99), 'solve_p99': np.percentile(solve, 99),
+            'pose_age_p99': np.nanpercentile(pose_age, 99) if np.any(np.isfinite(pose_age)) else math.nan,
+            'overrun': late.mean()}
+
+
+def create_telemetry_listener(port, host='0.0.0.0'):
+    """Collects the telemetry datagrams of the controllers on a background thread.
+
+    -> (function, function) take() -> dict sender address -> list of records
+       since the last take(), and close()
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.settimeout(0.2)
+    pending = {}
+    lock = threading.Lock()
+    state = {'running': True}
+
+    def listen():
+        while state['running']:
+            try:
+                data, sender = sock.recvfrom(65536)
+            except socket.timeout:
+                continue
+            except (IOError, OSError):
+                break
+            # Every controller reports the same robot index, so tell them
+            # apart by the address they send from
+            with lock:
+                pending.setdefault(sender, []).extend(parse_datagram(data))
+
+    thread = threading.Thread(target=listen, name='telemetry-listener')
+    thread.daemon = True
+    thread.start()
+
+    def take():
+        with lock:
+            records = dict(pending)
+            pending.clear()
+        return records
+
+    def close():
+        state['running'] = False
+        thread.join(1.0)
+        sock.close()
+
+    return take, close
+
+
+def create_load_publisher(names, trajectory):
+    """Creates the PoseStamped publishers of the synthetic bodies.
+
+    names: names of the first bodies, the others are called body<i>
+    trajectory: function(t, N) -> Nx3 (x, y, theta), see TRAJECTORIES
+
+    -> function run(N, rate, hold) -> poses published per second, sending
+       N bodies at rate Hz for hold seconds
+    """
+    import rospy
+    from geometry_msgs.msg import PoseStamped
+
+    publishers = []
+    messages = []
+
+    def run(N, rate, hold):
+        while len(publishers) < N:
+            i = len(publishers)
+            name = names[i] if i < len(names) else 'body%d' % i
+            publishers.append(rospy.Publisher('/vrpn_client_node/%s/pose' % name, PoseStamped, queue_size=1))
+            messages.append(PoseStamped())
+            messages[-1].header.frame_id = 'world'
+        time.sleep(0.5)  # let the new publishers connect
+        start = time.time()
+        frame = 0
+        sent = 0
+        while time.time() - start < hold and not rospy.is_shutdown():
+            delay = start + frame / float(rate) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.time()
+            stamp = rospy.Time.from_sec(now)
+            for i, (x, y, theta) in enumerate(trajectory(now - start, N)):
+                message = messages[i]
+                message.header.stamp = stamp
+                message.pose.position.x, message.pose.position.y = x, y
+                message.pose.orientation.z, message.pose.orientation.w = math.sin(theta / 2), math.cos(theta / 2)
+                publishers[i].publish(message)
+            sent += N
+            frame += 1
+        return sent / (time.time() - start)
+
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bodies', type=int, nargs='+', default=[4, 8, 16, 32, 64], help='numbers of bodies')
+    parser.add_argument('--rates', type=float, nargs='+', default=[100.], help='mocap frame rates (Hz)')
+    parser.add_argument('--hold', type=float, default=10., help='seconds per level')
+    parser.add_argument('--names', nargs='+', default=NAMES, help='names of the first bodies')
+    parser.add_argument('--trajectory', choices=sorted(TRAJECTORIES), default='circle')
+    parser.add_argument('--telemetry-port', type=int, default=5005, help='UDP port the controllers send telemetry to')
+    parser.add_argument('--tick-rate', type=float, default=20., help='tick rate of the controllers (Hz)')
+    parser.add_argument('--overrun', type=float, default=1.5, help='tick interval, in periods, that counts as an overrun')
+    parser.add_argument('--max-overrun', type=float, default=0.01, help='overrun fraction that ends the capacity')
+    args = parser.parse_args()
+
+    import rospy
+    rospy.init_node('mocap_load', anonymous=True)
+    take, close = create_telemetry_listener(args.telemetry_port)
+    run = create_load_publisher(args.names, TRAJECTORIES[args.trajectory])
+    period = 1. / args.tick_rate
+
+    print('%6s %8s %10s %10s %9s %11s %10s %10s %8s' % ('bodies', 'rate', 'offered/s', 'sent/s', 'ticks/s', 'interval99',
+                                                       'solve99', 'age99', 'overrun'))
+    ceiling = onset = None
+    try:
+        for rate in args.rates:
+            for N in args.bodies:
+                take()
+                sent = run(N, rate, args.hold)
+                if rospy.is_shutdown():
+                    return
+                summaries = [tick_summary(records, period, args.overrun) for records in take().values()]
+                if not summaries:
+                    print('%6d %8.0f %10.0f %10.0f   no telemetry' % (N, rate, N * rate, sent))
+                    continue
+                worst = max(summaries, key=lambda summary: summary['overrun'])
+                print('%6d %8.0f %10.0f %10.0f %9.1f %8.1f ms %7.1f ms %7.1f ms %7.1f%%%s' % (
+                    N, rate, N * rate, sent, min(summary['rate'] for summary in summaries),
+                    1e3 * worst['interval_p99'], 1e3 * max(summary['solve_p99'] for summary in summaries),
+                    1e3 * np.nanmax([summary['pose_age_p99'] for summary in summaries]), 100 * worst['overrun'],
+                    '' if sent > 0.95 * N * rate else '  (generator behind)'))
+                if worst['overrun'] > args.max_overrun:
+                    if onset is None:
+                        onset = (N, rate)
+                elif onset is None:
+                    ceiling = (N, rate)
+    finally:
+        close()
+    if ceiling is not None:
+        print('throughput ceiling: %d bodies at %.0f Hz (%.0f poses/s)' % (ceiling[0], ceiling[1], ceiling[0] * ceiling[1]))
+    if onset is not None:
+        print('tick overruns start at %d bodies at %.0f Hz' % onset)
+    else:
+        print('no tick overruns up to the highest level')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""Receding-horizon (MPC-CBF) mode for the resolution controller.
+
+Instead of the one-step CLF/CBF QPs of control_step, create_mpc_step plans
+`horizon` stages of the single-integrator fleet
+
+    p_{k+1} = p_k + dt u_k        (QP units, positions 10x metres)
+
+where u is the SI command in the units of dxu, which is published as dxu/50
+m/s, i.e. dxu/5 QP units per second, so a stage of stage_ticks controller
+ticks has dt = stage_ticks * tick / 5.
+
+minimizing sum_k |p_k - goal|**2 (terminal stage weighted up) plus
+input_weight |u_k|**2, with |u| bounded per axis by vmax and a
+discrete-time CBF for every pair at every stage
+
+    h_ij(p_{k+1}) >= (1 - gamma) h_ij(p_k),   h_ij = |p_i - p_j|**2 - safety_radius**2
+
+linearized around the previous plan shifted by one stage (h is convex, so
+the linearized left-hand side never overstates the margin).  Pairs that
+cannot come within safety_radius over the horizon at vmax get no active
+rows.
+
+States and inputs are interleaved stage by stage, so the KKT system OSQP
+factors is banded.  The sparsity pattern is fixed for a given fleet size and
+horizon; one OSQP solver is updated in place every tick and warm-started from
+the shifted previous solution.  Only u_0 is applied.  Omega is not used.
+
+The unicycles only track the SI plan (they move along their heading and
+turn slowly), so the plan keeps safety_radius + margin, and the applied
+commands go through a brake: with the velocity the published unicycle
+commands give the SI points, any pair that would violate the per-tick CBF
+h(p + tick v) >= (1 - brake_gamma) h(p) first loses the forward
+speed of both robots, then their turning too.
+
+    python3 mpc_cbf.py [--robots 4 8] [--ticks 400]
+
+runs the swap scenario closed loop and reports the solve times.
+"""
+
+from __future__ import print_function
+
+import argparse
+import math
+import time
+
+import numpy as np
+import osqp
+from scipy import sparse
+
+import deadlock_controller
+from deadlock_controller import goal_points, initial_conditions, control_step, uni_to_si_states, si_to_uni_dyn, log
+from telemetry import STATUS_SOLVED
+
+# Distance (m) of the SI point ahead of the robot, as in uni_to_si_states
+projection_distance = 0.05
+
+
+def create_mpc_pattern(N, horizon):
+    """Row and column indices of the MPC constraint matrix.
+
+    Variables per stage k: u_k (2N) then p_{k+1} (2N).  Rows: the dynamics
+    (2N per stage), one CBF row per pair and stage, the input bounds.
+
+    -> (pairs, rows, cols) the Px2 numpy int array of robot pairs and the COO
+       indices of A in the order the values are written by create_mpc_step
+    """
+    pairs = np.transpose(np.triu_indices(N, 1))
+    n, P = 2 * N, len(pairs)
+    u_index = lambda k: 2 * k * n + np.arange(n)
+    p_index = lambda k: (2 * k - 1) * n + np.arange(n)  # p_k, k >= 1
+    rows, cols = [], []
+    row = 0
+    for k in range(horizon):
+        # p_{k+1} - p_k - dt u_k = 0 (p_0 is data)
+        for part in ([p_index(k + 1), u_index(k)] + ([p_index(k)] if k else [])):
+            rows.append(row + np.arange(n))
+            cols.append(part)
+        row += n
+    pi = np.ravel(np.column_stack((2 * pairs[:, 0], 2 * pairs[:, 0] + 1, 2 * pairs[:, 1], 2 * pairs[:, 1] + 1)))
+    for k in range(1, horizon + 1):
+        # g_k' p_k - (1 - gamma) g_{k-1}' p_{k-1} >= ... (p_0 is data)
+        for stage in ([k] + ([k - 1] if k > 1 else [])):
+            rows.append(row + np.repeat(np.arange(P), 4))
+            cols.append(p_index(stage)[pi])
+        row += P
+    for k in range(horizon):
+        rows.append(row + np.arange(n))
+        cols.append(u_index(k))
+        row += n
+    return pairs, np.concatenate(rows), np.concatenate(cols)
+
+
+def create_mpc_step(horizon=10, stage_ticks=5, tick=0.05, gamma=0.05, vmax=10., margin=2., brake_gamma=0.2,
+                    input_weight=0.1, terminal_weight=10., max_iter=1000, **settings):
+    """Creates a controller tick that applies the first input of the MPC-CBF
+    plan (see the module docstring).  When OSQP does not solve the plan, the
+    tick falls back to control_step.
+
+    horizon: number of stages
+    stage_ticks: controller ticks per stage
+    tick: controller tick period (s)
+    gamma: CBF decay per stage, 0 < gamma <= 1; the default over the
+           default stage time dt matches barrier_gain_CBF of the one-step QPs
+    vmax: bound on each SI input component (QP units)
+    margin: added to safety_radius in the plan (QP units), for the unicycles
+            only tracking the SI plan approximately; the brake keeps safety_radius
+    brake_gamma: CBF decay per tick allowed by the brake
+    input_weight, terminal_weight: cost weights relative to the stage position error
+    max_iter, settings: OSQP settings
+
+    -> function step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+       with the arguments of control_step; uu, Omega, trigger and detector
+       are only used by the fallback
+    """
+    state = {'N': None}
+    # The published dxu / 50 m/s moves dxu / 5 QP units per second
+    dt = stage_ticks * tick / 5.
+    settings.setdefault('verbose', False)
+    settings.setdefault('eps_abs', 1e-4)
+    settings.setdefault('eps_rel', 1e-4)
+    settings.setdefault('polish', False)
+
+    def setup(N):
+        pairs, rows, cols = create_mpc_pattern(N, horizon)
+        n, P = 2 * N, len(pairs)
+        A = sparse.csc_matrix((np.arange(1., len(rows) + 1), (rows, cols)), shape=(rows.max() + 1, 2 * n * horizon))
+        weights = np.tile(np.concatenate((input_weight * np.ones(n), np.ones(n))), horizon)
+        weights[-n:] = terminal_weight
+        state.update(N=N, pairs=pairs, A=A, order=A.data.astype(int) - 1, solver=None, z=None,
+                     P=sparse.diags(weights).tocsc(), weights=weights,
+                     dynamics=np.concatenate([np.concatenate((np.ones(n), -dt * np.ones(n)) + ((-np.ones(n),) if k else ()))
+                                              for k in range(horizon)]),
+                     l=np.zeros(A.shape[0]), u=np.zeros(A.shape[0]))
+        state['l'][n * horizon + P * horizon:] = -vmax
+        state['u'][n * horizon + P * horizon:] = vmax
+        state['u'][n * horizon:n * horizon + P * horizon] = np.inf
+
+    def step(x, uu, Omega, goal_points=goal_points, dxu=None, info=None, trigger=None, detector=None):
+        _, N = np.shape(x)
+        if dxu is None:
+            dxu = np.zeros((2, N))
+        if state['N'] != N:
+            setup(N)
+        n = 2 * N
+        pairs = state['pairs']
+        P = len(pairs)
+        radius = deadlock_controller.safety_radius + margin
+
+        p0 = np.reshape(10 * uni_to_si_states(x), n, order='F')
+        goal = np.reshape(10 * goal_points[0:2], n, order='F')
+
+        # Previous plan shifted by one stage, or standing still
+        z = state['z']
+        if z is None:
+            z = np.tile(np.concatenate((np.zeros(n), p0)), horizon)
+        else:
+            z = np.concatenate((z[2 * n:], z[-2 * n:]))
+        plan = np.vstack((p0, np.reshape(z, (horizon, 2 * n))[:, n:]))
+
+        # Linearized h_ij at every stage of the plan
+        i, j = pairs[:, 0], pairs[:, 1]
+        e = np.stack((plan[:, 2 * i] - plan[:, 2 * j], plan[:, 2 * i + 1] - plan[:, 2 * j + 1]), axis=2)
+        h = np.sum(e ** 2, axis=2) - radius ** 2
+        g = 2 * np.concatenate((e, -e), axis=2)  # gradient on (p_i, p_j)
+        pair_states = np.stack((plan[:, 2 * i], plan[:, 2 * i + 1], plan[:, 2 * j], plan[:, 2 * j + 1]), axis=2)
+        offset = h - np.sum(g * pair_states, axis=2)  # h_lin(p) = offset + g'p
+        # Pairs that cannot meet within the horizon
+        reach = 2 * math.sqrt(2) * vmax * dt * horizon
+        far = np.sqrt(np.sum(e[0] ** 2, axis=1)) - reach > radius
+
+        values = [state['dynamics']]
+        cbf = []
+        lower = np.zeros((horizon, P))
+        for k in range(1, horizon + 1):
+            cbf.append(np.ravel(g[k]))
+            if k > 1:
+                cbf.append(np.ravel(-(1 - gamma) * g[k - 1]))
+                lower[k - 1] = (1 - gamma) * offset[k - 1] - offset[k]
+            else:
+                lower[0] = (1 - gamma) * h[0] - offset[1]
+        lower[:, far] = -np.inf
+        values.extend(cbf)
+        values.append(np.ones(n * horizon))
+        A = state['A']
+        A.data[:] = np.concatenate(values)[state['order']]
+
+        l = state['l']
+        u = state['u']
+        l[:n] = u[:n] = p0
+        l[n * horizon:n * horizon + P * horizon] = np.ravel(lower)
+        q = -state['weights'] * np.tile(np.concatenate((np.zeros(n), goal)), horizon)
+
+        if state['solver'] is None:
+            state['solver'] = osqp.OSQP()
+            state['solver'].setup(P=state['P'], q=q, A=A, l=l, u=u, max_iter=max_iter, **settings)
+        else:
+            state['solver'].update(q=q, Ax=A.data, l=l, u=u)
+        state['solver'].warm_start(x=z)
+        res = state['solver'].solve()
+
+        if res.info.status != 'solved':
+            log('qp_failed', 'MPC-CBF plan %s after %d iterations, using control_step', res.info.status, res.info.iter)
+            state['z'] = None
+            return control_step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+
+        state['z'] = res.x
+        reference = np.reshape(res.x[:n], (2, N), order='F')
+        dxu[:] = si_to_uni_dyn(reference, x)
+        braked = brake(x, dxu, pairs, tick, brake_gamma)
+        log('qp', 'MPC-CBF plan: %s after %d iterations, %d robots braked', res.info.status, res.info.iter,
+            np.count_nonzero(braked))
+
+        if info is not None:
+            active = np.zeros(N, dtype=int)
+            np.add.at(active, i[~far], horizon)
+            np.add.at(active, j[~far], horizon)
+            info['status'] = np.full(N, STATUS_SOLVED, dtype=np.uint8)
+            info['risk'] = np.full(N, math.nan)
+            info['rows'] = active
+            info['iter'] = np.full(N, res.info.iter, dtype=int)
+            info['reference'] = reference
+        return dxu
+
+    return step
+
+
+def brake(x, dxu, pairs, tick, gamma):
+    """Stops robots whose published commands would break the per-tick CBF.
+
+    The SI point of a unicycle, projection_distance ahead of it, moves with
+    v (cos, sin) + projection_distance w (-sin, cos) for the published v and
+    w.  While some pair would violate h(p + tick v) >= (1 - gamma) h(p), both
+    robots of the pair first lose their forward speed and then their turning.
+
+    x: 3xN numpy array of unicycle poses
+    dxu: 2xN numpy array of unicycle commands, changed in place
+    pairs: Px2 numpy int array of robot pairs
+
+    -> N numpy int array, 0 unchanged, 1 forward speed removed, 2 stopped
+    """
+    N = x.shape[1]
+    i, j = pairs[:, 0], pairs[:, 1]
+    p = 10 * uni_to_si_states(x)
+    heading = np.vstack((np.cos(x[2]), np.sin(x[2])))
+    normal = np.vstack((-heading[1], heading[0]))
+    r2 = deadlock_controller.safety_radius ** 2
+    h = np.sum((p[:, i] - p[:, j]) ** 2, axis=0) - r2
+    level = np.zeros(N, dtype=int)
+    for _ in range(2 * N):
+        v = np.where(level < 1, dxu[0] / 5., 0.)
+        w = np.where(level < 2, dxu[1] / 25., 0.)
+        q = p + tick * (v * heading + 10 * projection_distance * w * normal)
+        h_next = np.sum((q[:, i] - q[:, j]) ** 2, axis=0) - r2
+        bad = (h_next < (1 - gamma) * h - 1e-9) & ((level[i] < 2) | (level[j] < 2))
+        if not np.any(bad):
+            break
+        level[i[bad]] = np.minimum(level[i[bad]] + 1, 2)
+        level[j[bad]] = np.minimum(level[j[bad]] + 1, 2)
+    dxu[0, level >= 1] = 0.
+    dxu[1, level >= 2] = 0.
+    return level
+
+
+def swap_scenario(N, seed=0):
+    """-> (x, goals) 3xN start poses and goal poses: the 4-robot swap of the
+    node, or N robots crossing a circle for other sizes"""
+    if N == 4:
+        return initial_conditions.copy(), goal_points.copy()
+    rng = np.random.RandomState(seed)
+    radius = max(1., 0.6 * N / math.pi)
+    angle = 2 * math.pi * (np.arange(N) + rng.uniform(-0.1, 0.1, N)) / N
+    x = np.vstack((radius * np.cos(angle), radius * np.sin(angle), angle + math.pi))
+    return x, np.vstack((-x[0], -x[1], x[2]))
+
+
+def simulate(step, x, goals, ticks=400, tick=0.05):
+    """Runs step closed loop on unicycles driven by the published command
+    (dxu / 50 m/s, dxu / 25 rad/s, as twist_command).
+
+    -> (solve times, final distances to the goals, smallest pair distance) in s and m
+    """
+    N = x.shape[1]
+    x = x.copy()
+    Omega = math.pi / 2 * np.ones(N)
+    uu = np.zeros((2 * N, 1))
+    dxu = np.zeros((2, N))
+    times = []
+    closest = np.inf
+    for _ in range(ticks):
+        t0 = time.perf_counter()
+        step(x, uu, Omega, goals, dxu)
+        times.append(time.perf_counter() - t0)
+        x[0] += tick * dxu[0] / 50 * np.cos(x[2])
+        x[1] += tick * dxu[0] / 50 * np.sin(x[2])
+        x[2] += tick * dxu[1] / 25
+        p = uni_to_si_states(x)
+        distance = np.linalg.norm(p[:, :, None] - p[:, None, :], axis=0)
+        closest = min(closest, distance[np.triu_indices(N, 1)].min())
+    return np.array(times), np.linalg.norm(uni_to_si_states(x) - goals[0:2], axis=0), closest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--robots', type=int, nargs='+', default=[4, 8], help='fleet sizes')
+    parser.add_argument('--ticks', type=int, default=400, help='ticks of 50 ms to simulate')
+    parser.add_argument('--horizon', type=int, default=10)
+    parser.add_argument('--stage-ticks', type=int, default=5, help='controller ticks per stage')
+    parser.add_argument('--margin', type=float, default=2., help='plan margin on safety_radius (QP units)')
+    args = parser.parse_args()
+    for N in args.robots:
+        x, goals = swap_scenario(N)
+        times, distance, closest = simulate(create_mpc_step(args.horizon, args.stage_ticks, margin=args.margin), x, goals, args.ticks)
+        print('N=%d: solve mean %.2f ms, p99 %.2f ms, max %.2f ms; final distance to goal max %.3f m; '
+              'closest pair %.3f m' % (N, 1e3 * times.mean(), 1e3 * np.percentile(times, 99), 1e3 * times.max(),
+                                       distance.max(), closest))
+
+
+if __name__ == '__main__':
+    main()
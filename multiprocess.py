@@ -1,13 +1,317 @@
+#!/usr/bin/env python3
+"""Starts the controllers on every robot of the fleet from the lab PC.
+
+Robots, their controller scripts and the remote environment come from a YAML
+config (fleet.yaml by default).  Each robot gets one multiplexed ssh master
+connection, all controllers are started concurrently over those connections,
+and the time from launch to the controller's first published command is
+reported per robot.  A controller that exits with an error is restarted, and
+its time to first command is measured again for every restart.
+
+With `telemetry` set, the controllers also stream per-tick records (see
+telemetry.py) over the ssh pipe or UDP.  They are written to one file per
+robot in `telemetry_dir` and summarised for the whole fleet every
+`summary_interval` seconds.
+
+    python3 multiprocess.py [fleet.yaml]
+"""
+
+import argparse
+import asyncio
+import math
 import os
-from multiprocessing import Pool
+import shlex
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+import yaml
+
+from telemetry import (RECORD, FIELDS, STATUS_FAILED, STATUS_NAMES, create_stream_demux, parse_datagram)
+
+# Logged once by the controllers right after their first publish
+FIRST_COMMAND = 'first command published'
+
+DEFAULTS = {
+    'environment': '',
+    'script': '/opt/ros/noetic/lib/teleop_twist_keyboard/teleop_twist_keyboardres.py',
+    'connect_timeout': 10,
+    'startup_timeout': 30,
+    'restart': True,
+    'restart_delay': 2.0,
+    'max_restarts': 5,
+    'telemetry': '',
+    'telemetry_dir': 'telemetry',
+    'summary_interval': 5.0,
+}
+
+
+def load_fleet(path):
+    """Reads the fleet config and fills in the per-robot defaults.
+
+    -> list of robot dicts (name, host, script, environment, timeouts, restart policy)
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f)
+
+    defaults = dict(DEFAULTS)
+    defaults.update((k, v) for k, v in config.items() if k != 'robots')
+    robots = []
+    for entry in config['robots']:
+        robot = dict(defaults)
+        robot.update(entry)
+        robot.setdefault('name', robot['host'].split('@')[-1])
+        robots.append(robot)
+    return robots
+
+
+class RobotProcess(object):
+    """Owns the ssh master connection and the controller process of one robot."""
+
+    def __init__(self, robot, control_dir):
+        self.robot = robot
+        self.name = robot['name']
+        self.control_path = os.path.join(control_dir, self.name)
+        self.master = None
+        self.controller = None
+        self.connect_time = None
+        self.first_command_time = None
+        self.launch_command_time = None
+        self.restart_command_time = None
+        self.launches = 0
+        self.returncode = None
+        self.telemetry_file = None
+        self.window = None
+        self.last_record = None
+        self.reset_window()
+
+    def ssh(self, *args, command=None):
+        """-> argv for an ssh call over the master connection (options in args)"""
+        argv = ['ssh', '-S', self.control_path, '-o', 'BatchMode=yes'] + list(args) + [self.robot['host']]
+        return argv if command is None else argv + [command]
+
+    def say(self, message):
+        print('[%s] %s' % (self.name, message), flush=True)
+
+    async def connect(self):
+        """Opens the ssh master connection that every later ssh call reuses."""
+        t0 = time.monotonic()
+        self.master = await asyncio.create_subprocess_exec(
+            'ssh', '-M', '-N', '-S', self.control_path, '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=%d' % self.robot['connect_timeout'],
+            '-o', 'ServerAliveInterval=5', self.robot['host'],
+            stdin=asyncio.subprocess.DEVNULL)
+
+        deadline = t0 + self.robot['connect_timeout']
+        while time.monotonic() < deadline:
+            if self.master.returncode is not None:
+                break
+            check = await asyncio.create_subprocess_exec(
+                *self.ssh('-O', 'check'), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            if await check.wait() == 0:
+                self.connect_time = time.monotonic() - t0
+                self.say('connected in %.2f s' % self.connect_time)
+                return True
+            await asyncio.sleep(0.1)
+        self.say('could not connect to %s' % self.robot['host'])
+        self.returncode = 255
+        return False
+
+    async def run(self):
+        """Runs the controller, restarting it after a crash.
+
+        -> exit code of the last run
+        """
+        command = '%s; exec python3 -u %s' % (self.robot['environment'], shlex.quote(self.robot['script']))
+        if self.robot['telemetry']:
+            command += ' _telemetry:=%s' % shlex.quote(self.robot['telemetry'])
+            os.makedirs(self.robot['telemetry_dir'], exist_ok=True)
+            self.telemetry_file = open(os.path.join(self.robot['telemetry_dir'], '%s.bin' % self.name), 'ab')
+        restarts = 0
+        while True:
+            self.launches += 1
+            self.launch_command_time = None
+            launched = time.monotonic()
+            self.controller = await asyncio.create_subprocess_exec(
+                *self.ssh(command=command), stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            watchdog = asyncio.ensure_future(self.watch_startup(launched))
+            try:
+                await self.pump_output(launched)
+                self.returncode = await self.controller.wait()
+            finally:
+                watchdog.cancel()
+
+            if self.returncode == 0:
+                self.say('controller exited')
+                return self.returncode
+            self.say('controller exited with code %d' % self.returncode)
+            if not self.robot['restart'] or restarts >= self.robot['max_restarts']:
+                return self.returncode
+            restarts += 1
+            await asyncio.sleep(self.robot['restart_delay'])
+            self.say('restarting controller (%d/%d)' % (restarts, self.robot['max_restarts']))
+
+    async def pump_output(self, launched):
+        """Forwards the controller output, splits off the telemetry records
+        and notes the first command."""
+        feed = create_stream_demux()
+        while True:
+            data = await self.controller.stdout.read(4096)
+            if not data:
+                return
+            lines, records = feed(data)
+            for text in lines:
+                text = text.rstrip()
+                if self.launch_command_time is None and FIRST_COMMAND in text:
+                    self.launch_command_time = time.monotonic() - launched
+                    if self.first_command_time is None:
+                        self.first_command_time = self.launch_command_time
+                    else:
+                        self.restart_command_time = self.launch_command_time
+                    self.say('first command after %.2f s (launch %d)' % (self.launch_command_time, self.launches))
+                self.say(text)
+            if records:
+                self.add_records(records)
+
+    def add_records(self, records):
+        if self.telemetry_file is not None:
+            self.telemetry_file.write(b''.join(RECORD.pack(*r) for r in records))
+        w = self.window
+        for r in records:
+            w['ticks'] += 1
+            w['solve_sum'] += r[4]
+            w['solve_max'] = max(w['solve_max'], r[4])
+            w['failed'] += r[3] == STATUS_FAILED
+        self.last_record = dict(zip(FIELDS, records[-1]))
+
+    def reset_window(self):
+        self.window = {'start': time.monotonic(), 'ticks': 0, 'solve_sum': 0., 'solve_max': 0., 'failed': 0}
+
+    async def watch_startup(self, launched):
+        await asyncio.sleep(self.robot['startup_timeout'])
+        if self.launch_command_time is None:
+            self.say('no command after %.0f s' % (time.monotonic() - launched))
+
+    async def close(self):
+        """Stops the controller on the robot and closes the master connection."""
+        if self.controller is not None and self.controller.returncode is None:
+            self.controller.terminate()
+            await self.controller.wait()
+        if self.master is not None and self.master.returncode is None:
+            # Killing the local ssh client does not stop the remote python
+            kill = await asyncio.create_subprocess_exec(
+                *self.ssh(command='pkill -INT -f %s' % shlex.quote(self.robot['script'])),
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await kill.wait()
+            stop = await asyncio.create_subprocess_exec(
+                *self.ssh('-O', 'exit'), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            await stop.wait()
+            if self.master.returncode is None:
+                self.master.terminate()
+            await self.master.wait()
+        if self.telemetry_file is not None:
+            self.telemetry_file.close()
+
+
+class TelemetryProtocol(asyncio.DatagramProtocol):
+    """Hands UDP telemetry datagrams to the robot they came from."""
+
+    def __init__(self, robots):
+        self.by_address = {}
+        for robot in robots:
+            try:
+                self.by_address[socket.gethostbyname(robot.robot['host'].split('@')[-1])] = robot
+            except socket.error:
+                robot.say('cannot resolve %s for UDP telemetry' % robot.robot['host'])
+
+    def datagram_received(self, data, addr):
+        robot = self.by_address.get(addr[0])
+        if robot is not None:
+            robot.add_records(parse_datagram(data))
+
+
+def print_summary(robots):
+    print('%-10s %10s %14s %14s %9s %6s' % ('robot', 'connect', 'first command', 'after restart', 'launches', 'exit'))
+    for r in robots:
+        print('%-10s %10s %14s %14s %9d %6s' % (
+            r.name,
+            '-' if r.connect_time is None else '%.2f s' % r.connect_time,
+            '-' if r.first_command_time is None else '%.2f s' % r.first_command_time,
+            '-' if r.restart_command_time is None else '%.2f s' % r.restart_command_time,
+            r.launches,
+            '-' if r.returncode is None else r.returncode))
+
+
+def print_fleet_summary(robots):
+    """Prints one line per robot from the telemetry received since the last call."""
+    print('%-10s %8s %10s %10s %7s %9s %9s %10s %9s %8s' % (
+        'robot', 'rate', 'mean solve', 'max solve', 'failed', 'v', 'w', 'risk', 'pose age', 'status'), flush=True)
+    for r in robots:
+        w = r.window
+        elapsed = max(time.monotonic() - w['start'], 1e-9)
+        last = r.last_record
+        print('%-10s %6.1f/s %7.2f ms %7.2f ms %7d %9s %9s %10s %9s %8s' % (
+            r.name, w['ticks'] / elapsed,
+            1e3 * w['solve_sum'] / max(w['ticks'], 1), 1e3 * w['solve_max'], w['failed'],
+            '-' if last is None else '%.4f' % last['v'],
+            '-' if last is None else '%.4f' % last['w'],
+            '-' if last is None else '%.1f' % last['risk'],
+            '-' if last is None or math.isnan(last['pose_age']) else '%.0f ms' % (1e3 * last['pose_age']),
+            '-' if last is None else STATUS_NAMES.get(last['status'], last['status'])), flush=True)
+        r.reset_window()
+
+
+async def summarise(robots, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print_fleet_summary(robots)
+
+
+async def launch(robots):
+    async def start(robot):
+        if await robot.connect():
+            return await robot.run()
+
+    tasks = []
+    transport = None
+    settings = robots[0].robot if robots else DEFAULTS
+    if settings['telemetry']:
+        tasks.append(asyncio.ensure_future(summarise(robots, settings['summary_interval'])))
+        if settings['telemetry'].startswith('udp://'):
+            port = int(settings['telemetry'].rsplit(':', 1)[1])
+            transport, _ = await asyncio.get_event_loop().create_datagram_endpoint(
+                lambda: TelemetryProtocol(robots), local_addr=('0.0.0.0', port))
+
+    try:
+        await asyncio.gather(*(start(robot) for robot in robots))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if transport is not None:
+            transport.close()
+        await asyncio.gather(*(robot.close() for robot in robots), return_exceptions=True)
+
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', nargs='?', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fleet.yaml'))
+    args = parser.parse_args()
 
-def task(param):
-    # os.system(f"echo {param}")
-    os.system(
-        f"ssh {param} 'export ROSBOT_VER=ROSBOT_2.0_PRO; export ROS_DISTRO=noetic; export ROS_MASTER_URI=http://master:11311; export ROS_IPV6=on; . /opt/ros/noetic/setup.bash; . ~/husarion_ws/devel/setup.sh; export SERIAL_PORT=/dev/ttyS4; source rosbot_ros/devel/setup.bash; python3 /opt/ros/noetic/lib/teleop_twist_keyboard/teleop_twist_keyboardres.py'")
+    # ssh limits the length of a control socket path, so keep it short
+    control_dir = tempfile.mkdtemp(prefix='fleet-')
+    robots = [RobotProcess(robot, control_dir) for robot in load_fleet(args.config)]
+    try:
+        asyncio.run(launch(robots))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print_summary(robots)
+        shutil.rmtree(control_dir, ignore_errors=True)
+    return 0 if all(r.returncode in (None, 0) for r in robots) else 1
 
 
-with Pool(8) as p:
-    p.map(task,
-          ["husarion@192.168.1.117", "husarion@192.168.1.137", "husarion@192.168.1.138", "husarion@192.168.1.188"])
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Merges the per-body mocap pose topics into one Path message per frame.
+
+With one subscriber per robot, every mocap frame fires N pose callbacks in
+each controller.  This relay subscribes once to the vrpn_client_node topics
+of the bodies in ~bodies (with tcp_nodelay) and publishes all their poses as
+one nav_msgs/Path on ~output (default /fleet_poses), in the order of
+~bodies.  Every pose of the Path is the PoseStamped of its body, with its own
+mocap stamp.  The controllers then take the whole fleet from one message
+(~pose_topic:=/fleet_poses).
+
+A frame is published once every body has reported since the last one, or as
+soon as a body reports twice, so a body that drops out of the tracking only
+holds the others back for one frame.  A body that did not report since the
+last frame gets a NaN pose with a zero stamp, which the controllers skip, so
+its pose keeps its own stamp and age there.  The header stamp is that of the
+newest pose in the frame.  Nothing is published before every body has been seen once.
+
+    rosrun teleop_twist_keyboard pose_relay.py _bodies:="[Hus117, Hus137, Hus138, Hus188]"
+"""
+
+from __future__ import print_function
+
+import math
+import threading
+
+import rospy
+from geometry_msgs.msg import PoseStamped
+from nav_msgs.msg import Path
+
+BODIES = ['Hus117', 'Hus137', 'Hus138', 'Hus188']
+
+
+def create_relay(bodies, publisher):
+    """Creates the pose callback of the relay.
+
+    bodies: body names, their order is the order of the published poses
+    publisher: rospy.Publisher of Path
+
+    -> function callback(data, i) for the PoseStamped of body i
+    """
+    message = Path()
+    message.header.frame_id = 'world'
+    message.poses = [PoseStamped() for _ in bodies]
+    missing = PoseStamped()
+    missing.header.frame_id = 'world'
+    missing.pose.position.x = missing.pose.position.y = missing.pose.position.z = math.nan
+    stamps = [None] * len(bodies)
+    started = [False]
+    lock = threading.Lock()
+
+    def publish():
+        message.header.stamp = max(stamp for stamp in stamps if stamp is not None)
+        for i, stamp in enumerate(stamps):
+            if stamp is None:
+                message.poses[i] = missing
+        publisher.publish(message)
+        for i in range(len(stamps)):
+            stamps[i] = None
+
+    def callback(data, i):
+        with lock:
+            if stamps[i] is not None and started[0]:
+                publish()
+            message.poses[i] = data
+            stamps[i] = data.header.stamp
+            if all(stamp is not None for stamp in stamps):
+                started[0] = True
+                publish()
+
+    return callback
+
+
+def main():
+    rospy.init_node('pose_relay')
+    bodies = rospy.get_param('~bodies', BODIES)
+    publisher = rospy.Publisher(rospy.get_param('~output', '/fleet_poses'), Path, queue_size=1, tcp_nodelay=True)
+    callback = create_relay(bodies, publisher)
+    for i, body in enumerate(bodies):
+        rospy.Subscriber('/vrpn_client_node/%s/pose' % body, PoseStamped, callback, i, queue_size=1, tcp_nodelay=True)
+    rospy.spin()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except rospy.ROSInterruptException:
+        pass
@@ -0,0 +1,135 @@
+"""Timestamped pose buffers for the controller nodes.
+
+The pose callbacks used to overwrite x in place and drop data.header.stamp,
+so every tick treated poses of varying age (mocap, VRPN, network and the
+phase of the tick timer) as current.  create_pose_store keeps the last few
+stamped poses of every robot in fixed-size ring buffers; at tick time
+predict extrapolates each robot's latest pose to the time its command will
+be applied, with the velocity estimated over the buffer, and ages reports
+how old each robot's latest pose is.
+
+create_velocity_estimator runs an alpha-beta filter over the latest poses
+of the whole fleet once per tick and writes the velocities into the uu
+array the risk terms of the controller read.
+"""
+
+from __future__ import print_function
+
+import math
+
+import numpy as np
+
+
+def create_pose_store(N, depth=4, max_extrapolation=0.25):
+    """Creates per-robot ring buffers of stamped poses.
+
+    N: number of robots
+    depth: poses kept per robot; the velocity is the finite difference
+           between the oldest and the newest of them
+    max_extrapolation: poses are never extrapolated further than this (s),
+                       so a robot whose poses stop arriving is not driven
+                       away on a stale velocity
+
+    -> (function, function, function, function) store(i, stamp, px, py, theta),
+       predict(t, out=None) -> 3xN poses at time t (robots without a pose
+       keep their column of out), ages(t) -> N array of the age (s) of
+       every robot's latest pose, inf before the first one, and latest() ->
+       (N array of stamps, 3xN poses) of the latest poses, stamp 0 before
+       the first one
+    """
+    stamps = np.zeros((N, depth))
+    poses = np.zeros((N, depth, 3))
+    head = np.zeros(N, dtype=int)
+    count = np.zeros(N, dtype=int)
+    robots = np.arange(N)
+
+    def store(i, stamp, px, py, theta):
+        """Appends one pose of robot i (called from the pose callbacks), or
+        one pose of each robot in the int array i, with array arguments."""
+        k = np.where(count[i] > 0, (head[i] + 1) % depth, 0)
+        poses[i, k, 0] = px
+        poses[i, k, 1] = py
+        poses[i, k, 2] = theta
+        stamps[i, k] = stamp
+        # The tick only reads the slot head points to, so move it last
+        head[i] = k
+        count[i] = np.minimum(count[i] + 1, depth)
+
+    def predict(t, out=None):
+        """-> 3xN poses of all robots extrapolated to time t (s)"""
+        if out is None:
+            out = np.zeros((3, N))
+        newest = head.copy()
+        oldest = (newest - np.maximum(count, 1) + 1) % depth
+        latest = poses[robots, newest]
+        span = stamps[robots, newest] - stamps[robots, oldest]
+        delta = latest - poses[robots, oldest]
+        delta[:, 2] = (delta[:, 2] + math.pi) % (2 * math.pi) - math.pi
+        moving = span > 0
+        velocity = np.zeros((N, 3))
+        velocity[moving] = delta[moving] / span[moving, None]
+        ahead = np.clip(t - stamps[robots, newest], 0., max_extrapolation)
+        have = count > 0
+        out[:, have] = (latest + velocity * ahead[:, None]).T[:, have]
+        out[2, have] = (out[2, have] + math.pi) % (2 * math.pi) - math.pi
+        return out
+
+    def ages(t):
+        """-> N array of t minus the stamp of every robot's latest pose"""
+        age = t - stamps[robots, head]
+        age[count == 0] = np.inf
+        return age
+
+    def latest():
+        """-> (N stamps, 3xN poses) copies of every robot's latest pose"""
+        newest = head.copy()
+        return stamps[robots, newest], poses[robots, newest].T
+
+    return store, predict, ages, latest
+
+
+def yaw(qx, qy, qz, qw):
+    """-> yaw angle(s) of quaternion(s), arrays of any shape"""
+    return np.arctan2(2 * (qw * qz + qx * qy), 1 - 2 * (qy * qy + qz * qz))
+
+
+def create_velocity_estimator(N, alpha=0.5, beta=0.15, max_gap=0.5):
+    """Creates an alpha-beta filter of the velocities of N points.
+
+    Every call updates the robots whose stamp is newer than the one of their
+    last update, all in one vectorized pass; the others keep their estimate.
+    A robot seen for the first time, or after a gap of more than max_gap
+    seconds, restarts at its measured position with zero velocity.
+
+    alpha, beta: position and velocity gains of the filter
+    max_gap: longest interval between two poses that is filtered across (s)
+
+    -> function update(stamps, points, uu=None) -> uu, stamps the N pose
+       stamps (0 for no pose yet), points the 2xN measured positions and uu
+       the 2Nx1 array (stacked x, y velocities per robot) filled in place
+    """
+    position = np.zeros((2, N))
+    velocity = np.zeros((2, N))
+    last = np.zeros(N)
+
+    def update(stamps, points, uu=None):
+        if uu is None:
+            uu = np.zeros((2 * N, 1))
+        fresh = stamps > last
+        dt = stamps - last
+        restart = fresh & ((last <= 0) | (dt > max_gap))
+        track = fresh & ~restart
+        if np.any(track):
+            dt = dt[track]
+            predicted = position[:, track] + velocity[:, track] * dt
+            residual = points[:, track] - predicted
+            position[:, track] = predicted + alpha * residual
+            velocity[:, track] += beta / dt * residual
+        position[:, restart] = points[:, restart]
+        velocity[:, restart] = 0.
+        last[fresh] = stamps[fresh]
+        uu[0::2, 0] = velocity[0]
+        uu[1::2, 0] = velocity[1]
+        return uu
+
+    return update
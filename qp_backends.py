@@ -0,0 +1,815 @@
+"""QP solving helpers shared by the controllers.
+
+Every solver is wrapped as a backend with the same call,
+
+    solve(backend, H, f, A, b, lb=None, ub=None, initvals=None, stats=None, **settings)
+
+for min 1/2 x'Hx + f'x  s.t.  Ax <= b, lb <= x <= ub, returning x or None.
+Registered backends are 'osqp', 'cvxopt' and 'quadprog' (when installed) and
+'active_set', a dense NumPy dual active-set method (Goldfarb-Idnani) meant for
+the small QPs of the controllers.  select_backend times the backends on a set
+of sample problems and picks the fastest one that solves them accurately.
+
+The deadlock QPs are badly scaled: positions are multiplied by 10, the
+barrier rows carry h_x with safety_radius = 4.0 and the risk terms an offset
+of 6000, so row and column magnitudes differ by orders of magnitude.
+solve_osqp can equilibrate the problem (Ruiz scaling of rows and columns,
+scale=True, only where deadlock_controller.qp_scaling asks for it) before
+handing it to OSQP, unscales the result and reports what the solver did
+(iterations, residuals, status).  OSQP then does not scale the problem
+again, and its tolerances are tightened so that they still hold for the
+residuals of the unscaled problem.
+"""
+
+import time
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+import osqp
+
+try:
+    from cvxopt import matrix as cvxopt_matrix
+    from cvxopt import solvers as cvxopt_solvers
+except ImportError:
+    cvxopt_solvers = None
+
+try:
+    import quadprog
+except ImportError:
+    quadprog = None
+
+
+def equilibrate(H, f, A, lb, ub, iterations=5):
+    """Ruiz equilibration of min 1/2 x'Hx + f'x  s.t.  Ax <= b, lb <= x <= ub.
+
+    Finds diagonal D (columns), E (rows) and a cost scale c so that the
+    scaled problem in x = D xs, c (D H D), c D f, E A D has rows and columns of
+    roughly unit infinity norm.  Scale b with E and the bounds with 1/D.
+
+    H: nxn numpy array
+    f: n numpy array
+    A: mxn numpy array
+    lb, ub: n numpy arrays or None
+
+    -> (Hs, fs, As, lbs, ubs, D, E, c)
+    """
+    n = H.shape[0]
+    D = np.ones(n)
+    E = np.ones(A.shape[0])
+    Hs = H.copy()
+    As = A.copy()
+    for _ in range(iterations):
+        col = np.maximum(np.abs(Hs).max(axis=0), np.abs(As).max(axis=0) if As.size else 0.)
+        row = np.abs(As).max(axis=1) if As.size else np.zeros(0)
+        d = 1. / np.sqrt(np.where(col > 1e-12, col, 1.))
+        e = 1. / np.sqrt(np.where(row > 1e-12, row, 1.))
+        Hs = d[:, None] * Hs * d[None, :]
+        As = e[:, None] * As * d[None, :]
+        D *= d
+        E *= e
+    fs = D * f
+    c = 1. / max(np.abs(Hs).max(axis=0).mean(), np.abs(fs).max(), 1e-12)
+    lbs = None if lb is None else lb / D
+    ubs = None if ub is None else ub / D
+    return c * Hs, c * fs, As, lbs, ubs, D, E, c
+
+
+def equilibrated_osqp_problem(H, f, A, b, lb, ub, initvals, settings):
+    """Equilibrates a QP for OSQP (see equilibrate).
+
+    OSQP checks the residuals of the problem it is given: E (Ax - b) for the
+    rows, (x - lb) / D for the bounds and c D (Hx + f + A'y) for the
+    optimality conditions.  eps_abs and eps_rel in settings are multiplied by
+    the smallest of those factors, so the residuals of the unscaled problem
+    meet the requested tolerances, and OSQP's own scaling is turned off.
+
+    settings: dict of OSQP settings, updated in place
+
+    -> (H, f, A, b, lb, ub, initvals, D) of the scaled problem, x = D xs
+    """
+    H, f, A, lb, ub, D, E, c = equilibrate(H, f, A, lb, ub)
+    tighten = min(E.min() if E.size else 1., (1. / D).min(), (c * D).min(), 1.)
+    settings['eps_abs'] = settings.get('eps_abs', 1e-3) * tighten
+    settings['eps_rel'] = settings.get('eps_rel', 1e-3) * tighten
+    settings['scaling'] = 0
+    return H, f, A, E * b, lb, ub, None if initvals is None else initvals / D, D
+
+
+def solve_osqp(H, f, A, b, lb=None, ub=None, initvals=None, scale=False, stats=None, **settings):
+    """Solves min 1/2 x'Hx + f'x  s.t.  Ax <= b, lb <= x <= ub with OSQP.
+
+    H, A: numpy arrays or scipy sparse matrices
+    f, b, lb, ub, initvals: numpy arrays (lb/ub/initvals may be None)
+    scale: equilibrate the problem first (see equilibrated_osqp_problem) and
+           unscale the result
+    stats: optional dict, receives 'status', 'iter', 'pri_res', 'dua_res',
+           'solve_time' and 'setup_time' (residuals are those of the problem
+           OSQP actually solved, i.e. scaled when scale is True)
+    settings: forwarded to OSQP (max_iter, eps_abs, eps_prim_inf, verbose, ...)
+
+    -> numpy array x, or None if OSQP did not report the problem solved
+    """
+    H = np.asarray(H.toarray() if sparse.issparse(H) else H, dtype=float)
+    A = np.asarray(A.toarray() if sparse.issparse(A) else A, dtype=float)
+    f = np.reshape(np.asarray(f, dtype=float), -1)
+    b = np.reshape(np.asarray(b, dtype=float), -1)
+    n = H.shape[0]
+
+    if scale:
+        H, f, A, b, lb, ub, initvals, D = equilibrated_osqp_problem(H, f, A, b, lb, ub, initvals, settings)
+    else:
+        D = None
+
+    l = np.full(b.shape, -np.inf)
+    u = b
+    if lb is not None or ub is not None:
+        lb = lb if lb is not None else np.full(n, -np.inf)
+        ub = ub if ub is not None else np.full(n, np.inf)
+        A = np.vstack([A, np.eye(n)])
+        l = np.hstack([l, lb])
+        u = np.hstack([u, ub])
+
+    settings.setdefault('verbose', False)
+    solver = osqp.OSQP()
+    solver.setup(P=sparse.csc_matrix(H), q=f, A=sparse.csc_matrix(A), l=l, u=u, **settings)
+    if initvals is not None:
+        solver.warm_start(x=initvals)
+    res = solver.solve()
+
+    _report_osqp(stats, res)
+    if res.info.status != 'solved':
+        return None
+    return res.x if D is None else D * res.x
+
+
+def _report_osqp(stats, res):
+    if stats is not None:
+        stats['status'] = res.info.status
+        stats['iter'] = res.info.iter
+        # osqp >= 1.0 renamed pri_res/dua_res
+        stats['pri_res'] = getattr(res.info, 'prim_res', getattr(res.info, 'pri_res', None))
+        stats['dua_res'] = getattr(res.info, 'dual_res', getattr(res.info, 'dua_res', None))
+        stats['solve_time'] = res.info.solve_time
+        stats['setup_time'] = res.info.setup_time
+
+
+def create_osqp_workspace(n, m):
+    """Creates an OSQP solver that is set up once and reused for every QP
+    with n variables and at most m rows.
+
+    The constraints [A; I] (the rows, then the bounds) are kept as one dense
+    CSC pattern of m + n rows, A padded with zero rows whose upper bound is
+    infinite, so a solve writes the new values into preallocated buffers and
+    refreshes the solver with update(Px=..., q=..., Ax=..., l=..., u=...)
+    instead of setting up a new one.  Every solve starts like a fresh setup:
+    rho is reset when the last solve adapted it and the warm start zeroes the
+    duals, so the result is that of solve_osqp with bounds.  Scaled and
+    unscaled problems get a solver each, OSQP's own scaling is fixed at setup.
+
+    -> function solve(H, f, A, b, lb=None, ub=None, initvals=None, scale=False,
+       stats=None, **settings) taking the arguments of solve_osqp
+    """
+    # Upper triangle of P and the columns of [A; I], column by column
+    p_rows = np.concatenate([np.arange(j + 1) for j in range(n)])
+    p_cols = np.concatenate([np.full(j + 1, j) for j in range(n)])
+    p_indptr = np.concatenate(([0], np.cumsum(np.arange(1, n + 1))))
+    a_indices = np.ravel(np.column_stack((np.tile(np.arange(m), (n, 1)), m + np.arange(n))))
+    a_indptr = np.arange(0, n * (m + 1) + 1, m + 1)
+    Px = np.zeros(len(p_rows))
+    Ax = np.zeros((n, m + 1))
+    Ax[:, m] = 1.
+    q = np.zeros(n)
+    l = np.full(m + n, -np.inf)
+    u = np.full(m + n, np.inf)
+    x0 = np.zeros(n)
+    y0 = np.zeros(m + n)
+    solvers = {}
+
+    def setup(scale):
+        # Placeholder values, a solve overwrites them before OSQP uses them
+        P = sparse.csc_matrix(((p_rows == p_cols).astype(float), p_rows, p_indptr), shape=(n, n))
+        A = sparse.csc_matrix((np.ravel(Ax), a_indices, a_indptr), shape=(m + n, n))
+        solver = osqp.OSQP()
+        solver.setup(P=P, q=q, A=A, l=l, u=u, verbose=False, **({'scaling': 0} if scale else {}))
+        state = solvers[scale] = {'solver': solver, 'rho': solver.settings.rho, 'rho_changed': False,
+                                  'defaults': {}, 'applied': {}, 'l': l.copy()}
+        return state
+
+    def apply_settings(state, settings):
+        # Settings of an earlier call that this one leaves out go back to OSQP's defaults
+        solver = state['solver']
+        defaults = state['defaults']
+        applied = state['applied']
+        changes = {}
+        for key in set(settings) | set(applied):
+            if key not in defaults:
+                defaults[key] = getattr(solver.settings, key)
+            value = settings.get(key, defaults[key])
+            if applied.get(key, defaults[key]) != value:
+                changes[key] = value
+        if changes:
+            solver.update_settings(**changes)
+            applied.update(changes)
+
+    def solve(H, f, A, b, lb=None, ub=None, initvals=None, scale=False, stats=None, **settings):
+        H = np.asarray(H.toarray() if sparse.issparse(H) else H, dtype=float)
+        A = np.asarray(A.toarray() if sparse.issparse(A) else A, dtype=float)
+        f = np.reshape(np.asarray(f, dtype=float), -1)
+        b = np.reshape(np.asarray(b, dtype=float), -1)
+        rows = A.shape[0]
+        assert H.shape == (n, n) and A.shape[1] == n and rows <= m, \
+            "The OSQP workspace holds QPs of %d variables and up to %d rows. Recieved %r and %r." % (n, m, H.shape, A.shape)
+        settings.setdefault('verbose', False)
+        if scale:
+            H, f, A, b, lb, ub, initvals, D = equilibrated_osqp_problem(H, f, A, b, lb, ub, initvals, settings)
+            del settings['scaling']
+        else:
+            D = None
+
+        Px[:] = H[p_rows, p_cols]
+        q[:] = f
+        Ax[:, :rows] = A.T
+        Ax[:, rows:m] = 0.
+        u[:rows] = b
+        u[rows:m] = np.inf
+        l[m:] = -np.inf if lb is None else lb
+        u[m:] = np.inf if ub is None else ub
+
+        state = solvers.get(scale)
+        if state is None:
+            state = setup(scale)
+        solver = state['solver']
+        apply_settings(state, settings)
+        # The lower bounds rarely change, and osqp looks up its infinity on each of l and u
+        if np.array_equal(l, state['l']):
+            solver.update(Px=Px, q=q, Ax=np.ravel(Ax), u=u)
+        else:
+            solver.update(Px=Px, q=q, Ax=np.ravel(Ax), l=l, u=u)
+            state['l'][:] = l
+        if state['rho_changed']:
+            solver.update_settings(rho=state['rho'])
+        solver.warm_start(x=x0 if initvals is None else initvals, y=y0)
+        res = solver.solve()
+        state['rho_changed'] = res.info.rho_updates > 0
+
+        _report_osqp(stats, res)
+        if res.info.status != 'solved':
+            return None
+        return res.x if D is None else D * res.x
+
+    return solve
+
+
+def solve_relaxed(H, f, A, b, relax, slack_weight=1e4, lb=None, ub=None, initvals=None, stats=None,
+                  backend='osqp', **settings):
+    """Solves the QP of solve with the rows in relax softened by slacks.
+
+    Every relaxed row i becomes A_i x - s_i <= b_i with s_i >= 0, and
+    slack_weight/2 * s_i**2 is added to the cost, so the problem stays
+    feasible as long as the remaining rows are.
+
+    relax: indices of the rows of A that may be violated
+    stats: as in solve, plus 'slack' (largest slack in the solution)
+
+    -> numpy array x (without the slacks), or None if the backend found no solution
+    """
+    H = np.asarray(H.toarray() if sparse.issparse(H) else H, dtype=float)
+    A = np.asarray(A.toarray() if sparse.issparse(A) else A, dtype=float)
+    n = H.shape[0]
+    k = len(relax)
+
+    Hr = np.zeros((n + k, n + k))
+    Hr[:n, :n] = H
+    Hr[n:, n:] = slack_weight * np.eye(k)
+    fr = np.hstack([np.reshape(f, -1), np.zeros(k)])
+    Ar = np.hstack([A, np.zeros((A.shape[0], k))])
+    Ar[relax, n + np.arange(k)] = -1.
+    lbr = np.hstack([lb if lb is not None else np.full(n, -np.inf), np.zeros(k)])
+    ubr = np.hstack([ub if ub is not None else np.full(n, np.inf), np.full(k, np.inf)])
+    initr = None if initvals is None else np.hstack([initvals, np.zeros(k)])
+
+    x = solve(backend, Hr, fr, Ar, b, lbr, ubr, initr, stats=stats, **settings)
+    if x is None:
+        return None
+    if stats is not None:
+        stats['slack'] = x[n:].max() if k else 0.
+    return x[:n]
+
+
+def dense_problem(H, f, A, b, lb=None, ub=None):
+    """Folds the finite bounds into the inequality rows.
+
+    -> (H, f, A, b) numpy arrays of min 1/2 x'Hx + f'x  s.t.  Ax <= b
+    """
+    H = np.asarray(H.toarray() if sparse.issparse(H) else H, dtype=float)
+    A = np.asarray(A.toarray() if sparse.issparse(A) else A, dtype=float)
+    f = np.reshape(np.asarray(f, dtype=float), -1)
+    b = np.reshape(np.asarray(b, dtype=float), -1)
+    n = H.shape[0]
+    A = np.reshape(A, (-1, n))
+    rows = [A]
+    rhs = [b]
+    for bound, sign in ((ub, 1.), (lb, -1.)):
+        if bound is None:
+            continue
+        bound = np.asarray(bound, dtype=float)
+        finite = np.isfinite(bound)
+        rows.append(sign * np.eye(n)[finite])
+        rhs.append(sign * bound[finite])
+    return H, f, np.vstack(rows), np.hstack(rhs)
+
+
+def vanishing_rows(A, tol):
+    """-> numpy bool array, the rows of a dense problem whose coefficients
+    all vanish next to the largest row norm (within tol relative to it)"""
+    if not A.shape[0]:
+        return np.zeros(0, dtype=bool)
+    return np.abs(A).max(axis=1) <= tol * np.sqrt(np.sum(A * A, axis=1)).max()
+
+
+def feasibility_tolerance(A, b, tol):
+    """-> numpy array, tol relative to the scale of each row of a dense
+    problem, the largest of 1, |b_i| and the norm of A_i.  Vanishing rows
+    have lost their own scale and get the largest tolerance of the problem."""
+    if not b.size:
+        return np.zeros(0)
+    rows = tol * np.maximum(1., np.maximum(np.abs(b), np.sqrt(np.sum(A * A, axis=1))))
+    rows[vanishing_rows(A, tol)] = rows.max()
+    return rows
+
+
+def drop_vanishing_rows(A, b, tol):
+    """Removes the rows of a dense problem whose coefficients all vanish.
+
+    The CBF2 rows of the deadlock QP can underflow to 0 <= b_i with b_i a
+    rounding error below zero.  Such a row holds unless b_i is below minus
+    its feasibility_tolerance (tol relative); the exact solvers would
+    otherwise call the problem infeasible.
+
+    -> (A, b, kept) without those rows, kept the indices of the remaining rows
+       (None if no row was dropped), or None if a vanishing row does not hold
+    """
+    vanishing = vanishing_rows(A, tol)
+    if not np.any(vanishing):
+        return A, b, None
+    if np.any(b[vanishing] < -feasibility_tolerance(A, b, tol)[vanishing]):
+        return None
+    kept = np.flatnonzero(~vanishing)
+    return A[kept], b[kept], kept
+
+
+def _report(stats, status, iterations, x, A, b, start):
+    if stats is not None:
+        stats['status'] = status
+        stats['iter'] = iterations
+        stats['pri_res'] = max(np.max(A @ x - b), 0.) if x is not None and b.size else 0.
+        stats['dua_res'] = 0.
+        stats['solve_time'] = time.perf_counter() - start
+        stats['setup_time'] = 0.
+
+
+def solve_cvxopt(H, f, A, b, lb=None, ub=None, initvals=None, stats=None, **settings):
+    """Solves the QP with cvxopt.solvers.qp.
+
+    settings: cvxopt solver options (reltol, feastol, maxiters, ...); the
+              global cvxopt.solvers.options are used for the others
+
+    -> numpy array x, or None if cvxopt did not report the problem optimal
+    """
+    start = time.perf_counter()
+    H, f, A, b = dense_problem(H, f, A, b, lb, ub)
+    options = dict(cvxopt_solvers.options)
+    options.setdefault('show_progress', False)
+    options.update(settings)
+    try:
+        res = cvxopt_solvers.qp(cvxopt_matrix(H), cvxopt_matrix(f), cvxopt_matrix(A), cvxopt_matrix(b),
+                                initvals=None if initvals is None else cvxopt_matrix(np.asarray(initvals, dtype=float)),
+                                options=options)
+    except (ArithmeticError, ValueError) as e:
+        # cvxopt raises on singular KKT systems instead of returning a status
+        _report(stats, str(e), 0, None, A, b, start)
+        return None
+    x = np.array(res['x']).reshape(-1) if res['status'] == 'optimal' else None
+    _report(stats, 'solved' if x is not None else res['status'], res['iterations'], x, A, b, start)
+    return x
+
+
+def solve_quadprog(H, f, A, b, lb=None, ub=None, initvals=None, stats=None, tol=1e-7, **settings):
+    """Solves the QP with quadprog (Goldfarb-Idnani, H must be positive definite).
+
+    tol: rows whose coefficients all vanish (within tol relative to the
+         largest row norm, see vanishing_rows) are dropped when they hold
+         within their feasibility_tolerance (see drop_vanishing_rows)
+    stats: as in solve, plus 'active' (rows of dense_problem active at the solution)
+
+    -> numpy array x, or None if the constraints are inconsistent
+    """
+    start = time.perf_counter()
+    H, f, A, b = dense_problem(H, f, A, b, lb, ub)
+    reduced = drop_vanishing_rows(A, b, tol)
+    if reduced is None:
+        _report(stats, 'primal_infeasible', 0, None, A, b, start)
+        return None
+    Ar, br, kept = reduced
+    try:
+        x, _, _, iterations, _, active = quadprog.solve_qp(H, -f, -Ar.T, -br, 0)
+    except ValueError as e:
+        _report(stats, str(e), 0, None, A, b, start)
+        return None
+    _report(stats, 'solved', int(iterations[0]), x, A, b, start)
+    if stats is not None:
+        # 1-based, unused entries are 0
+        active = [int(i) - 1 for i in active if i > 0]
+        stats['active'] = active if kept is None else [int(kept[i]) for i in active]
+    return x
+
+
+def solve_active_set(H, f, A, b, lb=None, ub=None, initvals=None, stats=None, max_iter=100, tol=1e-7, **settings):
+    """Solves the QP with a dense dual active-set method (Goldfarb-Idnani).
+
+    Starts from the unconstrained minimum and adds the most violated row
+    until every row holds, so it needs no feasible start and detects
+    infeasibility exactly.  Meant for a handful of variables and rows; H must
+    be positive definite.
+
+    max_iter: maximum number of active-set changes
+    tol: primal feasibility tolerance, relative to |b_i| and the norm of
+         each row (see feasibility_tolerance); vanishing rows within it are
+         dropped (see drop_vanishing_rows)
+    stats: as in solve, plus 'active' (rows of dense_problem active at the solution)
+
+    -> numpy array x, or None if the problem is infeasible or max_iter is hit
+    """
+    start = time.perf_counter()
+    H, f, A, b = dense_problem(H, f, A, b, lb, ub)
+    reduced = drop_vanishing_rows(A, b, tol)
+    tol = feasibility_tolerance(A, b, tol)
+    if reduced is None:
+        _report(stats, 'primal_infeasible', 0, None, A, b, start)
+        return None
+    A_all, b_all = A, b
+    A, b, kept = reduced
+    if kept is not None:
+        tol = tol[kept]
+    Hinv = np.linalg.inv(H)
+    x = -Hinv @ f
+    active = []
+    lam = np.zeros(0)
+    iterations = 0
+
+    while iterations < max_iter:
+        # The row violated most relative to its tolerance
+        violation = (A @ x - b) / tol
+        p = int(np.argmax(violation)) if b.size else 0
+        if not b.size or violation[p] <= 1:
+            _report(stats, 'solved', iterations, x, A_all, b_all, start)
+            if stats is not None:
+                stats['active'] = list(active) if kept is None else [int(kept[i]) for i in active]
+            return x
+
+        # Add row p, dropping active rows whose multiplier would turn negative
+        lam_p = 0.
+        while True:
+            iterations += 1
+            n_p = A[p]
+            if active:
+                N = A[active].T
+                HN = Hinv @ N
+                r = np.linalg.solve(N.T @ HN, HN.T @ n_p)
+                z = Hinv @ n_p - HN @ r
+            else:
+                r = np.zeros(0)
+                z = Hinv @ n_p
+            zn = z @ n_p
+            step_primal = (n_p @ x - b[p]) / zn if zn > 1e-14 else np.inf
+            blocking = np.flatnonzero(r > 1e-14)
+            if blocking.size:
+                ratios = lam[blocking] / r[blocking]
+                k = blocking[np.argmin(ratios)]
+                step_dual = ratios.min()
+            else:
+                step_dual = np.inf
+            if np.isinf(step_primal) and np.isinf(step_dual):
+                _report(stats, 'primal_infeasible', iterations, None, A_all, b_all, start)
+                return None
+
+            step = min(step_primal, step_dual)
+            x = x - step * z
+            lam = lam - step * r
+            lam_p += step
+            if step_primal <= step_dual:
+                active.append(p)
+                lam = np.append(lam, lam_p)
+                break
+            del active[k]
+            lam = np.delete(lam, k)
+            if iterations >= max_iter:
+                break
+
+    _report(stats, 'max_iter_reached', iterations, None, A_all, b_all, start)
+    return None
+
+
+def solve_kkt(H, f, A, b, active, tol=1e-9):
+    """Solves a dense QP (see dense_problem) assuming the rows in active are
+    the active set, i.e. min 1/2 x'Hx + f'x  s.t.  A[active] x = b[active].
+
+    The result is only returned if it is the QP's solution: the multipliers
+    are non-negative and the other rows hold (within tol relative to the
+    largest |b|).
+
+    -> numpy array x or None
+    """
+    n = H.shape[0]
+    k = len(active)
+    if k:
+        kkt = np.zeros((n + k, n + k))
+        kkt[:n, :n] = H
+        kkt[:n, n:] = A[active].T
+        kkt[n:, :n] = A[active]
+        try:
+            solution = np.linalg.solve(kkt, np.hstack([-f, b[active]]))
+        except np.linalg.LinAlgError:
+            return None
+    else:
+        solution = np.linalg.solve(H, -f)
+    x = solution[:n]
+    scale = max(1., np.abs(b).max()) if b.size else 1.
+    if k and solution[n:].min() < -tol * scale:
+        return None
+    if b.size and np.max(A @ x - b) > tol * scale:
+        return None
+    return x
+
+
+def create_fast_path(candidates=((),), tol=1e-9):
+    """Creates a check that solves QPs whose constraints are (mostly) inactive
+    without calling a solver.
+
+    In open space none of the barrier rows of the controller QPs is active,
+    so the solution is the unconstrained optimum (or, for a CLF-CBF QP, the
+    optimum with only the CLF row active).  Each candidate active set is
+    tried with solve_kkt, which evaluates all rows at once.
+
+    candidates: active sets to try in order, as row indices of A (negative
+                indices count from the last row of A, bounds are not rows)
+
+    -> (function, function) try_solve(H, f, A, b, lb, ub, stats) -> x or None
+       (no candidate was the solution) and stats() -> dict of hits and misses
+    """
+    counters = {'hits': 0, 'misses': 0}
+
+    def try_solve(H, f, A, b, lb=None, ub=None, stats=None):
+        """stats: as in solve, plus 'fast_path' (True when no solver was needed)"""
+        start = time.perf_counter()
+        rows = np.shape(A)[0]
+        Hd, fd, Ad, bd = dense_problem(H, f, A, b, lb, ub)
+        for active in candidates:
+            x = solve_kkt(Hd, fd, Ad, bd, [i % rows for i in active], tol)
+            if x is not None:
+                counters['hits'] += 1
+                _report(stats, 'solved', 0, x, Ad, bd, start)
+                if stats is not None:
+                    stats['fast_path'] = True
+                return x
+        counters['misses'] += 1
+        if stats is not None:
+            stats['fast_path'] = False
+        return None
+
+    def fast_path_stats():
+        """-> dict with the hits and misses counts"""
+        return dict(counters)
+
+    return try_solve, fast_path_stats
+
+
+def create_active_set_cache(tol=1e-9):
+    """Creates a solver that first retries the active set of the previous solve.
+
+    Between ticks the rows active at the solution of a controller QP rarely
+    change.  For every key (e.g. the robot index) the active set of the last
+    solution is kept; the next QP with the same number of rows is first
+    solved as the equality-constrained KKT system of those rows, which is
+    accepted if its multipliers are non-negative and it satisfies the other
+    rows.  Otherwise the problem is solved in full with the given backend and
+    its active set is remembered.
+
+    tol: feasibility tolerance of the guess (relative to the largest |b|)
+
+    -> (function, function) solve_cached(key, backend, H, f, A, b, lb, ub, initvals, stats, **settings)
+       taking the arguments of solve after a cache key, and stats() -> dict of
+       hits and misses
+    """
+    cache = {}
+    counters = {'hits': 0, 'misses': 0}
+
+    def solve_cached(key, backend, H, f, A, b, lb=None, ub=None, initvals=None, stats=None, **settings):
+        """Solves the QP like solve, reusing the active set cached under key.
+
+        stats: as in solve, plus 'cached' (the cached active set was optimal)
+        """
+        start = time.perf_counter()
+        Hd, fd, Ad, bd = dense_problem(H, f, A, b, lb, ub)
+        m = Ad.shape[0]
+        guess = cache.get(key)
+        if guess is not None and guess[0] == m:
+            x = solve_kkt(Hd, fd, Ad, bd, guess[1], tol)
+            if x is not None:
+                counters['hits'] += 1
+                _report(stats, 'solved', 0, x, Ad, bd, start)
+                if stats is not None:
+                    stats['cached'] = True
+                return x
+
+        counters['misses'] += 1
+        if stats is None:
+            stats = {}
+        stats.pop('active', None)
+        x = solve(backend, H, f, A, b, lb=lb, ub=ub, initvals=initvals, stats=stats, **settings)
+        stats['cached'] = False
+        if x is None:
+            cache.pop(key, None)
+            return None
+        if 'active' in stats:
+            active = stats['active']
+        else:
+            # Backends that do not report it: rows tight at the solution
+            active = list(np.flatnonzero(Ad @ x - bd >= -1e-7 * max(1., np.abs(bd).max())))[:Hd.shape[0]]
+        cache[key] = (m, list(active))
+        return x
+
+    def cache_stats():
+        """-> dict with the hits and misses counts"""
+        return dict(counters)
+
+    return solve_cached, cache_stats
+
+
+def create_solution_memo(size=256, quantum=0.05, risk_quantum=1.0):
+    """Creates a bounded LRU memo of certificate solutions keyed on a
+    quantized snapshot of the inputs.
+
+    Robots parked at their goals or sitting in the same symmetric
+    configuration produce the same QP tick after tick.  A cached solution is
+    only handed out after the caller's check (re-evaluating the barrier
+    rows of the current QP) accepts it, so quantization can cost optimality
+    but never safety.
+
+    size: maximum number of cached solutions, least recently used go first
+    quantum: grid of the states (positions, goal, omega) in the key
+    risk_quantum: grid of the risk values in the key
+
+    -> (function, function, function, function) key(states, risk=None),
+       lookup(key, check) -> solution or None, store(key, solution) and
+       stats() -> dict of hits, misses, rejected (failed check) and evictions
+    """
+    cache = OrderedDict()
+    counters = {'hits': 0, 'misses': 0, 'rejected': 0, 'evictions': 0}
+
+    def key(states, risk=None):
+        """states: sequence of numpy arrays or floats, risk: numpy array, float or None"""
+        values = np.hstack([np.ravel(state) for state in states]) / quantum
+        if risk is not None:
+            values = np.hstack([values, np.ravel(risk) / risk_quantum])
+        return np.round(values).astype(np.int64).tobytes()
+
+    def lookup(key, check=None):
+        solution = cache.get(key)
+        if solution is None:
+            counters['misses'] += 1
+            return None
+        if check is not None and not check(solution):
+            counters['rejected'] += 1
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        counters['hits'] += 1
+        return solution
+
+    def store(key, solution):
+        cache[key] = solution
+        cache.move_to_end(key)
+        if len(cache) > size:
+            cache.popitem(last=False)
+            counters['evictions'] += 1
+
+    def memo_stats():
+        """-> dict with the hits, misses, rejected and evictions counts"""
+        return dict(counters)
+
+    return key, lookup, store, memo_stats
+
+
+def satisfies(x, A, b, lb=None, ub=None, tol=1e-9):
+    """-> True if x satisfies Ax <= b and the bounds (within tol relative to the largest |b|)"""
+    b = np.reshape(b, -1)
+    scale = max(1., np.abs(b).max()) if b.size else 1.
+    if b.size and np.max(np.asarray(A) @ x - b) > tol * scale:
+        return False
+    return (lb is None or np.all(x >= lb - tol)) and (ub is None or np.all(x <= ub + tol))
+
+
+BACKENDS = {'osqp': solve_osqp, 'active_set': solve_active_set}
+if cvxopt_solvers is not None:
+    BACKENDS['cvxopt'] = solve_cvxopt
+if quadprog is not None:
+    BACKENDS['quadprog'] = solve_quadprog
+
+
+def register_backend(name, function):
+    """Adds a solver under name; function takes the arguments of solve after backend."""
+    BACKENDS[name] = function
+
+
+def available_backends():
+    """-> list of the registered backend names"""
+    return list(BACKENDS)
+
+
+def solve(backend, H, f, A, b, lb=None, ub=None, initvals=None, stats=None, **settings):
+    """Solves min 1/2 x'Hx + f'x  s.t.  Ax <= b, lb <= x <= ub with a registered backend.
+
+    backend: name in BACKENDS
+    stats: optional dict, receives 'status', 'iter', 'pri_res', 'dua_res',
+           'solve_time' and 'setup_time' ('status' is 'solved' on success)
+    settings: forwarded to the backend, only pass the ones it understands
+
+    -> numpy array x, or None if the backend found no solution
+    """
+    assert backend in BACKENDS, "Unknown QP backend %r, available: %s." % (backend, ', '.join(BACKENDS))
+    return BACKENDS[backend](H, f, A, b, lb=lb, ub=ub, initvals=initvals, stats=stats, **settings)
+
+
+def benchmark_backends(problems, backends=None, repeat=10, tol=1e-4):
+    """Times the backends on sample problems and checks their solutions.
+
+    A backend passes when it solves every problem some backend solved
+    accurately, its solutions violate no row by more than tol (relative to
+    |b_i| and the row norm) and their cost is within tol (relative) of the median
+    cost of the backends that solved the problem accurately.  A solution
+    violating a row by more than tol does not count as solving the problem,
+    so a backend stopping on a loose tolerance cannot fail the exact ones on
+    (nearly) infeasible problems.
+
+    problems: list of (H, f, A, b, lb, ub) tuples
+    backends: names to try, default all registered
+    repeat: solves per problem when timing
+
+    -> dict name -> {'time': mean seconds per solve, 'violation', 'gap', 'ok'}
+    """
+    if backends is None:
+        backends = available_backends()
+    dense = [dense_problem(*problem) for problem in problems]
+    solutions = {}
+    report = {}
+    for name in backends:
+        try:
+            solutions[name] = [solve(name, *problem) for problem in problems]
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for problem in problems:
+                    solve(name, *problem)
+            report[name] = {'time': (time.perf_counter() - start) / (repeat * max(len(problems), 1))}
+        except Exception as e:
+            report[name] = {'time': np.inf, 'violation': np.inf, 'gap': np.inf, 'ok': False, 'error': str(e)}
+
+    def violation(x, A, b):
+        # relative to the scale of each row, the QPs mix rows of very different scale
+        return np.max((A @ x - b) / feasibility_tolerance(A, b, 1.)) if b.size else 0.
+
+    # The reference cost of a problem is the median over the backends that
+    # solved it accurately, so one inaccurate backend cannot set it
+    violations = {name: [np.inf if x is None else violation(x, A, b) for x, (_, _, A, b) in zip(solutions[name], dense)]
+                  for name in solutions}
+    costs = {name: [np.nan if x is None else 0.5 * x @ H @ x + f @ x for x, (H, f, _, _) in zip(solutions[name], dense)]
+             for name in solutions}
+    accurate = np.array([[cost if v <= tol else np.nan for cost, v in zip(costs[name], violations[name])]
+                         for name in costs])
+    reference = [np.median(c[~np.isnan(c)]) if not np.all(np.isnan(c)) else np.nan for c in accurate.T] if costs else []
+    for name in solutions:
+        worst_violation = gap = 0.
+        for x, cost, v, reference_cost in zip(solutions[name], costs[name], violations[name], reference):
+            if np.isnan(reference_cost):
+                continue
+            if x is None:
+                worst_violation = gap = np.inf
+                break
+            worst_violation = max(worst_violation, v)
+            gap = max(gap, abs(cost - reference_cost) / max(1., abs(reference_cost)))
+        report[name].update(violation=worst_violation, gap=gap, ok=worst_violation <= tol and gap <= tol)
+    return report
+
+
+def select_backend(problems, backends=None, repeat=10, tol=1e-4, default='osqp'):
+    """Picks the fastest backend that passes benchmark_backends.
+
+    -> (name, report), name being default if no backend passed
+    """
+    report = benchmark_backends(problems, backends, repeat, tol)
+    passed = [name for name in report if report[name]['ok']]
+    if not passed:
+        return default, report
+    return min(passed, key=lambda name: report[name]['time']), report
@@ -0,0 +1,111 @@
+"""Rate-limited, non-blocking logging for the controller hot path.
+
+print() from a 20-100 Hz tick goes straight to the terminal or, under
+multiprocess.py, through the ssh pipe, and blocks the tick whenever that pipe
+is slow.  The logger returned by create_rate_limited_logger only does a clock
+check and a non-blocking queue put in the calling thread.  Formatting and the
+actual write happen on a background writer thread.
+"""
+
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+
+def create_rate_limited_logger(rates=None, default_interval=1.0, stream=None, max_queue=1024):
+    """Creates a logger with a per-message-type rate limit and a background writer.
+
+    rates: dict mapping a message type (key) to the minimum number of seconds
+           between two emitted messages of that type.  0 emits every message,
+           None drops the type entirely.
+    default_interval: minimum interval for message types not in rates
+    stream: file-like object to write to (default sys.stdout)
+    max_queue: maximum number of pending messages.  When the writer falls
+               behind, new messages are dropped instead of blocking.
+
+    -> (function, function, function) log(key, fmt, *args), stats() and stop()
+    """
+    rates = dict(rates or {})
+    pending = queue.Queue(max_queue)
+    last_emit = {}
+    suppressed = {}
+    counters = {'emitted': 0, 'suppressed': 0, 'dropped': 0}
+    lock = threading.Lock()
+    state = {'thread': None}
+
+    def writer():
+        out = stream if stream is not None else sys.stdout
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            stamp, key, fmt, args, skipped = item
+            try:
+                message = fmt % args if args else fmt
+            except (TypeError, ValueError):
+                message = '%s %r' % (fmt, args)
+            if skipped:
+                message += ' (%d suppressed)' % skipped
+            try:
+                out.write('[%.3f] %s: %s\n' % (stamp, key, message))
+                out.flush()
+            except (IOError, OSError, ValueError):
+                pass
+
+    def start():
+        with lock:
+            if state['thread'] is None:
+                state['thread'] = threading.Thread(target=writer, name='ratelog-writer')
+                state['thread'].daemon = True
+                state['thread'].start()
+
+    def log(key, fmt, *args):
+        """Queues a message of type key unless that type is rate limited right now.
+
+        Arrays in args are copied, so the caller may keep mutating them.
+        """
+        interval = rates.get(key, default_interval)
+        if interval is None:
+            return
+        now = time.time()
+        if now - last_emit.get(key, -np.inf) < interval:
+            suppressed[key] = suppressed.get(key, 0) + 1
+            counters['suppressed'] += 1
+            return
+        if state['thread'] is None:
+            start()
+        args = tuple(a.copy() if isinstance(a, np.ndarray) else a for a in args)
+        try:
+            pending.put_nowait((now, key, fmt, args, suppressed.pop(key, 0)))
+        except queue.Full:
+            counters['dropped'] += 1
+            return
+        last_emit[key] = now
+        counters['emitted'] += 1
+
+    def stats():
+        """-> dict with the emitted, suppressed and dropped message counts"""
+        return dict(counters)
+
+    def stop(timeout=1.0):
+        """Flushes the pending messages and stops the writer thread."""
+        thread = state['thread']
+        if thread is None:
+            return
+        try:
+            pending.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        state['thread'] = None
+
+    return log, stats, stop
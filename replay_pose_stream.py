@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""Replays recorded pose snapshots through the deadlock-resolution controller.
+
+Runs the exact tick of teleop_twist_keyboardres.py (risk, de_CLF_CBF and the
+SI/unicycle mappings from deadlock_controller.py) offline and as fast as
+possible, and reports how far the replayed /cmd_vel differs from the published
+one.  Two inputs are understood:
+
+  * a tick recording made by running the node with _record:=/path/file.csv
+  * a rosbag export, i.e. one `rostopic echo -p -b run.bag /vrpn_client_node/<body>/pose`
+    CSV per robot (in robot index order) plus `rostopic echo -p -b run.bag /cmd_vel`
+
+Examples:
+
+  python3 replay_pose_stream.py ticks.csv
+  python3 replay_pose_stream.py --poses Hus117.csv Hus137.csv Hus138.csv Hus188.csv --cmd cmd_vel.csv
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import math
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import deadlock_controller
+from joint_deadlock import create_joint_step
+from mpc_cbf import create_mpc_step
+from deadlock_controller import (goal_points, control_step, twist_command, read_tick_records, uni_to_si_states,
+                                 riskMatixCal, DeadlockQP, de_CLF_CBF_qp, de_CLF_CBF)
+from qp_backends import create_solution_memo
+
+
+def quaternion_yaw(qx, qy, qz, qw):
+    """Yaw of a quaternion, same as euler_from_quaternion(...)[2] in the node."""
+    return math.atan2(2. * (qw * qz + qx * qy), 1. - 2. * (qy * qy + qz * qz))
+
+
+def read_pose_export(path):
+    """Reads a `rostopic echo -p` PoseStamped export.
+
+    -> (times, poses) numpy arrays of shape (K,) and (K, 3)
+    """
+    times = []
+    poses = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            times.append(float(row['%time']) * 1e-9)
+            poses.append((float(row['field.pose.position.x']), float(row['field.pose.position.y']),
+                          quaternion_yaw(float(row['field.pose.orientation.x']), float(row['field.pose.orientation.y']),
+                                         float(row['field.pose.orientation.z']), float(row['field.pose.orientation.w']))))
+    return np.array(times), np.array(poses)
+
+
+def read_cmd_export(path):
+    """Reads a `rostopic echo -p` Twist export.
+
+    -> (times, commands) numpy arrays of shape (K,) and (K, 2)
+    """
+    times = []
+    commands = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            times.append(float(row['%time']) * 1e-9)
+            commands.append((float(row['field.linear.x']), float(row['field.angular.z'])))
+    return np.array(times), np.array(commands)
+
+
+def ticks_from_export(pose_paths, cmd_path):
+    """Rebuilds per-tick snapshots from a rosbag export.
+
+    Every /cmd_vel message is one tick.  Like the live callbacks, each robot
+    contributes the latest pose received before that tick.  Omega and uu are
+    not in the bag, so they start at the node's initial values and Omega is
+    carried forward by the replay itself.
+
+    -> list of (stamp, x, Omega, uu, command) tuples, Omega and uu set to None
+    """
+    bodies = [read_pose_export(path) for path in pose_paths]
+    cmd_times, commands = read_cmd_export(cmd_path)
+    N = len(bodies)
+    start = max(t[0] for t, _ in bodies)
+
+    ticks = []
+    for stamp, command in zip(cmd_times, commands):
+        if stamp < start:
+            continue
+        x = np.zeros((3, N))
+        for i, (t, poses) in enumerate(bodies):
+            x[:, i] = poses[np.searchsorted(t, stamp, side='right') - 1]
+        ticks.append((stamp, x, None, None, command))
+    return ticks
+
+
+def replay(ticks, p, free_run=False, tolerance=1e-6, verbose=True, trigger=None, step=control_step, detector=None):
+    """Feeds the ticks through control_step and compares the commands.
+
+    ticks: list of (stamp, x, Omega, uu, command) tuples
+    p: index of the robot whose command was published
+    free_run: carry Omega forward from the replay instead of resetting it
+              from the recording every tick
+    trigger: optional event trigger (deadlock_controller.create_event_trigger)
+    step: controller tick with the arguments of control_step
+          (e.g. deadlock_controller.create_multirate_step())
+    detector: optional deadlock detector (deadlock_controller.create_deadlock_detector)
+
+    -> (differences, tick_times, rows, iters) numpy arrays of shape (K, 2),
+       (K,), (K, N) and (K, N), rows and iters being the QP rows kept and the
+       solver iterations per robot
+    """
+    N = ticks[0][1].shape[1]
+    Omega = math.pi / 2 * np.ones(N)
+    uu = np.zeros((2 * N, 1))
+    dxu = np.zeros((2, N))
+    differences = np.zeros((len(ticks), 2))
+    tick_times = np.zeros(len(ticks))
+    rows = np.zeros((len(ticks), N), dtype=int)
+    iters = np.zeros((len(ticks), N), dtype=int)
+    info = {}
+
+    for k, (stamp, x, omega_start, uu_start, command) in enumerate(ticks):
+        if omega_start is not None and (k == 0 or not free_run):
+            Omega[:] = omega_start
+        if uu_start is not None:
+            uu = uu_start
+
+        t0 = time.perf_counter()
+        step(x, uu, Omega, goal_points, dxu, info, trigger, detector)
+        tick_times[k] = time.perf_counter() - t0
+        rows[k] = info['rows']
+        iters[k] = info['iter']
+
+        replayed = twist_command(dxu, p)
+        differences[k] = (replayed[0] - command[0], replayed[1] - command[1])
+        if verbose and np.max(np.abs(differences[k])) > tolerance:
+            print('tick %d t=%.3f published=(%.6f, %.6f) replayed=(%.6f, %.6f) diff=(%.3e, %.3e)' % (
+                k, stamp, command[0], command[1], replayed[0], replayed[1], differences[k, 0], differences[k, 1]))
+
+    return differences, tick_times, rows, iters
+
+
+def measure_qp_allocations(ticks):
+    """Measures the memory allocated while building the deadlock QPs of the
+    ticks, with a reused DeadlockQP and with de_CLF_CBF_qp (fresh arrays),
+    and by the whole de_CLF_CBF call (build, fast path and solve).
+
+    -> dict name -> numpy array of the peak bytes traced per call
+    """
+    problems = []
+    for stamp, x, omega, uu, command in ticks:
+        N = x.shape[1]
+        omega = math.pi / 2 * np.ones(N) if omega is None else omega
+        uu = np.zeros((2 * N, 1)) if uu is None else uu
+        x_si = uni_to_si_states(x)
+        riskmatrix = riskMatixCal(np.reshape(x_si, 2 * N, order='F'), uu)
+        for i in range(N):
+            mask = np.arange(N) != i
+            problems.append((x_si[:, [i]] * 10, x_si[:, mask] * 10, goal_points[0:2, [i]] * 10, omega[i],
+                             uu[2 * i:2 * i + 2], np.reshape(np.delete(uu, [2 * i, 2 * i + 1]), (2, -1), order='F'),
+                             riskmatrix[i], riskmatrix[mask]))
+
+    workspace = DeadlockQP(problems[0][1].shape[1])
+    results = {}
+    for name, build in (('DeadlockQP.build', workspace.build), ('de_CLF_CBF_qp', de_CLF_CBF_qp),
+                        ('de_CLF_CBF', de_CLF_CBF)):
+        build(*problems[0])
+        peaks = np.zeros(len(problems))
+        for k, problem in enumerate(problems):
+            tracemalloc.start()
+            build(*problem)
+            peaks[k] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = peaks
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', nargs='?', help='tick recording written by the node (~record)')
+    parser.add_argument('--poses', nargs='+', help='per-robot PoseStamped CSV exports, in robot index order')
+    parser.add_argument('--cmd', help='/cmd_vel Twist CSV export')
+    parser.add_argument('-p', '--robot', type=int, default=3, help='index of the robot that published /cmd_vel')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='report ticks whose command differs by more than this')
+    parser.add_argument('--free-run', action='store_true', help='do not reset Omega from the recording each tick')
+    parser.add_argument('--repeat', type=int, default=1, help='replay the stream this many times (profiling)')
+    parser.add_argument('--scaling', action='store_true', help='equilibrate the QP before solving (qp_scaling)')
+    parser.add_argument('--backend', help="QP backend for the deadlock QP (qp_backend), 'auto' to benchmark them first")
+    parser.add_argument('--event-trigger', type=float, metavar='THRESHOLD',
+                        help='event-triggered mode, re-solve after a robot moves more than THRESHOLD (QP units, 10x metres)')
+    parser.add_argument('--memo', type=int, metavar='SIZE', help='memoize up to SIZE deadlock QP solutions (qp_memo)')
+    parser.add_argument('--memo-quantum', type=float, default=0.05, help='state grid of the memo key (QP units)')
+    parser.add_argument('--slow-every', type=int, default=1, metavar='K',
+                        help='two-rate mode, full QP every K-th tick and the CBF filter in between')
+    parser.add_argument('--neighbors', type=int, metavar='K', help='only the K nearest robots are obstacles (qp_neighbors)')
+    parser.add_argument('--joint', action='store_true', help='solve one joint QP for the fleet (joint_deadlock.py)')
+    parser.add_argument('--mpc', type=int, metavar='HORIZON', help='follow an MPC-CBF plan of HORIZON stages (mpc_cbf.py)')
+    parser.add_argument('--detect', action='store_true',
+                        help='solve the cheap CLF-CBF QP unless the deadlock detector fires')
+    parser.add_argument('--allocations', action='store_true',
+                        help='report the memory allocated per deadlock QP build instead of replaying')
+    parser.add_argument('--max-build-bytes', type=float, default=2048.,
+                        help='with --allocations, fail when the median DeadlockQP.build allocates more than this')
+    parser.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    args = parser.parse_args()
+
+    if args.scaling:
+        deadlock_controller.qp_scaling = True
+    if args.neighbors:
+        deadlock_controller.qp_neighbors = args.neighbors
+    if args.memo:
+        deadlock_controller.qp_memo = create_solution_memo(args.memo, args.memo_quantum)
+    if args.backend == 'auto':
+        name, report = deadlock_controller.select_qp_backend()
+        for backend, result in sorted(report.items(), key=lambda item: item[1]['time']):
+            print('%-10s %8.3f ms  violation %.1e  cost gap %.1e  %s' % (
+                backend, 1e3 * result['time'], result['violation'], result['gap'], 'ok' if result['ok'] else 'rejected'))
+        print('selected QP backend: %s' % name)
+    elif args.backend:
+        deadlock_controller.qp_backend = args.backend
+
+    if args.recording:
+        ticks = read_tick_records(args.recording)
+    elif args.poses and args.cmd:
+        ticks = ticks_from_export(args.poses, args.cmd)
+    else:
+        parser.error('give either a tick recording or --poses and --cmd')
+    if not ticks:
+        parser.error('no ticks to replay')
+    if args.allocations:
+        allocations = measure_qp_allocations(ticks)
+        for name, peaks in sorted(allocations.items()):
+            print('%-17s %8.0f bytes median, %8.0f bytes mean, %8.0f bytes max per call' % (
+                name, np.median(peaks), peaks.mean(), peaks.max()))
+        # Steady state: the odd build that logs (and copies its arrays) is not counted
+        steady = np.median(allocations['DeadlockQP.build'])
+        if steady > args.max_build_bytes:
+            sys.exit('DeadlockQP.build allocates %.0f bytes per call in steady state, more than %.0f'
+                     % (steady, args.max_build_bytes))
+        print('DeadlockQP.build steady state within %.0f bytes' % args.max_build_bytes)
+        return
+
+    tick_times = []
+    for r in range(args.repeat):
+        trigger = None
+        if args.event_trigger:
+            trigger = deadlock_controller.create_event_trigger(state_threshold=args.event_trigger)
+        step = deadlock_controller.create_multirate_step(args.slow_every) if args.slow_every > 1 else control_step
+        if args.joint:
+            step = create_joint_step()
+        if args.mpc:
+            step = create_mpc_step(args.mpc)
+        detector = deadlock_controller.create_deadlock_detector() if args.detect else None
+        differences, times, rows, iters = replay(ticks, args.robot, args.free_run, args.tolerance,
+                                                 verbose=not args.quiet and r == 0, trigger=trigger, step=step,
+                                                 detector=detector)
+        tick_times.append(times)
+    tick_times = np.concatenate(tick_times)
+
+    abs_diff = np.abs(differences)
+    mismatched = np.count_nonzero(np.max(abs_diff, axis=1) > args.tolerance)
+    print('ticks: %d, mismatched: %d (tolerance %g)' % (len(ticks), mismatched, args.tolerance))
+    print('max |diff| linear.x: %.3e, angular.z: %.3e' % (abs_diff[:, 0].max(), abs_diff[:, 1].max()))
+    solved = rows[rows > 0]
+    if solved.size:
+        print('QP rows kept: mean %.2f, min %d, max %d' % (solved.mean(), solved.min(), solved.max()))
+        solved = iters[rows > 0]
+        print('QP iterations: mean %.1f, p99 %.0f, max %d' % (solved.mean(), np.percentile(solved, 99), solved.max()))
+    if trigger is not None:
+        events = trigger[3]()
+        print('event-triggered: %d QP solves, %d ticks held' % (events['triggers'], events['skipped']))
+    fast = deadlock_controller.fast_path_stats()
+    if fast['hits'] + fast['misses']:
+        print('QP fast path (no solver): %d of %d QPs' % (fast['hits'], fast['hits'] + fast['misses']))
+    if detector is not None:
+        print('deadlock detector: %(detections)d detections, %(releases)d releases, '
+              '%(resolution_ticks)d resolution and %(cheap_ticks)d CLF-CBF robot ticks' % detector[2]())
+    if deadlock_controller.qp_memo is not None:
+        memo = deadlock_controller.qp_memo[3]()
+        print('memo: %d hits, %d misses, %d rejected by the barrier check, %d evictions' % (
+            memo['hits'], memo['misses'], memo['rejected'], memo['evictions']))
+    cache = deadlock_controller.qp_cache_stats()
+    if cache['hits'] + cache['misses']:
+        print('previous active set reused: %d of %d QPs' % (cache['hits'], cache['hits'] + cache['misses']))
+    print('tick time: mean %.3f ms, p99 %.3f ms, max %.3f ms, total %.3f s' % (
+        1e3 * tick_times.mean(), 1e3 * np.percentile(tick_times, 99), 1e3 * tick_times.max(), tick_times.sum()))
+
+
+if __name__ == '__main__':
+    main()
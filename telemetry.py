@@ -0,0 +1,179 @@
+"""Compact per-tick telemetry from the controllers back to the lab PC.
+
+Every controller tick can emit one fixed-size binary record (tick stamp, solve
+time, solver status, published command, risk and the age of the oldest pose
+the tick used).  Records go either to
+stdout, interleaved with the normal text log so they travel over the existing
+ssh pipe, or to a UDP socket.  On stdout a record is framed by a NUL byte,
+which never appears in the text output, so multiprocess.py can split the
+stream back into log lines and records with create_stream_demux.
+
+The emitter never blocks the control loop: records are queued in a bounded
+queue and written by a background thread; when the consumer is too slow, new
+records are dropped and counted.
+"""
+
+from __future__ import print_function
+
+import math
+import socket
+import struct
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# stamp, seq, robot, status, solve_time, v, w, risk, pose_age
+RECORD = struct.Struct('<dIBBfffff')
+FRAME_MARK = b'\x00'
+FRAME_SIZE = 1 + RECORD.size
+FIELDS = ('stamp', 'seq', 'robot', 'status', 'solve_time', 'v', 'w', 'risk', 'pose_age')
+
+# Solver status carried in the records
+STATUS_SOLVED = 0     # QP solved
+STATUS_NOMINAL = 1    # no QP needed (e.g. at the goal, position controller)
+STATUS_FAILED = 2     # QP returned no solution, fallback command used
+STATUS_RELAXED = 3    # QP infeasible, slack-relaxed QP solved instead
+STATUS_HELD = 4       # no event triggered, previous QP solution reused
+STATUS_FILTERED = 5   # fast tick, slow-loop reference passed through the CBF filter
+STATUS_NAMES = {STATUS_SOLVED: 'solved', STATUS_NOMINAL: 'nominal', STATUS_FAILED: 'failed',
+                STATUS_RELAXED: 'relaxed', STATUS_HELD: 'held', STATUS_FILTERED: 'filtered'}
+
+
+def create_telemetry_emitter(target, max_pending=256, batch=32):
+    """Creates a non-blocking telemetry emitter.
+
+    target: 'stdout' to frame records into the stdout stream, or
+            'udp://host:port' to send them as datagrams
+    max_pending: records kept while the writer is busy, newer ones are dropped
+    batch: maximum number of records written in one write/datagram
+
+    -> (function, function, function) emit(robot, stamp, solve_time, status, v, w, risk, pose_age),
+       stats() and close()
+    """
+    if target == 'stdout':
+        out = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+
+        def write(frames):
+            # One write per batch, so log lines written by other threads can
+            # only land between whole frames.
+            sys.stdout.flush()
+            out.write(frames)
+            out.flush()
+    else:
+        url = urlparse(target)
+        assert url.scheme == 'udp' and url.port, "Telemetry target must be 'stdout' or 'udp://host:port'. Recieved %r." % target
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = (url.hostname, url.port)
+
+        def write(frames):
+            sock.sendto(frames, address)
+
+    pending = queue.Queue(max_pending)
+    counters = {'sent': 0, 'dropped': 0, 'errors': 0}
+    seq = [0]
+
+    def writer():
+        while True:
+            frames = [pending.get()]
+            if frames[0] is None:
+                break
+            while len(frames) < batch:
+                try:
+                    frames.append(pending.get_nowait())
+                except queue.Empty:
+                    break
+            stop = frames[-1] is None
+            if stop:
+                frames.pop()
+            try:
+                write(b''.join(frames))
+                counters['sent'] += len(frames)
+            except (IOError, OSError, ValueError):
+                counters['errors'] += len(frames)
+            if stop:
+                break
+
+    thread = threading.Thread(target=writer, name='telemetry-writer')
+    thread.daemon = True
+    thread.start()
+
+    def emit(robot, stamp, solve_time, status, v, w, risk=math.nan, pose_age=math.nan):
+        """Queues one tick record, dropping it if the writer is behind."""
+        seq[0] += 1
+        frame = FRAME_MARK + RECORD.pack(stamp, seq[0] & 0xffffffff, robot, status, solve_time, v, w, risk, pose_age)
+        try:
+            pending.put_nowait(frame)
+        except queue.Full:
+            counters['dropped'] += 1
+
+    def stats():
+        """-> dict with the sent, dropped and errors record counts"""
+        return dict(counters)
+
+    def close(timeout=1.0):
+        try:
+            pending.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+
+    return emit, stats, close
+
+
+def create_stream_demux():
+    """Creates a parser that splits a controller output stream into text lines
+    and telemetry records.
+
+    -> function feed(data) -> (list of str lines, list of record tuples)
+    """
+    state = {'buffer': b''}
+
+    def feed(data):
+        buffer = state['buffer'] + data
+        lines = []
+        records = []
+        start = 0
+        while True:
+            mark = buffer.find(FRAME_MARK, start)
+            text_end = len(buffer) if mark < 0 else mark
+            # Complete text lines before the next frame
+            newline = buffer.rfind(b'\n', start, text_end)
+            if newline >= 0:
+                lines.extend(line.decode('utf-8', 'replace') for line in buffer[start:newline].split(b'\n'))
+                start = newline + 1
+            if mark < 0 or mark + FRAME_SIZE > len(buffer):
+                break
+            records.append(RECORD.unpack_from(buffer, mark + 1))
+            # Text cut by the frame continues after it
+            buffer = buffer[:mark] + buffer[mark + FRAME_SIZE:]
+        state['buffer'] = buffer[start:]
+        return lines, records
+
+    return feed
+
+
+def parse_datagram(data):
+    """-> list of record tuples in one UDP datagram"""
+    return [RECORD.unpack_from(data, offset + 1) for offset in range(0, len(data) - FRAME_SIZE + 1, FRAME_SIZE)
+            if data[offset:offset + 1] == FRAME_MARK]
+
+
+def read_telemetry_file(path):
+    """Reads a per-robot file written by multiprocess.py (raw records, no frame marks).
+
+    -> numpy structured array with the fields in FIELDS
+    """
+    import numpy as np
+    dtype = np.dtype([('stamp', '<f8'), ('seq', '<u4'), ('robot', 'u1'), ('status', 'u1'),
+                      ('solve_time', '<f4'), ('v', '<f4'), ('w', '<f4'), ('risk', '<f4'), ('pose_age', '<f4')])
+    assert dtype.itemsize == RECORD.size
+    return np.fromfile(path, dtype=dtype)
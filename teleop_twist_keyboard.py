@@ -14,29 +14,34 @@ import sys, select, termios, tty
 
 import random
 import math
+import time
 import numpy as np
 from cvxopt import matrix
 from cvxopt.blas import dot
 from cvxopt.solvers import qp, options
 from cvxopt import matrix, sparse
 
-import qpsolvers
-from qpsolvers import solve_qp
-from scipy import sparse as sparsed
-# Unused for now, will include later for speed.
-# import quadprog as solver2
+from qp_backends import solve, create_fast_path, create_solution_memo, satisfies
+from barrier_partition import create_partitioned_solver
 
 import itertools
 import numpy as np
 from scipy.special import comb
 from geometry_msgs.msg import TransformStamped, PoseStamped
 
+from ratelog import create_rate_limited_logger
+from telemetry import create_telemetry_emitter, STATUS_SOLVED
+
 options['show_progress'] = False
 # Change default options of CVXOPT for faster solving
 options['reltol'] = 1e-2 # was e-2
 options['feastol'] = 1e-2 # was e-4
 options['maxiters'] = 50 # default is 100
 
+# Diagnostics from the control tick go through a rate-limited background
+# writer instead of blocking print() calls on the terminal or ssh pipe.
+log, log_stats, stop_log = create_rate_limited_logger({'state': 1.0, 'barrier': 0.2, 'clf': 1.0, 'fast_path': 5.0})
+
 def create_si_to_uni_dynamics(linear_velocity_gain=1, angular_velocity_limit=np.pi):
     """ Returns a function mapping from single-integrator to unicycle dynamics with angular velocity magnitude restrictions.
 
@@ -237,13 +242,19 @@ def create_uni_to_si_dynamics(projection_distance=0.05):
 
 
 
-def create_single_integrator_barrier_certificate(barrier_gain=100, safety_radius=0.17, magnitude_limit=100):
+def create_single_integrator_barrier_certificate(barrier_gain=100, safety_radius=0.17, magnitude_limit=100, backend='cvxopt',
+                                                 partition=False, workers=1):
 	"""Creates a barrier certificate for a single-integrator system.  This function
     returns another function for optimization reasons.
 
     barrier_gain: double (controls how quickly agents can approach each other.  lower = slower)
     safety_radius: double (how far apart the agents will stay)
     magnitude_limit: how fast the robot can move linearly.
+    backend: QP solver, any name in qp_backends.BACKENDS
+    partition: solve the groups of robots that cannot interact this tick as
+               separate QPs (barrier_partition.py), the optimum of the joint
+               QP to the backend's tolerance
+    workers: threads solving those QPs, 1 solves them in turn
 
     -> function (the barrier certificate function)
     """
@@ -265,6 +276,8 @@ def create_single_integrator_barrier_certificate(barrier_gain=100, safety_radius
 	assert magnitude_limit > 0, "In the function create_single_integrator_barrier_certificate, the maximum linear velocity of the robot (magnitude_limit) must be positive. Recieved %r." % magnitude_limit
 	#assert magnitude_limit <= 0.2, "In the function create_single_integrator_barrier_certificate, the maximum linear velocity of the robot (magnitude_limit) must be less than the max speed of the robot (0.2m/s). Recieved %r." % magnitude_limit
 
+	solve_partitioned = create_partitioned_solver(backend, workers) if partition else None
+
 	def f(dxi, x):
 		# Check user input types
 		assert isinstance(dxi,
@@ -291,19 +304,18 @@ def create_single_integrator_barrier_certificate(barrier_gain=100, safety_radius
 		num_constraints = int(comb(N, 2))
 		A = np.zeros((num_constraints, 2 * N))
 		b = np.zeros(num_constraints)
-		H = sparse(matrix(2 * np.identity(2 * N)))
-
-		count = 0
-		for i in range(N-1):
-			for j in range(i + 1, N):
-				error = x[:, i] - x[:, j]
-				h = (error[0] * error[0] + error[1] * error[1]) - np.power(safety_radius, 2)
-
-				A[count, (2 * i, (2 * i + 1))] = -2 * error
-				A[count, (2 * j, (2 * j + 1))] = 2 * error
-				b[count] = barrier_gain * np.power(h, 3)
-
-				count += 1
+		H = 2 * np.identity(2 * N)
+
+		# One row per pair (i, j), i < j, in the order of the former double loop
+		rows = np.transpose(np.triu_indices(N, 1))
+		count = np.arange(num_constraints)
+		error = x[:, rows[:, 0]] - x[:, rows[:, 1]]
+		h = (error[0] * error[0] + error[1] * error[1]) - np.power(safety_radius, 2)
+		A[count, 2 * rows[:, 0]] = -2 * error[0]
+		A[count, 2 * rows[:, 0] + 1] = -2 * error[1]
+		A[count, 2 * rows[:, 1]] = 2 * error[0]
+		A[count, 2 * rows[:, 1] + 1] = 2 * error[1]
+		b[:] = barrier_gain * np.power(h, 3)
 
 		# Threshold control inputs before QP
 		norms = np.linalg.norm(dxi, 2, 0)
@@ -311,13 +323,23 @@ def create_single_integrator_barrier_certificate(barrier_gain=100, safety_radius
 		dxi[:, idxs_to_normalize] *= magnitude_limit / norms[idxs_to_normalize]
 
 		f = -2 * np.reshape(dxi, 2 * N, order='F')
-		result = qp(H, matrix(f), matrix(A), matrix(b))['x']
+		if partition:
+			stats = {}
+			result = solve_partitioned(H, f, A, b, rows, dxi, stats)
+			log('barrier', 'barrier certificate split into %d QPs (%d robots, %d of %d rows)',
+				stats['qps'], N, stats['rows'], stats['rows_total'])
+		else:
+			result = solve(backend, H, f, A, b)
+		if result is None:
+			log('barrier', 'barrier certificate QP failed, stopping all robots')
+			result = np.zeros(2 * N)
 
 		return np.reshape(result, (2, -1), order='F')
 
 	return f
 
-def create_unicycle_barrier_certificate(barrier_gain=100, safety_radius=0.12, projection_distance=0.05, magnitude_limit=100):
+def create_unicycle_barrier_certificate(barrier_gain=100, safety_radius=0.12, projection_distance=0.05, magnitude_limit=100, backend='cvxopt',
+                                        partition=False, workers=1):
     """ Creates a unicycle barrier cetifcate to avoid collisions. Uses the diffeomorphism mapping
     and single integrator implementation. For optimization purposes, this function returns
     another function.
@@ -325,6 +347,8 @@ def create_unicycle_barrier_certificate(barrier_gain=100, safety_radius=0.12, pr
     barrier_gain: double (how fast the robots can approach each other)
     safety_radius: double (how far apart the robots should stay)
     projection_distance: double (how far ahead to place the bubble)
+    backend: QP solver, any name in qp_backends.BACKENDS
+    partition, workers: see create_single_integrator_barrier_certificate
 
     -> function (the unicycle barrier certificate function)
     """
@@ -343,7 +367,8 @@ def create_unicycle_barrier_certificate(barrier_gain=100, safety_radius=0.12, pr
    # assert magnitude_limit <= 0.2, "In the function create_unicycle_barrier_certificate, the maximum linear velocity of the robot (magnitude_limit) must be less than the max speed of the robot (0.2m/s). Recieved %r." % magnitude_limit
 
 
-    si_barrier_cert = create_single_integrator_barrier_certificate(barrier_gain=barrier_gain, safety_radius=safety_radius+projection_distance)
+    si_barrier_cert = create_single_integrator_barrier_certificate(barrier_gain=barrier_gain, safety_radius=safety_radius+projection_distance, backend=backend,
+                                                                   partition=partition, workers=workers)
 
     si_to_uni_dyn, uni_to_si_states = create_si_to_uni_mapping(projection_distance=projection_distance)
 
@@ -371,30 +396,36 @@ def create_unicycle_barrier_certificate(barrier_gain=100, safety_radius=0.12, pr
 
     return f
 
-def de_create_single_integrator_barrier_certificate(barrier_gain=10, safety_radius=0.17, magnitude_limit=0.2):
+def de_create_single_integrator_barrier_certificate(barrier_gain=10, safety_radius=0.17, magnitude_limit=0.2, backend='cvxopt', fast_path=True, memo=None):
     """Creates a barrier certificate for a single-integrator system.  This function
     returns another function for optimization reasons.
 
     barrier_gain: double (controls how quickly agents can approach each other.  lower = slower)
     safety_radius: double (how far apart the agents will stay)
     magnitude_limit: how fast the robot can move linearly.
+    backend: QP solver, any name in qp_backends.BACKENDS
+    fast_path: return the nominal input without solving when it already satisfies every barrier
+    memo: optional qp_backends.create_solution_memo, solutions are reused for the same quantized
+          (dxi, x, xo) if they satisfy the current barriers
 
     -> function (the barrier certificate function)
     """
 
+    try_nominal, fast_path_stats = create_fast_path()
+
     def f(dxi, x, xo):
 
         # Initialize some variables for computational savings
         num_constraints = xo.shape[1]
         A = np.zeros((num_constraints, 2))
         b = np.zeros(num_constraints)
-        H = sparse(matrix(2 * np.identity(2)))
+        H = 2 * np.identity(2)
 
         for i in range(num_constraints):
             error = x[:,0] - xo[:, i]
             h = (error[0] * error[0] + error[1] * error[1]) - np.power(safety_radius, 2)
             if h <= 0:
-                print(h)
+                log('barrier', 'h = %s', h)
             A[i, :] = -error.T
             b[i] = 0.5 * barrier_gain * h
         norms = np.linalg.norm(dxi, 2, 0)
@@ -403,11 +434,21 @@ def de_create_single_integrator_barrier_certificate(barrier_gain=10, safety_radi
 
         f = -2 * np.reshape(dxi, 2, order='F')
         H = 0.5*(H+H.T)
-        try:
-            result = qp(H, matrix(f), matrix(A), matrix(b))['x']
-            return np.reshape(result, (2, -1), order='F')
-        except:
+        result = try_nominal(H, f, A, b) if fast_path else None
+        if fast_path:
+            log('fast_path', 'barrier certificate fast path: %s', fast_path_stats())
+        if result is None and memo is not None:
+            memo_key = memo[0]((dxi, x, xo))
+            result = memo[1](memo_key, lambda u: satisfies(u, A, b))
+            if result is None:
+                result = solve(backend, H, f, A, b)
+                if result is not None:
+                    memo[2](memo_key, result)
+        elif result is None:
+            result = solve(backend, H, f, A, b)
+        if result is None:
             return np.array([[0],[0]])
+        return np.reshape(result, (2, -1), order='F')
 
 
     return f
@@ -524,9 +565,7 @@ def create_clf_unicycle_pose_controller(approach_angle_gain=1, desired_angle_gai
 			ca = np.cos(alpha)
 			sa = np.sin(alpha)
 
-			print(gamma)
-			print(e)
-			print(ca)
+			log('clf', 'gamma = %s, e = %s, ca = %s', gamma, e, ca)
 
 			dxu[0, i] = gamma * e * ca
 			dxu[1, i] = k * alpha + gamma * ((ca * sa) / alpha) * (alpha + h * theta)
@@ -536,18 +575,30 @@ def create_clf_unicycle_pose_controller(approach_angle_gain=1, desired_angle_gai
 	return pose_uni_clf_controller
 
 
-def de_create_single_integrator_CLF_CBF(barrier_gain=10, safety_radius=0.17, magnitude_limit=0.2):
+def de_create_single_integrator_CLF_CBF(barrier_gain=10, safety_radius=0.17, magnitude_limit=0.2, backend='osqp', fast_path=True, memo=None,
+                                        neighbors=None):
     """Creates a barrier certificate for a single-integrator system.  This function
     returns another function for optimization reasons.
 
     barrier_gain: double (controls how quickly agents can approach each other.  lower = slower)
     safety_radius: double (how far apart the agents will stay)
     magnitude_limit: how fast the robot can move linearly.
+    backend: QP solver, any name in qp_backends.BACKENDS
+    fast_path: return the CLF-optimal input without solving when it already satisfies every barrier
+    memo: optional qp_backends.create_solution_memo, solutions are reused for the same quantized
+          (x, xo, xgoal) if they satisfy the current barriers
+    neighbors: keep only this many nearest obstacles (partial sort), so the QP always has neighbors + 1 rows
 
     -> function (the barrier certificate function)
     """
 
+    # The CLF row is the last one
+    try_clf_optimal, fast_path_stats = create_fast_path(candidates=((), (-1,)))
+
     def f(x, xo, xgoal):
+        if neighbors is not None and xo.shape[1] > neighbors:
+            distance = np.sum((xo - x) ** 2, axis=0)
+            xo = xo[:, np.sort(np.argpartition(distance, neighbors - 1)[:neighbors])]
         # Initialize some variables for computational savings
         num_constraints = xo.shape[1] + 1
         A = np.zeros((num_constraints, 3))
@@ -558,7 +609,7 @@ def de_create_single_integrator_CLF_CBF(barrier_gain=10, safety_radius=0.17, mag
             error = x[:, 0] - xo[:, i]
             h = (error[0] * error[0] + error[1] * error[1]) - np.power(safety_radius, 2)
             if h <= 0:
-                print(h)
+                log('barrier', 'h = %s', h)
             A[i, 0:2] = -error.T
             b[i] = 0.5 * barrier_gain * h
 
@@ -572,9 +623,19 @@ def de_create_single_integrator_CLF_CBF(barrier_gain=10, safety_radius=0.17, mag
 
         f = np.zeros((3, 1))
         H = np.eye(3)
-        H = sparsed.csc_matrix(H)
-        A = sparsed.csc_matrix(A)
-        result = solve_qp(H, f, A, b, solver='osqp')
+        result = try_clf_optimal(H, f, A, b) if fast_path else None
+        if fast_path:
+            log('fast_path', 'CLF-CBF fast path: %s', fast_path_stats())
+        if result is None and memo is not None:
+            memo_key = memo[0]((x, xo, xgoal))
+            # The CLF row only costs optimality, the barrier rows are re-checked
+            result = memo[1](memo_key, lambda u: satisfies(u, A[:-1], b[:-1]))
+            if result is None:
+                result = solve(backend, H, f, A, b)
+                if result is not None:
+                    memo[2](memo_key, result)
+        elif result is None:
+            result = solve(backend, H, f, A, b)
 
         return result
 
@@ -585,15 +646,45 @@ publisher = rospy.Publisher('/cmd_vel', Twist, queue_size = 1)
 rospy.sleep(2)
 twist = Twist()
 #rate = rospy.Rate(1)
+first_command = [True]
+
+# Set ~telemetry to 'stdout' or 'udp://host:port' to stream per-tick records to multiprocess.py
+telemetry_target = rospy.get_param('~telemetry', '')
+if telemetry_target:
+	emit_telemetry, _, close_telemetry = create_telemetry_emitter(telemetry_target)
+	rospy.on_shutdown(close_telemetry)
+else:
+	emit_telemetry = None
+
+def publish_command(twist, p, tick_start):
+	publisher.publish(twist)
+	if first_command[0]:
+		# multiprocess.py times the controller startup on this message
+		first_command[0] = False
+		log('startup', 'first command published')
+	if emit_telemetry is not None:
+		emit_telemetry(p, tick_start, time.time() - tick_start, STATUS_SOLVED, twist.linear.x, twist.angular.z)
 
 single_integrator_position_controller = create_si_position_controller()
 
-si_barrier_cert = de_create_single_integrator_CLF_CBF(safety_radius=4)
+# Set ~qp_backend to use another solver than each certificate's default (see qp_backends.py)
+qp_backend = rospy.get_param('~qp_backend', '')
+backend_options = {'backend': qp_backend} if qp_backend else {}
+# Set ~memo_size to memoize up to that many CLF-CBF solutions on a ~memo_quantum grid
+memo_size = rospy.get_param('~memo_size', 0)
+memo = create_solution_memo(memo_size, rospy.get_param('~memo_quantum', 0.05)) if memo_size > 0 else None
+# Set ~neighbors to k to only take the k nearest robots as obstacles (fixed QP size)
+neighbors = rospy.get_param('~neighbors', 0)
+
+si_barrier_cert = de_create_single_integrator_CLF_CBF(safety_radius=4, memo=memo, neighbors=neighbors or None, **backend_options)
 _, uni_to_si_states = create_si_to_uni_mapping()
 
 si_to_uni_dyn = create_si_to_uni_dynamics()
 unicycle_position_controller = create_clf_unicycle_pose_controller()
-uni_barrier_cert = create_unicycle_barrier_certificate(safety_radius = 0.4)
+# Set ~partition to solve the centralized certificate per group of interacting
+# robots, on ~partition_workers threads
+uni_barrier_cert = create_unicycle_barrier_certificate(safety_radius = 0.4, partition=rospy.get_param('~partition', False),
+                                                       workers=rospy.get_param('~partition_workers', 1), **backend_options)
 
 N = 4
 x = np.array([[0.0,0.5,-0.5,1.0],[0.0,-0.5,0.5,-1.0],[0.2,0.2,0.2,0.2]])
@@ -615,6 +706,7 @@ def control_callback(event):
 
 	#p for your controlling robot's index
 	p = 3
+	tick_start = time.time()
 	if ready[0] != 1 or ready[1] != 1 or ready[2] != 1 or ready[3] != 1:
 
 		for i in range(N):
@@ -629,13 +721,13 @@ def control_callback(event):
 		twist.angular.x = 0
 		twist.angular.y = 0
 		twist.angular.z = dxu[1,p]/5.
-		publisher.publish(twist)
+		publish_command(twist, p, tick_start)
 		
 	if ready[0] == 1 and ready[1] == 1 and ready[2] == 1 and ready[3] == 1:
 
 		dxu = np.array([[0,0,0,0],[0,0,0,0]])
 
-		print("x is",x)
+		log('state', 'x is %s', x)
 		x_si = uni_to_si_states(x)
 
 		# robot i
@@ -659,7 +751,7 @@ def control_callback(event):
 		twist.angular.x = 0
 		twist.angular.y = 0
 		twist.angular.z = dxu[1,p]/25.
-		publisher.publish(twist)
+		publish_command(twist, p, tick_start)
 
 def central():
 
@@ -671,6 +763,7 @@ def central():
 
 	
 	timer = rospy.Timer(rospy.Duration(0.05), control_callback)
+	rospy.on_shutdown(stop_log)
 	rospy.spin()
 
 
@@ -0,0 +1,58 @@
+"""Tests of the per-group barrier certificate solve (python -m pytest)."""
+import numpy as np
+import pytest
+from cvxopt.solvers import options
+
+from barrier_partition import create_partitioned_solver
+from qp_backends import solve, available_backends, feasibility_tolerance
+
+# Largest difference from the joint solve: the exact solvers agree to
+# rounding, OSQP and CVXOPT (with the options of teleop_twist_keyboard.py)
+# only to their tolerances
+TOLERANCES = {'quadprog': 1e-9, 'active_set': 1e-9, 'osqp': 2e-3, 'cvxopt': 0.1}
+
+
+def certificate_problems(count=100, seed=0, safety_radius=0.4, barrier_gain=100):
+    """-> list of (H, f, A, b, rows, dxi) barrier certificates of random
+       fleets, built as create_single_integrator_barrier_certificate does,
+       with every b >= 0 so that they can be split"""
+    rng = np.random.RandomState(seed)
+    problems = []
+    while len(problems) < count:
+        N = rng.randint(4, 13)
+        x = rng.uniform(-3, 3, (2, N))
+        dxi = rng.normal(scale=0.3, size=(2, N))
+        rows = np.transpose(np.triu_indices(N, 1))
+        count_rows = np.arange(len(rows))
+        error = x[:, rows[:, 0]] - x[:, rows[:, 1]]
+        h = error[0] * error[0] + error[1] * error[1] - safety_radius ** 2
+        if np.any(h < 0):
+            continue
+        A = np.zeros((len(rows), 2 * N))
+        A[count_rows, 2 * rows[:, 0]] = -2 * error[0]
+        A[count_rows, 2 * rows[:, 0] + 1] = -2 * error[1]
+        A[count_rows, 2 * rows[:, 1]] = 2 * error[0]
+        A[count_rows, 2 * rows[:, 1] + 1] = 2 * error[1]
+        b = barrier_gain * h ** 3
+        problems.append((2 * np.identity(2 * N), -2 * np.reshape(dxi, 2 * N, order='F'), A, b, rows, dxi))
+    return problems
+
+
+@pytest.mark.parametrize('backend', sorted(TOLERANCES))
+def test_partitioned_matches_joint(backend, monkeypatch):
+    if backend not in available_backends():
+        pytest.skip('%s is not installed' % backend)
+    monkeypatch.setitem(options, 'show_progress', False)
+    monkeypatch.setitem(options, 'reltol', 1e-2)
+    monkeypatch.setitem(options, 'feastol', 1e-2)
+    solve_partitioned = create_partitioned_solver(backend)
+    split = 0
+    for H, f, A, b, rows, dxi in certificate_problems():
+        stats = {}
+        result = solve_partitioned(H, f, A, b, rows, dxi, stats)
+        joint = solve(backend, H, f, A, b)
+        assert result is not None and joint is not None
+        assert np.all(A @ joint - b <= feasibility_tolerance(A, b, TOLERANCES[backend]))
+        assert np.abs(result - joint).max() <= TOLERANCES[backend]
+        split += stats['qps'] > 1
+    assert split > 10
@@ -0,0 +1,84 @@
+"""Tests of the deadlock QP workspace (python -m pytest)."""
+import gc
+import math
+import tracemalloc
+import warnings
+
+import numpy as np
+
+import deadlock_controller
+from deadlock_controller import (DeadlockQP, de_CLF_CBF_solve, riskMatixCal, uni_to_si_states, initial_conditions,
+                                 goal_points)
+from qp_backends import solve_osqp
+
+
+def deadlock_problems(num_ticks=40):
+    """-> list of de_CLF_CBF argument tuples along the straight paths from
+       initial_conditions to goal_points, every robot of every tick"""
+    N = initial_conditions.shape[1]
+    rng = np.random.RandomState(0)
+    uu = np.zeros((2 * N, 1))
+    omega = math.pi / 2 * np.ones(N)
+    problems = []
+    for t in np.linspace(0., 0.6, num_ticks):
+        x = (1 - t) * initial_conditions + t * goal_points + rng.normal(scale=0.05, size=initial_conditions.shape)
+        x_si = uni_to_si_states(x)
+        riskmatrix = riskMatixCal(np.reshape(x_si, 2 * N, order='F'), uu)
+        for i in range(N):
+            mask = np.arange(N) != i
+            problems.append((x_si[:, [i]] * 10, x_si[:, mask] * 10, goal_points[0:2, [i]] * 10, omega[i],
+                             uu[2 * i:2 * i + 2], np.reshape(np.delete(uu, [2 * i, 2 * i + 1]), (2, -1), order='F'),
+                             riskmatrix[i], riskmatrix[mask]))
+    return problems
+
+
+def build_and_solve(workspace, problem, stats):
+    H, f, A, b, lb, ub, initvals = workspace.build(*problem, stats=stats)
+    return de_CLF_CBF_solve(H, f, A, b, lb, ub, initvals, workspace.num_obstacles, stats, workspace=workspace)
+
+
+def test_workspace_matches_fresh_osqp():
+    workspace = DeadlockQP(initial_conditions.shape[1] - 1)
+    for problem in deadlock_problems():
+        H, f, A, b, lb, ub, initvals = (np.array(a) for a in workspace.build(*problem))
+        for scale in (False, True):
+            expected = solve_osqp(H, f, A, b, lb=lb, ub=ub, initvals=initvals, scale=scale, max_iter=6000)
+            result = workspace.osqp(H, f, A, b, lb=lb, ub=ub, initvals=initvals, scale=scale, max_iter=6000)
+            assert (result is None) == (expected is None)
+            if result is not None:
+                assert np.allclose(result, expected, rtol=0., atol=1e-8)
+
+
+def test_build_and_solve_steady_state_allocations(monkeypatch):
+    assert deadlock_controller.qp_backend == 'osqp'
+    # Captured log lines would count as growth
+    monkeypatch.setattr(deadlock_controller, 'log', lambda key, fmt, *args: None)
+    workspace = DeadlockQP(initial_conditions.shape[1] - 1)
+    stats = {}
+    # The relaxed fallback sets up a solver of its own, keep to the ticks without it
+    problems = []
+    for problem in deadlock_problems():
+        stats['relaxed'] = False
+        build_and_solve(workspace, problem, stats)
+        if not stats['relaxed']:
+            problems.append(problem)
+    assert len(problems) > 100
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        tracemalloc.start()
+        try:
+            # Objects freed in a pass were allocated in the one before under
+            # the same trace, so the differences are the growth per pass.
+            # osqp's bindings keep allocating for a few passes while they
+            # warm up, a leak would grow every pass.
+            traced = []
+            for _ in range(16):
+                for problem in problems:
+                    result = build_and_solve(workspace, problem, stats)
+                result = None
+                gc.collect()
+                traced.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+    # Any object kept per tick would add at least 32 bytes per tick
+    assert np.median(np.diff(traced)[-8:]) < 8 * len(problems), traced
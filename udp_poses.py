@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Direct UDP pose ingestion, bypassing vrpn_client_node and the ROS master.
+
+A mocap-side sender puts every frame into one datagram: a header (sender
+stamp, frame number, body count) followed by one record per body (robot
+index, position, orientation quaternion).  create_udp_pose_reader reads the
+datagrams on a background thread and writes the poses straight into the
+controller's pose store (pose_store.py) and state array, and keeps the
+receive latency (receipt time minus sender stamp) of every frame.
+
+The stamps are the sender's wall clock, so sender and controller need
+synchronized clocks (chrony/NTP), as with the header stamps of the ROS path.
+
+    python3 udp_poses.py send udp://<controller>:3883 [--bodies 4] [--rate 100]
+
+runs a stand-in sender with synthetic bodies driving in circles, and
+
+    python3 udp_poses.py latency [--bodies 4] [--rate 100] [--frames 2000]
+
+sends the same synthetic frames over loopback UDP and, when rospy and a ROS
+master are available, over a ROS topic, and compares their latencies.
+"""
+
+from __future__ import print_function
+
+import argparse
+import math
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from pose_store import yaw
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# stamp, frame, number of bodies
+FRAME = struct.Struct('<dIH')
+# robot index, x, y, z, qx, qy, qz, qw
+BODY = struct.Struct('<H7f')
+BODY_DTYPE = np.dtype([('index', '<u2'), ('pose', '<f4', 7)])
+assert BODY_DTYPE.itemsize == BODY.size
+
+
+def pack_frame(stamp, frame, index, poses):
+    """-> datagram of one frame
+
+    index: int array of robot indices
+    poses: Bx3 (x, y, theta) or Bx7 (x, y, z, qx, qy, qz, qw) array
+    """
+    poses = np.asarray(poses, dtype=np.float32)
+    if poses.shape[1] == 3:
+        planar = np.zeros((len(poses), 7), dtype=np.float32)
+        planar[:, 0:2] = poses[:, 0:2]
+        planar[:, 5] = np.sin(poses[:, 2] / 2)
+        planar[:, 6] = np.cos(poses[:, 2] / 2)
+        poses = planar
+    bodies = np.zeros(len(poses), dtype=BODY_DTYPE)
+    bodies['index'] = index
+    bodies['pose'] = poses
+    return FRAME.pack(stamp, frame & 0xffffffff, len(poses)) + bodies.tobytes()
+
+
+def unpack_frame(data):
+    """-> (stamp, frame, structured array of bodies) of one datagram, or None
+    if it is not a whole frame"""
+    if len(data) < FRAME.size:
+        return None
+    stamp, frame, count = FRAME.unpack_from(data)
+    if len(data) != FRAME.size + count * BODY.size:
+        return None
+    return stamp, frame, np.frombuffer(data, dtype=BODY_DTYPE, count=count, offset=FRAME.size)
+
+
+def create_udp_pose_reader(port, store=None, x=None, host='0.0.0.0', history=1000, robots=None, reorder_window=100,
+                           log=None):
+    """Starts reading pose frames from a UDP socket on a background thread.
+
+    port: UDP port to bind (0 picks a free one)
+    store: optional store function of create_pose_store, receives each frame
+    x: optional 3xN array of the latest poses, updated in place
+    history: number of frame latencies kept for stats()
+    robots: number of robots, bodies with a larger index are dropped
+            (default the columns of x, no limit without x)
+    reorder_window: a frame at most this many frames behind the last one of
+                    the same sender is dropped as out of order; one further
+                    behind, or from another sender, means the sender restarted
+    log: optional log(key, fmt, *args) for errors in the reader
+
+    -> (int, function, function) the bound port, stats() -> dict of frame
+       counts, latency percentiles (s) and 'alive' (reader thread running)
+       and close()
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.settimeout(0.2)
+    latencies = np.zeros(history)
+    if robots is None and x is not None:
+        robots = x.shape[1]
+    counters = {'frames': 0, 'bodies': 0, 'invalid': 0, 'out_of_order': 0, 'restarts': 0, 'unknown_bodies': 0,
+                'errors': 0}
+    state = {'running': True, 'alive': True, 'frame': None, 'sender': None}
+
+    def reader():
+        try:
+            while state['running']:
+                try:
+                    data, sender = sock.recvfrom(65536)
+                except socket.timeout:
+                    continue
+                except (IOError, OSError):
+                    break
+                try:
+                    receive(data, sender, time.time())
+                except Exception as error:
+                    counters['errors'] += 1
+                    if log is not None:
+                        log('udp_poses', 'dropped a pose frame from %s: %r', sender, error)
+        finally:
+            state['alive'] = False
+            if state['running'] and log is not None:
+                log('udp_poses', 'UDP pose reader stopped')
+
+    def receive(data, sender, received):
+        frame = unpack_frame(data)
+        if frame is None:
+            counters['invalid'] += 1
+            return
+        stamp, number, bodies = frame
+        if state['frame'] is not None and sender == state['sender']:
+            behind = (state['frame'] - number) & 0xffffffff
+            if 0 < behind <= reorder_window:
+                counters['out_of_order'] += 1
+                return
+            if 0 < behind < 0x80000000:
+                counters['restarts'] += 1
+        elif state['sender'] is not None and sender != state['sender']:
+            counters['restarts'] += 1
+        state['frame'] = number
+        state['sender'] = sender
+        index = bodies['index'].astype(int)
+        pose = bodies['pose']
+        if robots is not None and np.any(index >= robots):
+            known = index < robots
+            counters['unknown_bodies'] += len(index) - np.count_nonzero(known)
+            index = index[known]
+            pose = pose[known]
+        theta = yaw(pose[:, 3], pose[:, 4], pose[:, 5], pose[:, 6])
+        if x is not None:
+            x[0, index] = pose[:, 0]
+            x[1, index] = pose[:, 1]
+            x[2, index] = theta
+        if store is not None:
+            store(index, np.full(len(index), stamp), pose[:, 0], pose[:, 1], theta)
+        latencies[counters['frames'] % history] = received - stamp
+        counters['frames'] += 1
+        counters['bodies'] += len(index)
+
+    thread = threading.Thread(target=reader, name='udp-pose-reader')
+    thread.daemon = True
+    thread.start()
+
+    def stats():
+        """-> dict of frame counts and the mean, p50, p99 and max latency of the last frames"""
+        result = dict(counters, alive=state['alive'])
+        recent = latencies[:min(counters['frames'], history)]
+        if len(recent):
+            result.update(latency_mean=recent.mean(), latency_p50=np.percentile(recent, 50),
+                          latency_p99=np.percentile(recent, 99), latency_max=recent.max())
+        return result
+
+    def close():
+        state['running'] = False
+        thread.join(1.0)
+        sock.close()
+
+    return sock.getsockname()[1], stats, close
+
+
+def standin_poses(t, N, radius=1.0, period=20.):
+    """Synthetic mocap bodies: N robots evenly spaced on a circle, driving
+    around it once every period seconds.
+
+    -> Nx3 array of (x, y, theta) at time t (s)
+    """
+    angle = 2 * math.pi * (np.arange(N) / float(N) + t / period)
+    return np.column_stack((radius * np.cos(angle), radius * np.sin(angle), angle + math.pi / 2))
+
+
+def run_sender(target, N, rate, duration=None, poses=standin_poses):
+    """Sends synthetic frames of N bodies at rate Hz to 'udp://host:port'.
+
+    -> number of frames sent
+    """
+    url = urlparse(target)
+    assert url.scheme == 'udp' and url.port, "Pose target must be 'udp://host:port'. Recieved %r." % target
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (url.hostname, url.port)
+    index = np.arange(N)
+    start = time.time()
+    frame = 0
+    while duration is None or frame < duration * rate:
+        # Absolute schedule, so a late frame does not delay the ones after it
+        delay = start + frame / float(rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.time()
+        sock.sendto(pack_frame(now, frame, index, poses(now - start, N)), address)
+        frame += 1
+    sock.close()
+    return frame
+
+
+def measure_ros_latency(N, rate, frames):
+    """Publishes the synthetic frames as PoseStamped of every body and
+    subscribes to them in the same process.
+
+    -> numpy array of latencies (s), or None without rospy or a ROS master
+    """
+    try:
+        import rospy
+        from geometry_msgs.msg import PoseStamped
+    except ImportError:
+        return None
+    if not rospy.core.is_initialized():
+        try:
+            rospy.get_master().getPid()
+        except Exception:
+            return None
+        rospy.init_node('udp_poses_latency', anonymous=True, disable_signals=True)
+    latencies = []
+
+    def callback(data):
+        latencies.append(time.time() - data.header.stamp.to_sec())
+
+    topics = ['/udp_poses_latency/body%d/pose' % i for i in range(N)]
+    publishers = [rospy.Publisher(topic, PoseStamped, queue_size=1) for topic in topics]
+    subscribers = [rospy.Subscriber(topic, PoseStamped, callback, queue_size=1, tcp_nodelay=True) for topic in topics]
+    time.sleep(1.0)
+    messages = [PoseStamped() for _ in range(N)]
+    start = time.time()
+    for frame in range(frames):
+        delay = start + frame / float(rate) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        now = time.time()
+        for i, (x, y, theta) in enumerate(standin_poses(now - start, N)):
+            message = messages[i]
+            message.header.stamp = rospy.Time.from_sec(now)
+            message.pose.position.x, message.pose.position.y = x, y
+            message.pose.orientation.z, message.pose.orientation.w = math.sin(theta / 2), math.cos(theta / 2)
+            publishers[i].publish(message)
+    time.sleep(0.5)
+    for subscriber in subscribers:
+        subscriber.unregister()
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['send', 'latency'])
+    parser.add_argument('target', nargs='?', help="'udp://host:port' to send to")
+    parser.add_argument('--bodies', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100., help='frames per second')
+    parser.add_argument('--duration', type=float, help='seconds to send for (default forever)')
+    parser.add_argument('--frames', type=int, default=2000, help='frames to measure the latency over')
+    args = parser.parse_args()
+
+    if args.command == 'send':
+        if not args.target:
+            parser.error('send needs a target')
+        print('sent %d frames' % run_sender(args.target, args.bodies, args.rate, args.duration))
+        return
+
+    port, stats, close = create_udp_pose_reader(0, host='127.0.0.1', history=args.frames)
+    run_sender('udp://127.0.0.1:%d' % port, args.bodies, args.rate, args.frames / args.rate)
+    time.sleep(0.2)
+    close()
+    result = stats()
+    print('udp: %d frames, latency mean %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+        result['frames'], 1e3 * result['latency_mean'], 1e3 * result['latency_p50'], 1e3 * result['latency_p99'],
+        1e3 * result['latency_max']))
+    latencies = measure_ros_latency(args.bodies, args.rate, args.frames)
+    if latencies is None or not len(latencies):
+        print('ros: not measured (no rospy or no ROS master)')
+    else:
+        print('ros: %d poses, latency mean %.3f ms, p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+            len(latencies), 1e3 * latencies.mean(), 1e3 * np.percentile(latencies, 50),
+            1e3 * np.percentile(latencies, 99), 1e3 * latencies.max()))
+
+
+if __name__ == '__main__':
+    main()